@@ -1,4 +1,4 @@
-from django.contrib import admin
+from django.contrib import admin, messages
 from django.contrib.auth.admin import UserAdmin as BaseUserAdmin
 from django.contrib.auth.models import User as BaseUser, Permission as BasePermission
 from django.utils.text import slugify
@@ -7,6 +7,7 @@ from allianceauth.services.hooks import ServicesHook
 from django.db.models.signals import pre_save, post_save, pre_delete, post_delete, m2m_changed
 from django.dispatch import receiver
 from allianceauth.authentication.models import State, get_guest_state, CharacterOwnership, UserProfile, OwnershipRecord
+from allianceauth.authentication.tasks import get_state_check_progress
 from allianceauth.hooks import get_hooks
 from allianceauth.eveonline.models import EveCharacter
 from django.forms import ModelForm
@@ -159,6 +160,23 @@ class StateAdmin(admin.ModelAdmin):
     def user_count(obj):
         return obj.userprofile_set.all().count()
 
+    def changelist_view(self, request, extra_context=None):
+        # state changes are applied to users in the background, so show how far along that is
+        progress = get_state_check_progress()
+        if progress:
+            if progress['status'] == 'queued':
+                messages.info(request, 'User states are queued to be re-evaluated.')
+            elif progress['status'] == 'running':
+                messages.info(request, 'Re-evaluating user states: {checked} of {total} users checked, '
+                                       '{changed} changed so far.'.format(**progress))
+            elif progress['status'] == 'failed':
+                messages.warning(request, 'Re-evaluating user states stopped unexpectedly. '
+                                          'Save a state to re-evaluate them again.')
+            else:
+                messages.info(request, 'User states re-evaluated: {changed} of {total} users changed.'.format(
+                    **progress))
+        return super(StateAdmin, self).changelist_view(request, extra_context=extra_context)
+
 
 class BaseOwnershipAdmin(admin.ModelAdmin):
     list_display = ('user', 'character')
@@ -1,12 +1,47 @@
+from django.conf import settings
 from django.contrib.auth.backends import ModelBackend
 from django.contrib.auth.models import Permission
 from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+from django.db.models.functions import Length
 import logging
+import re
+import uuid
 from .models import UserProfile, CharacterOwnership, OwnershipRecord
 
 
 logger = logging.getLogger(__name__)
 
+PERMISSIONS_CACHE_TIMEOUT = getattr(settings, 'PERMISSIONS_CACHE_TIMEOUT', 60 * 60 * 24)
+PERMISSIONS_VERSION_KEY = 'authentication_permissions_version'
+USERNAME_ALLOCATION_ATTEMPTS = 5
+USERNAME_SUFFIX_CANDIDATES = 10  # suffixed usernames read when looking for the highest suffix
+
+
+def get_permissions_cache_key(user_pk):
+    version = cache.get(PERMISSIONS_VERSION_KEY)
+    if version is None:
+        cache.add(PERMISSIONS_VERSION_KEY, uuid.uuid4().hex, None)
+        version = cache.get(PERMISSIONS_VERSION_KEY)
+    return 'authentication_permissions_{0}_{1}'.format(version, user_pk)
+
+
+def invalidate_user_permissions(user_pk):
+    """
+    Discard the cached permissions of a single user, now and again once the current transaction commits
+    """
+    cache.delete(get_permissions_cache_key(user_pk))
+    transaction.on_commit(lambda: cache.delete(get_permissions_cache_key(user_pk)))
+
+
+def invalidate_all_permissions():
+    """
+    Discard the cached permissions of every user by replacing the version their cache keys include
+    """
+    cache.set(PERMISSIONS_VERSION_KEY, uuid.uuid4().hex, None)
+    transaction.on_commit(lambda: cache.set(PERMISSIONS_VERSION_KEY, uuid.uuid4().hex, None))
+
 
 class StateBackend(ModelBackend):
     @staticmethod
@@ -22,9 +57,15 @@ class StateBackend(ModelBackend):
         if not user_obj.is_active or user_obj.is_anonymous or obj is not None:
             return set()
         if not hasattr(user_obj, '_perm_cache'):
-            user_obj._perm_cache = self.get_user_permissions(user_obj)
-            user_obj._perm_cache.update(self.get_group_permissions(user_obj))
-            user_obj._perm_cache.update(self.get_state_permissions(user_obj))
+            # shared between requests until the user's groups, state or any permissions change
+            key = get_permissions_cache_key(user_obj.pk)
+            perms = cache.get(key)
+            if perms is None:
+                perms = self.get_user_permissions(user_obj)
+                perms.update(self.get_group_permissions(user_obj))
+                perms.update(self.get_state_permissions(user_obj))
+                cache.set(key, perms, PERMISSIONS_CACHE_TIMEOUT)
+            user_obj._perm_cache = perms
         return user_obj._perm_cache
 
     def authenticate(self, token=None):
@@ -66,8 +107,17 @@ class StateBackend(ModelBackend):
             return self.create_user(token)
 
     def create_user(self, token):
-        username = self.iterate_username(token.character_name)  # build unique username off character name
-        user = User.objects.create_user(username, is_active=False)  # prevent login until email set
+        for attempt in range(1, USERNAME_ALLOCATION_ATTEMPTS + 1):
+            username = self.iterate_username(token.character_name)  # build unique username off character name
+            try:
+                with transaction.atomic():
+                    user = User.objects.create_user(username, is_active=False)  # prevent login until email set
+                break
+            except IntegrityError:
+                # a concurrent registration claimed the same username first
+                if attempt == USERNAME_ALLOCATION_ATTEMPTS:
+                    raise
+                logger.debug('Username {0} was taken during registration. Retrying.'.format(username))
         user.set_unusable_password()  # prevent login via password
         user.save()
         token.user = user
@@ -81,13 +131,18 @@ class StateBackend(ModelBackend):
     def iterate_username(name):
         name = str.replace(name, "'", "")
         name = str.replace(name, ' ', '_')
-        if User.objects.filter(username__startswith=name).exists():
-            u = User.objects.filter(username__startswith=name)
-            num = len(u)
-            username = "%s_%s" % (name, num)
-            while u.filter(username=username).exists():
-                num += 1
-                username = "%s_%s" % (name, num)
-        else:
-            username = name
-        return username
+        # usernames are compared case-insensitively, as some database collations treat them that way
+        if not User.objects.filter(username__iexact=name).exists():
+            return name
+        # the longest suffixed usernames have the highest suffixes, matched by length so the name itself
+        # is never interpreted as a database regex
+        candidates = User.objects.filter(username__istartswith=name).filter(
+            username__iregex=r'^.{%d}_[0-9]+$' % len(name)).annotate(
+            username_length=Length('username')).order_by('-username_length', '-username').values_list(
+            'username', flat=True)[:USERNAME_SUFFIX_CANDIDATES]
+        pattern = re.compile(r'%s_([0-9]+)' % re.escape(name), re.IGNORECASE)
+        suffix = max((int(match.group(1)) for match in map(pattern.fullmatch, candidates) if match), default=0) + 1
+        # leading zeros can hide a higher suffix from the ordering, so make sure the username is free
+        while User.objects.filter(username__iexact="%s_%s" % (name, suffix)).exists():
+            suffix += 1
+        return "%s_%s" % (name, suffix)
@@ -1,12 +1,19 @@
+import copy
 import logging
+import uuid
+from collections import defaultdict
 
+from django.core.cache import cache
 from django.db import transaction
 from django.db.models import Manager, QuerySet, Q
 
 from allianceauth.eveonline.models import EveCharacter
+from allianceauth.eveonline.tasks import update_characters
 
 logger = logging.getLogger(__name__)
 
+BULK_CHUNK_SIZE = 500
+
 
 def available_states_query(character):
     query = Q(public=True)
@@ -19,13 +26,146 @@ def available_states_query(character):
     return query
 
 
+class StateIndex:
+    """
+    Maps character, corporation and alliance IDs to the highest priority state available to them.
+    Each process builds it once, then rebuilds it whenever a state change replaces the version kept in the cache.
+    """
+    version_key = 'authentication_state_index_version'
+
+    def __init__(self):
+        self.version = None
+        self.index = None
+
+    def invalidate(self):
+        cache.set(self.version_key, uuid.uuid4().hex, None)
+
+    def current_version(self):
+        version = cache.get(self.version_key)
+        if version is None:
+            version = uuid.uuid4().hex
+            cache.add(self.version_key, version, None)
+            version = cache.get(self.version_key, version)
+        return version
+
+    @staticmethod
+    def build():
+        from allianceauth.authentication.models import State
+        states = {state.pk: state for state in State.objects.all()}
+
+        def best(rows):
+            mapping = {}
+            for obj_id, state_pk in rows:
+                entry = (states[state_pk].priority, state_pk)
+                if entry > mapping.get(obj_id, (float('-inf'),)):
+                    mapping[obj_id] = entry
+            return mapping
+
+        return {
+            'states': states,
+            'public': max(((state.priority, pk) for pk, state in states.items() if state.public), default=None),
+            'characters': best(State.member_characters.through.objects.values_list(
+                'evecharacter__character_id', 'state_id')),
+            'corporations': best(State.member_corporations.through.objects.values_list(
+                'evecorporationinfo__corporation_id', 'state_id')),
+            'alliances': best(State.member_alliances.through.objects.values_list(
+                'eveallianceinfo__alliance_id', 'state_id')),
+        }
+
+    def get_index(self):
+        version = self.current_version()
+        if version != self.version:
+            logger.debug('Building state index version {0}'.format(version))
+            # read the version first, so changes made while building replace it and force another rebuild
+            self.index, self.version = self.build(), version
+        return self.index
+
+    def get_for_character(self, character):
+        """
+        Find the highest priority state available to a character
+        :return: State or None if no state is available
+        """
+        index = self.get_index()
+        candidates = [index['public']]
+        for key, obj_id in (('characters', character.character_id), ('corporations', character.corporation_id),
+                            ('alliances', character.alliance_id)):
+            if obj_id:
+                candidates.append(index[key].get(int(obj_id)))
+        candidates = [c for c in candidates if c is not None]
+        if not candidates:
+            return None
+        # a copy, so callers can't change the instance shared by later lookups
+        return copy.copy(index['states'][max(candidates)[1]])
+
+
+state_index = StateIndex()
+
+
 class CharacterOwnershipManager(Manager):
+    @staticmethod
+    def resolve_character(character):
+        """
+        Resolves a character created from a token alone, whose corp and alliance are still unknown, from ESI now.
+        Needed wherever the character can become a main, as states and autogroups depend on its corp and alliance.
+        :return: the character
+        """
+        if not character.corporation_id:
+            logger.debug('Resolving character {0} before it is relied upon'.format(character))
+            character.update_character()
+        return character
+
+    @classmethod
+    def _get_or_create_character(cls, character_id):
+        character = EveCharacter.objects.filter(character_id=character_id).first()
+        if character is None:
+            logger.debug('Token is for a new character. Creating model for {0}'.format(character_id))
+            return EveCharacter.objects.create_character(character_id)
+        return cls.resolve_character(character)
+
+    @staticmethod
+    def _get_or_create_character_deferred(token):
+        """
+        Looks up the token's character, or creates it from the token's name alone and resolves it from ESI later.
+        Flows which can make the character a main resolve it straight away with resolve_character.
+        """
+        character = EveCharacter.objects.filter(character_id=token.character_id).first()
+        if character is None:
+            logger.debug('Token is for a new character. Queueing update of model for {0}'.format(token.character_id))
+            # never updated, so it is refreshed first should the queued update be lost
+            character = EveCharacter.objects.create(character_id=token.character_id,
+                                                    character_name=token.character_name, corporation_name='',
+                                                    corporation_ticker='', last_updated=None)
+            transaction.on_commit(lambda: update_characters.delay([token.character_id]))
+        return character
+
     def create_by_token(self, token):
-        if not EveCharacter.objects.filter(character_id=token.character_id).exists():
-            EveCharacter.objects.create_character(token.character_id)
-        return self.create(character=EveCharacter.objects.get(character_id=token.character_id), user=token.user,
+        return self.create(character=self._get_or_create_character(token.character_id), user=token.user,
                            owner_hash=token.character_owner_hash)
 
+    def record_token(self, token):
+        """
+        Brings the ownership of the token's character in line with a newly saved token
+        Revokes an ownership with another owner hash or user, then assigns the character to the token's user.
+        A new character is only created when the token has a user to own it, and is resolved from ESI in a task.
+        :return: the character's ownership, or None if it has none
+        """
+        with transaction.atomic():
+            ownership = self.filter(character__character_id=token.character_id).select_related('character').first()
+            if ownership is not None:
+                if ownership.owner_hash == token.character_owner_hash and (
+                        token.user_id is None or ownership.user_id == token.user_id):
+                    return ownership
+                # purge ownership records if the hash or auth user account has changed
+                character = ownership.character
+                ownership.delete()
+            elif token.user_id is not None:
+                character = self._get_or_create_character_deferred(token)
+            if token.user_id is None:
+                return None
+            logger.debug("Character {0} is not yet owned. Assigning ownership to {1}".format(token.character_name,
+                                                                                             token.user))
+            return self.create(character=character, user=token.user, owner_hash=token.character_owner_hash)
+
 
 class StateQuerySet(QuerySet):
     def available_to_character(self, character):
@@ -45,11 +185,68 @@ class StateQuerySet(QuerySet):
             from allianceauth.authentication.models import get_guest_state
             return get_guest_state()
 
+    def resolve_for_profiles(self, profiles):
+        """
+        Find the highest priority state in this queryset available to each profile's main character.
+        Runs one query per state instead of one per profile.
+        :param profiles: UserProfile queryset
+        :return: dict of profile pk to state pk, omitting profiles with no available state
+        """
+        resolved = {}
+        with_main = profiles.filter(main_character__isnull=False)
+        for state in self.order_by('-priority'):
+            if state.public:
+                members = with_main
+            else:
+                members = with_main.filter(
+                    Q(main_character__in=state.member_characters.all()) |
+                    Q(main_character__corporation_id__in=state.member_corporations.values('corporation_id')) |
+                    Q(main_character__alliance_id__in=state.member_alliances.values('alliance_id')))
+            for pk in members.values_list('pk', flat=True):
+                resolved.setdefault(pk, state.pk)
+            if state.public:
+                # every remaining profile has this state available
+                break
+        return resolved
+
+    def assign_to_profiles(self, profiles):
+        """
+        Assign each profile the highest priority state in this queryset available to it, or the guest state.
+        Changed assignments are saved in bulk, then state_changed is sent only for those users.
+        :param profiles: UserProfile queryset
+        :return: list of UserProfiles whose state changed
+        """
+        from allianceauth.authentication.models import get_guest_state
+        guest_state_pk = get_guest_state().pk
+        resolved = self.resolve_for_profiles(profiles)
+        changes = defaultdict(list)
+        for pk, state_pk in profiles.values_list('pk', 'state_id'):
+            new_state_pk = resolved.get(pk, guest_state_pk)
+            if new_state_pk != state_pk:
+                changes[new_state_pk].append(pk)
+        if not changes:
+            return []
+
+        with transaction.atomic():
+            for state_pk, pks in changes.items():
+                for i in range(0, len(pks), BULK_CHUNK_SIZE):
+                    profiles.model.objects.filter(pk__in=pks[i:i + BULK_CHUNK_SIZE]).update(state_id=state_pk)
+
+        changed = []
+        for state_pk, pks in changes.items():
+            for i in range(0, len(pks), BULK_CHUNK_SIZE):
+                changed.extend(profiles.model.objects.select_related('user', 'state').filter(
+                    pk__in=pks[i:i + BULK_CHUNK_SIZE]))
+        logger.info('Updated state of {0} users'.format(len(changed)))
+        for profile in changed:
+            profile.notify_state_change()
+        return changed
+
     def delete(self):
+        from allianceauth.authentication.models import UserProfile
         with transaction.atomic():
-            for state in self:
-                for profile in state.userprofile_set.all():
-                    profile.assign_state(state=self.model.objects.exclude(pk=state.pk).get_for_user(profile.user))
+            remaining = self.model.objects.exclude(pk__in=[state.pk for state in self])
+            remaining.assign_to_profiles(UserProfile.objects.filter(state__in=self))
         super(StateQuerySet, self).delete()
 
 
@@ -64,12 +261,27 @@ class StateManager(Manager):
         return self.get_queryset().available_to_user(user)
 
     def get_for_character(self, character):
-        states = self.get_queryset().available_to_character(character)
-        if states.exists():
-            return states[0]
-        else:
+        state = state_index.get_for_character(character)
+        if state is None:
             from allianceauth.authentication.models import get_guest_state
             return get_guest_state()
+        return state
 
     def get_for_user(self, user):
-        return self.get_queryset().get_for_user(user)
+        if user.profile.main_character:
+            return self.get_for_character(user.profile.main_character)
+        else:
+            from allianceauth.authentication.models import get_guest_state
+            return get_guest_state()
+
+    @staticmethod
+    def invalidate_index():
+        state_index.invalidate()
+        # also once committed, in case another process rebuilt the index from the uncommitted state
+        transaction.on_commit(state_index.invalidate)
+
+    def resolve_for_profiles(self, profiles):
+        return self.get_queryset().resolve_for_profiles(profiles)
+
+    def assign_to_profiles(self, profiles):
+        return self.get_queryset().assign_to_profiles(profiles)
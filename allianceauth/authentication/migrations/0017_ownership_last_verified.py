@@ -0,0 +1,18 @@
+# Generated by Django 2.0.13 on 2026-10-18 08:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('authentication', '0016_ownershiprecord'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='characterownership',
+            name='last_verified',
+            field=models.DateTimeField(blank=True, db_index=True, help_text='When the owner hash was last confirmed with SSO.', null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.0.13 on 2026-10-18 09:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('authentication', '0017_ownership_last_verified'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='characterownership',
+            name='last_verify_attempt',
+            field=models.DateTimeField(blank=True, db_index=True, help_text='When the owner hash was last checked with SSO, successfully or not.', null=True),
+        ),
+    ]
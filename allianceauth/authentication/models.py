@@ -41,8 +41,7 @@ class State(models.Model):
 
     def delete(self, **kwargs):
         with transaction.atomic():
-            for profile in self.userprofile_set.all():
-                profile.assign_state(state=State.objects.exclude(pk=self.pk).get_for_user(profile.user))
+            State.objects.exclude(pk=self.pk).assign_to_profiles(self.userprofile_set.all())
         super(State, self).delete(**kwargs)
 
 
@@ -73,11 +72,14 @@ class UserProfile(models.Model):
             if commit:
                 logger.info('Updating {} state to {}'.format(self.user, self.state))
                 self.save(update_fields=['state'])
-                notify(self.user, _('State Changed'),
-                       _('Your user state has been changed to %(state)s') % ({'state': state}),
-                       'info')
-                from allianceauth.authentication.signals import state_changed
-                state_changed.send(sender=self.__class__, user=self.user, state=self.state)
+                self.notify_state_change()
+
+    def notify_state_change(self):
+        notify(self.user, _('State Changed'),
+               _('Your user state has been changed to %(state)s') % ({'state': self.state}),
+               'info')
+        from allianceauth.authentication.signals import state_changed
+        state_changed.send(sender=self.__class__, user=self.user, state=self.state)
 
     def __str__(self):
         return str(self.user)
@@ -91,6 +93,11 @@ class CharacterOwnership(models.Model):
     character = models.OneToOneField(EveCharacter, on_delete=models.CASCADE, related_name='character_ownership')
     owner_hash = models.CharField(max_length=28, unique=True)
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='character_ownerships')
+    last_verified = models.DateTimeField(null=True, blank=True, db_index=True,
+                                         help_text="When the owner hash was last confirmed with SSO.")
+    last_verify_attempt = models.DateTimeField(null=True, blank=True, db_index=True,
+                                               help_text="When the owner hash was last checked with SSO, "
+                                                         "successfully or not.")
 
     objects = CharacterOwnershipManager()
 
@@ -1,58 +1,62 @@
 import logging
 
 from .models import CharacterOwnership, UserProfile, get_guest_state, State, OwnershipRecord
-from django.contrib.auth.models import User
-from django.db.models import Q
+from .backends import invalidate_user_permissions, invalidate_all_permissions
+from .tasks import queue_state_check
+from django.contrib.auth.models import User, Group, Permission
 from django.db.models.signals import pre_save, post_save, pre_delete, post_delete, m2m_changed
 from django.dispatch import receiver, Signal
 from esi.models import Token
 
-from allianceauth.eveonline.models import EveCharacter
+from allianceauth.eveonline.models import EveCharacter, EveCorporationInfo, EveAllianceInfo
 
 logger = logging.getLogger(__name__)
 
 state_changed = Signal(providing_args=['user', 'state'])
 
 
-def trigger_state_check(state):
-    # evaluate all current members to ensure they still have access
-    for profile in state.userprofile_set.all():
-        profile.assign_state()
-
-    # we may now be available to others with lower states
-    check_states = State.objects.filter(priority__lt=state.priority)
-    for profile in UserProfile.objects.filter(state__in=check_states):
-        if state.available_to_user(profile.user):
-            profile.state = state
-            profile.save(update_fields=['state'])
-            state_changed.send(sender=state.__class__, user=profile.user, state=state)
-
-
 @receiver(m2m_changed, sender=State.member_characters.through)
 def state_member_characters_changed(sender, instance, action, *args, **kwargs):
     if action.startswith('post_'):
-        logger.debug('State {} member characters changed. Re-evaluating membership.'.format(instance))
-        trigger_state_check(instance)
+        logger.debug('State {} member characters changed. Queueing membership re-evaluation.'.format(instance))
+        State.objects.invalidate_index()
+        queue_state_check()
 
 
 @receiver(m2m_changed, sender=State.member_corporations.through)
 def state_member_corporations_changed(sender, instance, action, *args, **kwargs):
     if action.startswith('post_'):
-        logger.debug('State {} member corporations changed. Re-evaluating membership.'.format(instance))
-        trigger_state_check(instance)
+        logger.debug('State {} member corporations changed. Queueing membership re-evaluation.'.format(instance))
+        State.objects.invalidate_index()
+        queue_state_check()
 
 
 @receiver(m2m_changed, sender=State.member_alliances.through)
 def state_member_alliances_changed(sender, instance, action, *args, **kwargs):
     if action.startswith('post_'):
-        logger.debug('State {} member alliances changed. Re-evaluating membership.'.format(instance))
-        trigger_state_check(instance)
+        logger.debug('State {} member alliances changed. Queueing membership re-evaluation.'.format(instance))
+        State.objects.invalidate_index()
+        queue_state_check()
 
 
 @receiver(post_save, sender=State)
 def state_saved(sender, instance, *args, **kwargs):
-    logger.debug('State {} saved. Re-evaluating membership.'.format(instance))
-    trigger_state_check(instance)
+    logger.debug('State {} saved. Queueing membership re-evaluation.'.format(instance))
+    State.objects.invalidate_index()
+    queue_state_check()
+
+
+@receiver(post_delete, sender=State)
+def state_deleted(sender, instance, *args, **kwargs):
+    State.objects.invalidate_index()
+
+
+@receiver(post_delete, sender=EveCharacter)
+@receiver(post_delete, sender=EveCorporationInfo)
+@receiver(post_delete, sender=EveAllianceInfo)
+def state_member_deleted(sender, instance, *args, **kwargs):
+    # deleting drops any state memberships without sending m2m_changed
+    State.objects.invalidate_index()
 
 
 # Is there a smarter way to intercept pre_save with a diff main_character or state?
@@ -79,26 +83,7 @@ def record_character_ownership(sender, instance, created, *args, **kwargs):
     if created:
         logger.debug('New token for {0} character {1} saved. Evaluating ownership.'.format(instance.user,
                                                                                            instance.character_name))
-        if instance.user:
-            query = Q(owner_hash=instance.character_owner_hash) & Q(user=instance.user)
-        else:
-            query = Q(owner_hash=instance.character_owner_hash)
-        # purge ownership records if the hash or auth user account has changed
-        CharacterOwnership.objects.filter(character__character_id=instance.character_id).exclude(query).delete()
-        # create character if needed
-        if EveCharacter.objects.filter(character_id=instance.character_id).exists() is False:
-            logger.debug('Token is for a new character. Creating model for {0} ({1})'.format(instance.character_name,
-                                                                                             instance.character_id))
-            EveCharacter.objects.create_character(instance.character_id)
-        char = EveCharacter.objects.get(character_id=instance.character_id)
-        # check if we need to create ownership
-        if instance.user and not CharacterOwnership.objects.filter(
-                character__character_id=instance.character_id).exists():
-            logger.debug("Character {0} is not yet owned. Assigning ownership to {1}".format(instance.character_name,
-                                                                                             instance.user))
-            CharacterOwnership.objects.update_or_create(character=char,
-                                                        defaults={'owner_hash': instance.character_owner_hash,
-                                                                  'user': instance.user})
+        CharacterOwnership.objects.record_token(instance)
 
 
 @receiver(pre_delete, sender=CharacterOwnership)
@@ -158,4 +143,51 @@ def ownership_record_creation(sender, instance, created, *args, **kwargs):
                 logger.debug("Already have ownership record of {0} by user {1}".format(instance.character, instance.user))
                 return
         logger.info("Character {0} has a new owner {1}. Creating ownership record.".format(instance.character, instance.user))
-        OwnershipRecord.objects.create(user=instance.user, character=instance.character, owner_hash=instance.owner_hash)
\ No newline at end of file
+        OwnershipRecord.objects.create(user=instance.user, character=instance.character, owner_hash=instance.owner_hash)
+
+
+@receiver(m2m_changed, sender=User.groups.through)
+@receiver(m2m_changed, sender=User.user_permissions.through)
+def user_permissions_changed(sender, instance, action, reverse, pk_set, *args, **kwargs):
+    if action.startswith('post_'):
+        if not reverse:
+            invalidate_user_permissions(instance.pk)
+        elif pk_set:
+            for pk in pk_set:
+                invalidate_user_permissions(pk)
+        else:
+            # a group or permission was cleared from all of its users
+            invalidate_all_permissions()
+
+
+@receiver(m2m_changed, sender=Group.permissions.through)
+@receiver(m2m_changed, sender=State.permissions.through)
+def group_or_state_permissions_changed(sender, action, *args, **kwargs):
+    if action.startswith('post_'):
+        invalidate_all_permissions()
+
+
+@receiver(post_delete, sender=Group)
+@receiver(post_delete, sender=State)
+@receiver(post_delete, sender=Permission)
+def permission_holder_deleted(sender, *args, **kwargs):
+    invalidate_all_permissions()
+
+
+@receiver(post_save, sender=User)
+def user_saved_permissions_changed(sender, instance, update_fields=None, *args, **kwargs):
+    # superusers have every permission, saves only touching other fields like last_login can't change them
+    if update_fields is None or {'is_superuser', 'is_active'}.intersection(update_fields):
+        invalidate_user_permissions(instance.pk)
+
+
+@receiver(post_save, sender=UserProfile)
+def profile_permissions_changed(sender, instance, *args, **kwargs):
+    # the state may have changed
+    invalidate_user_permissions(instance.user_id)
+
+
+@receiver(state_changed)
+def state_permissions_changed(sender, user, *args, **kwargs):
+    # sent for profiles whose state is changed in bulk without saving them
+    invalidate_user_permissions(user.pk)
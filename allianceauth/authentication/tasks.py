@@ -1,22 +1,54 @@
 import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
 
+from esi import app_settings
 from esi.errors import TokenExpiredError, TokenInvalidError, IncompleteResponseError
 from esi.models import Token
 from celery import shared_task
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+from requests.auth import HTTPBasicAuth
+from requests_oauthlib import OAuth2Session
 
-from allianceauth.authentication.models import CharacterOwnership
+from allianceauth.authentication.models import CharacterOwnership, State, UserProfile
 
 logger = logging.getLogger(__name__)
 
+STATE_CHECK_DELAY = getattr(settings, 'STATE_CHECK_DELAY', 5)  # seconds to wait for further state changes
+STATE_CHECK_CHUNK_SIZE = 1000
+STATE_CHECK_SCHEDULED_KEY = 'authentication_state_check_scheduled'
+STATE_CHECK_PROGRESS_KEY = 'authentication_state_check_progress'
+# a scheduled check that hasn't started or made progress by now is assumed lost, so another may be scheduled
+STATE_CHECK_TIMEOUT = 10 * 60
+STATE_CHECK_RESULT_TIMEOUT = 60 * 60  # seconds a finished check's result is kept for display
+OWNERSHIP_VERIFY_BATCH_SIZE = getattr(settings, 'OWNERSHIP_VERIFY_BATCH_SIZE', 500)
+OWNERSHIP_VERIFY_WORKERS = getattr(settings, 'OWNERSHIP_VERIFY_WORKERS', 10)  # concurrent requests to SSO
+# seconds before a verified ownership is verified again, a little less than the check_all_character_ownership
+# schedule so each run covers those the last run verified
+OWNERSHIP_VERIFY_INTERVAL = getattr(settings, 'OWNERSHIP_VERIFY_INTERVAL', 60 * 60 * 3)
 
-@shared_task
-def check_character_ownership(owner_hash):
+_sso_sessions = threading.local()
+
+
+def verify_owner_hash(owner_hash, update_token_data=None):
+    """
+    Checks the tokens with the given owner hash against SSO, revoking ownership if the character has changed owner
+    :param update_token_data: callable refreshing a token's data from SSO without saving it
+    :return: False if SSO couldn't confirm the owner hash either way, otherwise True
+    """
+    update_token_data = update_token_data or (lambda token: token.update_token_data(commit=False))
     tokens = Token.objects.filter(character_owner_hash=owner_hash)
     if tokens:
         for t in tokens:
             old_hash = t.character_owner_hash
             try:
-                t.update_token_data(commit=False)
+                update_token_data(t)
             except (TokenExpiredError, TokenInvalidError):
                 t.delete()
                 continue
@@ -24,7 +56,7 @@ def check_character_ownership(owner_hash):
                 # We can't validate the hash hasn't changed but also can't assume it has. Abort for now.
                 logger.warning("Failed to validate owner hash of {0} due to problems contacting SSO servers.".format(
                     tokens[0].character_name))
-                break
+                return False
 
             if not t.character_owner_hash == old_hash:
                 logger.info(
@@ -35,9 +67,159 @@ def check_character_ownership(owner_hash):
     if not Token.objects.filter(character_owner_hash=owner_hash).exists():
         logger.info('No tokens found with owner hash %s. Revoking ownership.' % owner_hash)
         CharacterOwnership.objects.filter(owner_hash=owner_hash).delete()
+    return True
+
+
+@shared_task
+def check_character_ownership(owner_hash):
+    now = timezone.now()
+    if verify_owner_hash(owner_hash):
+        CharacterOwnership.objects.filter(owner_hash=owner_hash).update(last_verified=now, last_verify_attempt=now)
+    else:
+        CharacterOwnership.objects.filter(owner_hash=owner_hash).update(last_verify_attempt=now)
 
 
 @shared_task
 def check_all_character_ownership():
-    for c in CharacterOwnership.objects.all().only('owner_hash'):
-        check_character_ownership.delay(c.owner_hash)
+    verify_character_ownerships.delay()
+
+
+def get_sso_session():
+    """
+    :return: OAuth2Session of the current thread, so its connections to SSO are reused between tokens
+    """
+    if not hasattr(_sso_sessions, 'session'):
+        _sso_sessions.session = OAuth2Session(app_settings.ESI_SSO_CLIENT_ID)
+    return _sso_sessions.session
+
+
+def update_token_data_pooled(token):
+    """
+    Token.update_token_data without saving, refreshing and verifying tokens through the current thread's SSO session
+    """
+    session = get_sso_session()
+    if token.expired:
+        if not token.can_refresh:
+            raise TokenExpiredError()
+        token.refresh(session=session,
+                      auth=HTTPBasicAuth(app_settings.ESI_SSO_CLIENT_ID, app_settings.ESI_SSO_CLIENT_SECRET))
+    # the session is shared between tokens, so send this token's own instead of the session's
+    token_data = session.request('get', app_settings.ESI_TOKEN_VERIFY_URL, withhold_token=True,
+                                 headers={'Authorization': 'Bearer ' + token.access_token}).json()
+    token.character_id = token_data['CharacterID']
+    token.character_name = token_data['CharacterName']
+    token.character_owner_hash = token_data['CharacterOwnerHash']
+    token.token_type = token_data['TokenType']
+
+
+def _verify_owner_hash_pooled(owner_hash):
+    try:
+        return verify_owner_hash(owner_hash, update_token_data=update_token_data_pooled)
+    except Exception:
+        logger.exception('Failed to verify owner hash {0}'.format(owner_hash))
+        return False
+
+
+def _verify_owner_hash_in_thread(owner_hash):
+    try:
+        return _verify_owner_hash_pooled(owner_hash)
+    finally:
+        # worker threads each open their own database connection
+        connection.close()
+
+
+@shared_task
+def verify_character_ownerships(batch_size=OWNERSHIP_VERIFY_BATCH_SIZE):
+    """
+    Verifies the ownerships attempted longest ago, a batch at a time with up to OWNERSHIP_VERIFY_WORKERS in parallel.
+    Ownerships attempted within the last OWNERSHIP_VERIFY_INTERVAL seconds are skipped, whether or not SSO could
+    verify them, so failing ownerships can't hold up the rest.
+    Queues the next batch until none are left.
+    :return: dict of stats for this batch
+    """
+    started = time.monotonic()
+    cutoff = timezone.now() - timedelta(seconds=OWNERSHIP_VERIFY_INTERVAL)
+    owner_hashes = list(CharacterOwnership.objects.filter(
+        Q(last_verify_attempt__isnull=True) | Q(last_verify_attempt__lt=cutoff)).order_by(
+        F('last_verify_attempt').asc(nulls_first=True)).values_list('owner_hash', flat=True)[:batch_size])
+
+    if OWNERSHIP_VERIFY_WORKERS > 1 and len(owner_hashes) > 1:
+        with ThreadPoolExecutor(max_workers=OWNERSHIP_VERIFY_WORKERS) as executor:
+            results = list(executor.map(_verify_owner_hash_in_thread, owner_hashes))
+    else:
+        results = [_verify_owner_hash_pooled(owner_hash) for owner_hash in owner_hashes]
+
+    verified = [owner_hash for owner_hash, result in zip(owner_hashes, results) if result]
+    now = timezone.now()
+    CharacterOwnership.objects.filter(owner_hash__in=verified).update(last_verified=now)
+    CharacterOwnership.objects.filter(owner_hash__in=owner_hashes).update(last_verify_attempt=now)
+    elapsed = time.monotonic() - started
+    stats = {
+        'checked': len(owner_hashes),
+        'verified': len(verified),
+        'failed': len(owner_hashes) - len(verified),
+        'revoked': len(owner_hashes) - CharacterOwnership.objects.filter(owner_hash__in=owner_hashes).count(),
+        'seconds': round(elapsed, 2),
+        'per_second': round(len(owner_hashes) / elapsed, 2) if elapsed else 0,
+    }
+    logger.info('Verified {verified} of {checked} character ownerships in {seconds} seconds ({per_second}/s), '
+                '{revoked} revoked and {failed} failed.'.format(**stats))
+
+    # stop once a batch verifies nothing, as SSO is likely unavailable
+    if len(owner_hashes) == batch_size and verified:
+        verify_character_ownerships.delay(batch_size)
+    return stats
+
+
+def queue_state_check():
+    """
+    Schedules a re-evaluation of every user's state once the current transaction commits.
+    State changes made before the check starts are covered by the same check.
+    """
+    transaction.on_commit(schedule_state_check)
+
+
+def schedule_state_check():
+    if cache.add(STATE_CHECK_SCHEDULED_KEY, True, STATE_CHECK_DELAY + STATE_CHECK_TIMEOUT):
+        logger.debug('Scheduling state check in {0} seconds.'.format(STATE_CHECK_DELAY))
+        now = timezone.now()
+        cache.set(STATE_CHECK_PROGRESS_KEY, {'status': 'queued', 'queued': now, 'updated': now}, None)
+        check_all_states.apply_async(countdown=STATE_CHECK_DELAY)
+    else:
+        logger.debug('State check already scheduled.')
+
+
+def get_state_check_progress():
+    """
+    :return: dict describing the latest state check, or None if there hasn't been one recently
+    A check which has made no progress for STATE_CHECK_TIMEOUT seconds is reported as failed, as its worker has died.
+    """
+    progress = cache.get(STATE_CHECK_PROGRESS_KEY)
+    if progress and progress['status'] in ('queued', 'running'):
+        if progress['updated'] < timezone.now() - timedelta(seconds=STATE_CHECK_DELAY + STATE_CHECK_TIMEOUT):
+            progress['status'] = 'failed'
+    return progress
+
+
+@shared_task
+def check_all_states():
+    """
+    Assigns every user the state they are now entitled to, in chunks so progress can be reported.
+    """
+    # changes from here on schedule another check, as this one may have already read past them
+    cache.delete(STATE_CHECK_SCHEDULED_KEY)
+    profiles = UserProfile.objects.order_by('pk')
+    pks = list(profiles.values_list('pk', flat=True))
+    now = timezone.now()
+    progress = {'status': 'running', 'started': now, 'updated': now, 'total': len(pks), 'checked': 0, 'changed': 0}
+    cache.set(STATE_CHECK_PROGRESS_KEY, progress, None)
+    for i in range(0, len(pks), STATE_CHECK_CHUNK_SIZE):
+        chunk = pks[i:i + STATE_CHECK_CHUNK_SIZE]
+        changed = State.objects.assign_to_profiles(profiles.filter(pk__gte=chunk[0], pk__lte=chunk[-1]))
+        # updated after every chunk, so a check whose worker died can be told apart from a slow one
+        progress.update(checked=progress['checked'] + len(chunk), changed=progress['changed'] + len(changed),
+                        updated=timezone.now())
+        cache.set(STATE_CHECK_PROGRESS_KEY, progress, None)
+    progress.update(status='finished', finished=timezone.now())
+    cache.set(STATE_CHECK_PROGRESS_KEY, progress, STATE_CHECK_RESULT_TIMEOUT)
+    logger.info('Checked states of {0} users, {1} changed.'.format(progress['checked'], progress['changed']))
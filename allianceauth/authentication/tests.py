@@ -1,19 +1,28 @@
+import threading
+from datetime import timedelta
 from unittest import mock
 from io import StringIO
 from django.test import TestCase
-from django.contrib.auth.models import User
+from django.contrib.auth.models import User, Group, Permission
 from allianceauth.tests.auth_utils import AuthUtils
+from .managers import StateIndex
 from .models import CharacterOwnership, UserProfile, State, get_guest_state, OwnershipRecord
 from .backends import StateBackend
-from .tasks import check_character_ownership
+from .tasks import check_character_ownership, check_all_states, schedule_state_check, get_state_check_progress, \
+    STATE_CHECK_DELAY, STATE_CHECK_PROGRESS_KEY, STATE_CHECK_SCHEDULED_KEY, verify_character_ownerships, \
+    get_sso_session, update_token_data_pooled
 from allianceauth.eveonline.models import EveCharacter, EveCorporationInfo, EveAllianceInfo
+from allianceauth.eveonline.providers import Character, Corporation
+from .views import main_character_change
 from esi.models import Token
-from esi.errors import IncompleteResponseError
+from esi.errors import IncompleteResponseError, TokenExpiredError
 from allianceauth.authentication.decorators import main_character_required
 from django.test.client import RequestFactory
 from django.http.response import HttpResponse
 from django.contrib.auth.models import AnonymousUser
 from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
 from django.shortcuts import reverse
 from django.core.management import call_command
 from urllib import parse
@@ -124,6 +133,34 @@ class BackendTestCase(TestCase):
         self.assertTrue(CharacterOwnership.objects.filter(owner_hash='4', user=self.old_user).exists())
         self.assertTrue(user.profile.main_character)
 
+    def test_permissions_cached(self):
+        permission = Permission.objects.get(codename='change_userprofile')
+        group = Group.objects.create(name='test group')
+        self.user.groups.add(group)
+        self.assertFalse(StateBackend().has_perm(User.objects.get(pk=self.user.pk), 'authentication.change_userprofile'))
+
+        # a later request only reads the permissions version and its cached permissions
+        user = User.objects.get(pk=self.user.pk)
+        with self.assertNumQueries(2):
+            self.assertEqual(StateBackend().get_all_permissions(user), set())
+
+        group.permissions.add(permission)
+        self.assertTrue(StateBackend().has_perm(User.objects.get(pk=self.user.pk), 'authentication.change_userprofile'))
+        self.user.groups.remove(group)
+        self.assertFalse(StateBackend().has_perm(User.objects.get(pk=self.user.pk), 'authentication.change_userprofile'))
+        self.user.profile.state.permissions.add(permission)
+        self.assertTrue(StateBackend().has_perm(User.objects.get(pk=self.user.pk), 'authentication.change_userprofile'))
+
+    def test_permissions_cache_superuser_demoted(self):
+        user = User.objects.get(pk=self.user.pk)
+        user.is_superuser = True
+        user.save()
+        self.assertTrue(StateBackend().has_perm(User.objects.get(pk=user.pk), 'authentication.change_userprofile'))
+
+        user.is_superuser = False
+        user.save()
+        self.assertFalse(StateBackend().has_perm(User.objects.get(pk=user.pk), 'authentication.change_userprofile'))
+
     def test_iterate_username(self):
         t = Token(character_id=self.unclaimed_character.character_id,
                   character_name=self.unclaimed_character.character_name, character_owner_hash='3')
@@ -136,6 +173,39 @@ class BackendTestCase(TestCase):
         self.assertTrue(username_1.endswith('_1'))
         self.assertTrue(username_2.endswith('_2'))
 
+    def test_iterate_username_next_suffix(self):
+        for username in ['Test_Name', 'Test_Name_1', 'Test_Name_9', 'Test_Name_10', 'Test_Name_Other_Character']:
+            User.objects.create(username=username)
+        with self.assertNumQueries(3):
+            self.assertEqual(StateBackend.iterate_username("Test Name"), 'Test_Name_11')
+        self.assertEqual(StateBackend.iterate_username("Test Name Other"), 'Test_Name_Other')
+
+    def test_iterate_username_leading_zeros(self):
+        for username in ['Test.Name', 'Test.Name_009', 'Test.Name_10']:
+            User.objects.create(username=username)
+        self.assertEqual(StateBackend.iterate_username("Test.Name"), 'Test.Name_11')
+
+    def test_iterate_username_many_suffixes(self):
+        User.objects.bulk_create([User(username='Test_Name')] +
+                                 [User(username='Test_Name_%s' % i) for i in range(1, 201)])
+        # the number of queries doesn't grow with the number of suffixed usernames
+        with self.assertNumQueries(3):
+            self.assertEqual(StateBackend.iterate_username("Test Name"), 'Test_Name_201')
+
+    def test_iterate_username_case_insensitive(self):
+        for username in ['test_name', 'TEST_NAME_4']:
+            User.objects.create(username=username)
+        self.assertEqual(StateBackend.iterate_username("Test Name"), 'Test_Name_5')
+        self.assertEqual(StateBackend.iterate_username("Other Name"), 'Other_Name')
+
+    def test_create_user_username_taken(self):
+        t = Token(character_id=self.unclaimed_character.character_id,
+                  character_name=self.unclaimed_character.character_name, character_owner_hash='3')
+        # simulates a concurrent registration claiming the username between allocation and creation
+        with mock.patch.object(StateBackend, 'iterate_username', side_effect=[self.user.username, 'free_name']):
+            user = StateBackend().create_user(t)
+        self.assertEqual(user.username, 'free_name')
+
 
 class CharacterOwnershipTestCase(TestCase):
     @classmethod
@@ -196,6 +266,79 @@ class CharacterOwnershipTestCase(TestCase):
         self.user = User.objects.get(pk=self.user.pk)
         self.assertIsNone(self.user.profile.main_character)
 
+    def test_existing_ownership_unchanged(self):
+        token = Token.objects.create(
+            user=self.user,
+            character_id=self.character.character_id,
+            character_name=self.character.character_name,
+            character_owner_hash='1',
+        )
+        token.pk = None
+        # inserting the token, then one ownership lookup in a savepoint
+        with self.assertNumQueries(4):
+            token.save()
+        self.assertEquals(CharacterOwnership.objects.get(character=self.character).user, self.user)
+
+    @mock.patch('allianceauth.eveonline.managers.EveCharacterManager.create_character')
+    def test_new_character_without_user(self, create_character):
+        Token.objects.create(
+            character_id=2,
+            character_name='New Character',
+            character_owner_hash='2',
+        )
+        # nothing to own the character yet, so it isn't resolved from ESI
+        self.assertFalse(create_character.called)
+        self.assertFalse(CharacterOwnership.objects.filter(owner_hash='2').exists())
+
+    @mock.patch(MODULE_PATH + '.managers.transaction.on_commit', side_effect=lambda func: func())
+    @mock.patch(MODULE_PATH + '.managers.update_characters')
+    @mock.patch('allianceauth.eveonline.managers.EveCharacterManager.create_character')
+    def test_new_character_deferred(self, create_character, update_characters, on_commit):
+        Token.objects.create(
+            user=self.user,
+            character_id=2,
+            character_name='New Character',
+            character_owner_hash='2',
+        )
+        # owned straight away, then resolved from ESI in a task
+        self.assertFalse(create_character.called)
+        update_characters.delay.assert_called_once_with([2])
+        ownership = CharacterOwnership.objects.get(owner_hash='2')
+        self.assertEqual(ownership.user, self.user)
+        self.assertEqual(ownership.character.character_name, 'New Character')
+        self.assertIsNone(ownership.character.last_updated)
+
+    @mock.patch(MODULE_PATH + '.views.messages')
+    @mock.patch('allianceauth.eveonline.managers.providers.provider')
+    @mock.patch(MODULE_PATH + '.managers.update_characters')
+    def test_main_character_change_new_character(self, update_characters, provider, messages):
+        corp = EveCorporationInfo.objects.create(corporation_id=1, corporation_name='Corp', corporation_ticker='CORP',
+                                                 member_count=1)
+        state = AuthUtils.create_state('Test Member', 150, member_corporations=corp)
+        profile = UserProfile.objects.get(user=self.user)
+        profile.main_character = self.character
+        profile.save()
+        self.assertEqual(UserProfile.objects.get(user=self.user).state, state)
+        token = Token.objects.create(
+            user=self.user,
+            character_id=2,
+            character_name='New Character',
+            character_owner_hash='2',
+        )
+        provider.get_character.return_value = Character(id=2, name='New Character', corp_id=1)
+        provider.get_corp.return_value = Corporation(id=1, name='Corp', ticker='CORP')
+
+        request = RequestFactory().get('/test/')
+        request.user = User.objects.get(pk=self.user.pk)
+        # undecorated, as the token is supplied by SSO
+        main_character_change.__wrapped__.__wrapped__(request, token)
+
+        # resolved from ESI before becoming the main, so the user keeps their state
+        profile = UserProfile.objects.get(user=self.user)
+        self.assertEqual(profile.main_character.character_id, 2)
+        self.assertEqual(profile.main_character.corporation_id, 1)
+        self.assertEqual(profile.state, state)
+
 
 class StateTestCase(TestCase):
     @classmethod
@@ -214,6 +357,12 @@ class StateTestCase(TestCase):
             priority=150,
         )
 
+    def setUp(self):
+        # state checks are queued until the transaction commits, which a TestCase never does
+        patcher = mock.patch(MODULE_PATH + '.tasks.transaction.on_commit', side_effect=lambda func: func())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
     def _refresh_user(self):
         self.user = User.objects.get(pk=self.user.pk)
 
@@ -331,6 +480,108 @@ class StateTestCase(TestCase):
         self._refresh_user()
         self.assertEquals(self.user.profile.state, self.member_state)
 
+    def test_assign_to_profiles(self):
+        self.member_state.member_corporations.add(self.test_corporation)
+        users = [AuthUtils.create_user('test_user%s' % i, disconnect_signals=True) for i in range(3)]
+        for i, user in enumerate(users):
+            AuthUtils.add_main_character(user, 'Test Character %s' % i, str(i + 10), corp_id='1', alliance_id='1')
+        # reset them without signals, as if they had been assigned before joining the corp
+        UserProfile.objects.filter(user__in=users).update(state=self.guest_state)
+
+        with mock.patch('allianceauth.authentication.signals.state_changed.send') as send:
+            changed = State.objects.assign_to_profiles(UserProfile.objects.all())
+
+        self.assertEqual(sorted(p.user.pk for p in changed), [u.pk for u in users])
+        self.assertEqual(send.call_count, 3)
+        self.assertEqual(UserProfile.objects.filter(state=self.member_state).count(), 4)
+
+        with mock.patch('allianceauth.authentication.signals.state_changed.send') as send:
+            changed = State.objects.assign_to_profiles(UserProfile.objects.all())
+
+        self.assertEqual(changed, [])
+        self.assertFalse(send.called)
+
+    def test_resolve_for_profiles(self):
+        self.member_state.member_alliances.add(self.test_alliance)
+        profiles = UserProfile.objects.filter(user=self.user)
+
+        # one query for the states, then one per state however many profiles there are
+        with self.assertNumQueries(State.objects.count() + 1):
+            resolved = State.objects.resolve_for_profiles(profiles)
+
+        self.assertEqual(resolved, {self.user.profile.pk: self.member_state.pk})
+
+    def test_get_for_character(self):
+        self.assertEqual(State.objects.get_for_character(self.test_character), self.guest_state)
+        self.member_state.member_corporations.add(self.test_corporation)
+        self.assertEqual(State.objects.get_for_character(self.test_character), self.member_state)
+        higher_state = State.objects.create(name='Higher State', priority=200)
+        higher_state.member_alliances.add(self.test_alliance)
+        self.assertEqual(State.objects.get_for_character(self.test_character), higher_state)
+        higher_state.delete()
+        self.assertEqual(State.objects.get_for_character(self.test_character), self.member_state)
+
+    def test_state_index_reused(self):
+        State.objects.get_for_character(self.test_character)
+
+        with mock.patch.object(StateIndex, 'build', wraps=StateIndex.build) as build:
+            State.objects.get_for_character(self.test_character)
+            self.assertFalse(build.called)
+            self.member_state.member_characters.add(self.test_character)
+            State.objects.get_for_character(self.test_character)
+            self.assertTrue(build.called)
+
+    def test_state_index_member_deleted(self):
+        self.member_state.member_corporations.add(self.test_corporation)
+        self.assertEqual(State.objects.get_for_character(self.test_character), self.member_state)
+
+        self.test_corporation.delete()
+
+        self.assertEqual(State.objects.get_for_character(self.test_character), self.guest_state)
+
+
+class StateCheckTestCase(TestCase):
+    def setUp(self):
+        cache.delete(STATE_CHECK_SCHEDULED_KEY)
+        cache.delete(STATE_CHECK_PROGRESS_KEY)
+
+    def test_schedule_state_check_coalesced(self):
+        with mock.patch.object(check_all_states, 'apply_async') as apply_async:
+            schedule_state_check()
+            schedule_state_check()
+
+        apply_async.assert_called_once_with(countdown=STATE_CHECK_DELAY)
+        self.assertEqual(get_state_check_progress()['status'], 'queued')
+
+    def test_check_all_states(self):
+        user = AuthUtils.create_user('test_user', disconnect_signals=True)
+        AuthUtils.add_main_character(user, 'Test Character', '1', corp_id='1', corp_name='Test Corp')
+        corp = EveCorporationInfo.objects.create(corporation_id='1', corporation_name='Test Corp',
+                                                 corporation_ticker='TEST', member_count=1)
+        state = AuthUtils.create_state('Test Member', 150, member_corporations=corp, disconnect_signals=True)
+        cache.set(STATE_CHECK_SCHEDULED_KEY, True)
+
+        check_all_states()
+
+        self.assertEqual(UserProfile.objects.get(user=user).state, state)
+        self.assertIsNone(cache.get(STATE_CHECK_SCHEDULED_KEY))
+        progress = get_state_check_progress()
+        self.assertEqual(progress['status'], 'finished')
+        self.assertEqual(progress['checked'], progress['total'])
+        self.assertEqual(progress['changed'], 1)
+
+    def test_state_check_stalled(self):
+        started = timezone.now() - timedelta(hours=1)
+        cache.set(STATE_CHECK_PROGRESS_KEY, {'status': 'running', 'started': started, 'updated': started,
+                                             'total': 2000, 'checked': 1000, 'changed': 0}, None)
+
+        # the worker died without finishing
+        self.assertEqual(get_state_check_progress()['status'], 'failed')
+
+        cache.set(STATE_CHECK_PROGRESS_KEY, {'status': 'running', 'started': started, 'updated': timezone.now(),
+                                             'total': 2000, 'checked': 1000, 'changed': 0}, None)
+        self.assertEqual(get_state_check_progress()['status'], 'running')
+
 
 class CharacterOwnershipCheckTestCase(TestCase):
     @classmethod
@@ -375,6 +626,97 @@ class CharacterOwnershipCheckTestCase(TestCase):
         self.assertTrue(filter.return_value.delete.called)
 
 
+@mock.patch(MODULE_PATH + '.tasks.OWNERSHIP_VERIFY_WORKERS', 1)
+@mock.patch(MODULE_PATH + '.tasks.update_token_data_pooled')
+class VerifyCharacterOwnershipsTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = AuthUtils.create_user('test_user', disconnect_signals=True)
+        for i in range(1, 4):
+            character = EveCharacter.objects.create(character_id=i, character_name='Test %s' % i, corporation_id=1,
+                                                    corporation_name='Test Corp', corporation_ticker='TEST')
+            CharacterOwnership.objects.create(user=cls.user, character=character, owner_hash=str(i))
+            Token.objects.create(user=cls.user, character_id=i, character_name='Test %s' % i,
+                                 character_owner_hash=str(i))
+        # verified recently so skipped
+        CharacterOwnership.objects.filter(owner_hash='3').update(last_verified=timezone.now(),
+                                                                 last_verify_attempt=timezone.now())
+
+    def test_verify_character_ownerships(self, update_token_data):
+        def change_hash(token):
+            if token.character_owner_hash == '2':
+                token.character_owner_hash = 'changed'
+        update_token_data.side_effect = change_hash
+
+        stats = verify_character_ownerships()
+
+        self.assertEqual(sorted(args[0].character_owner_hash for args, kwargs in update_token_data.call_args_list),
+                         ['1', 'changed'])
+        self.assertEqual(stats['checked'], 2)
+        self.assertEqual(stats['verified'], 2)
+        self.assertEqual(stats['revoked'], 1)
+        self.assertFalse(CharacterOwnership.objects.filter(owner_hash='2').exists())
+        self.assertIsNotNone(CharacterOwnership.objects.get(owner_hash='1').last_verified)
+
+    def test_sso_unavailable(self, update_token_data):
+        update_token_data.side_effect = IncompleteResponseError()
+
+        stats = verify_character_ownerships(batch_size=1)
+
+        self.assertEqual(stats['checked'], 1)
+        self.assertEqual(stats['failed'], 1)
+        # stops without queueing another batch
+        self.assertEqual(update_token_data.call_count, 1)
+        self.assertEqual(CharacterOwnership.objects.filter(last_verified__isnull=True).count(), 2)
+        failed = CharacterOwnership.objects.get(last_verified__isnull=True, last_verify_attempt__isnull=False)
+
+        # the failure moves to the back of the line so the next run checks another ownership
+        verify_character_ownerships(batch_size=1)
+        self.assertNotEqual(update_token_data.call_args[0][0].character_owner_hash, failed.owner_hash)
+
+
+@mock.patch(MODULE_PATH + '.tasks._sso_sessions', new_callable=threading.local)
+@mock.patch(MODULE_PATH + '.tasks.OAuth2Session')
+class UpdateTokenDataPooledTestCase(TestCase):
+    def setUp(self):
+        self.user = AuthUtils.create_user('test_user', disconnect_signals=True)
+        self.tokens = [Token.objects.create(user=self.user, character_id=i, character_name='Test %s' % i,
+                                            character_owner_hash=str(i), access_token='access %s' % i)
+                       for i in range(1, 3)]
+
+    def test_session_reused(self, oauth_session, sso_sessions):
+        oauth_session.return_value.request.return_value.json.return_value = {
+            'CharacterID': 1, 'CharacterName': 'Test 1', 'CharacterOwnerHash': 'changed', 'TokenType': 'Character'}
+
+        self.assertIs(get_sso_session(), get_sso_session())
+        for token in self.tokens:
+            update_token_data_pooled(token)
+
+        self.assertEqual(oauth_session.call_count, 1)
+        session = oauth_session.return_value
+        self.assertEqual(session.request.call_count, 2)
+        # each token is verified with its own access token
+        self.assertEqual([kwargs['headers']['Authorization'] for args, kwargs in session.request.call_args_list],
+                         ['Bearer access 1', 'Bearer access 2'])
+        self.assertEqual(self.tokens[0].character_owner_hash, 'changed')
+        # without saving
+        self.assertEqual(Token.objects.get(pk=self.tokens[0].pk).character_owner_hash, '1')
+
+    def test_expired(self, oauth_session, sso_sessions):
+        Token.objects.filter(pk=self.tokens[0].pk).update(created=timezone.now() - timedelta(days=1))
+        token = Token.objects.get(pk=self.tokens[0].pk)
+
+        with self.assertRaises(TokenExpiredError):
+            update_token_data_pooled(token)
+        self.assertFalse(oauth_session.return_value.request.called)
+
+        token.refresh_token = 'refresh'
+        with mock.patch.object(Token, 'refresh') as refresh:
+            update_token_data_pooled(token)
+        self.assertIs(refresh.call_args[1]['session'], oauth_session.return_value)
+        self.assertTrue(oauth_session.return_value.request.called)
+
+
 class ManagementCommandTestCase(TestCase):
     @classmethod
     def setUpTestData(cls):
@@ -34,6 +34,8 @@ def main_character_change(request, token):
             messages.error(request, 'Cannot change main character to %(char)s: character owned by a different account.' % ({'char': token.character_name}))
             co = None
     if co:
+        # an alt added moments ago may not have been resolved from ESI yet, and its corp decides the user's state
+        CharacterOwnership.objects.resolve_character(co.character)
         request.user.profile.main_character = co.character
         request.user.profile.save(update_fields=['main_character'])
         messages.success(request, _('Changed main character to %(char)s') % {"char": co.character})
@@ -7,6 +7,7 @@ from django.db import models
 from esi.errors import TokenError
 from esi.models import Token
 from allianceauth.eveonline.models import EveCorporationInfo, EveCharacter
+from allianceauth.eveonline.providers import provider
 from allianceauth.notifications import notify
 
 from allianceauth.corputils.managers import CorpStatsManager
@@ -46,17 +47,24 @@ class CorpStats(models.Model):
     def update(self):
         try:
             c = self.token.get_esi_client(spec_file=SWAGGER_SPEC_PATH)
-            assert c.Character.get_characters_character_id(character_id=self.token.character_id).result()[
-                       'corporation_id'] == int(self.corp.corporation_id)
-            member_ids = c.Corporation.get_corporations_corporation_id_members(
-                corporation_id=self.corp.corporation_id).result()
+            character, member_ids = provider.gather(
+                c.Character.get_characters_character_id(character_id=self.token.character_id).result,
+                c.Corporation.get_corporations_corporation_id_members(corporation_id=self.corp.corporation_id).result,
+                return_exceptions=True,
+            )
+            # leaving corp takes precedence over any failure to list members
+            if isinstance(character, Exception):
+                raise character
+            assert character['corporation_id'] == int(self.corp.corporation_id)
+            if isinstance(member_ids, Exception):
+                raise member_ids
 
             # requesting too many ids per call results in a HTTP400
             # the swagger spec doesn't have a maxItems count
             # manual testing says we can do over 350, but let's not risk it
             member_id_chunks = [member_ids[i:i + 255] for i in range(0, len(member_ids), 255)]
-            member_name_chunks = [c.Character.get_characters_names(character_ids=id_chunk).result() for id_chunk in
-                                  member_id_chunks]
+            member_name_chunks = provider.gather(
+                *[c.Character.get_characters_names(character_ids=id_chunk).result for id_chunk in member_id_chunks])
             member_list = {}
             for name_chunk in member_name_chunks:
                 member_list.update({m['character_id']: m['character_name'] for m in name_chunk})
@@ -104,11 +112,11 @@ class CorpStats(models.Model):
 
     @property
     def registered_member_count(self):
-        return len(self.registered_members)
+        return self.registered_members.count()
 
     @property
     def registered_members(self):
-        return self.members.filter(pk__in=[m.pk for m in self.members.all() if m.registered])
+        return self.members.filter(character_id__in=CharacterOwnership.objects.values('character__character_id'))
 
     @property
     def unregistered_member_count(self):
@@ -116,17 +124,16 @@ class CorpStats(models.Model):
 
     @property
     def unregistered_members(self):
-        return self.members.filter(pk__in=[m.pk for m in self.members.all() if not m.registered])
+        return self.members.exclude(character_id__in=CharacterOwnership.objects.values('character__character_id'))
 
     @property
     def main_count(self):
-        return len(self.mains)
+        return self.mains.count()
 
     @property
     def mains(self):
-        return self.members.filter(pk__in=[m.pk for m in self.members.all() if
-                                           m.main_character and int(m.main_character.character_id) == int(
-                                               m.character_id)])
+        return self.members.filter(character_id__in=EveCharacter.objects.filter(
+            character_ownership__user__profile__main_character=models.F('pk')).values('character_id'))
 
     def visible_to(self, user):
         return CorpStats.objects.filter(pk=self.pk).visible_to(user).exists()
@@ -114,6 +114,8 @@ class EveAllianceInfoAdmin(admin.ModelAdmin):
 class EveCharacterAdmin(admin.ModelAdmin):
     search_fields = ['character_name', 'corporation_name', 'alliance_name', 'character_ownership__user__username']
     list_display = ('character_name', 'corporation_name', 'alliance_name', 'user', 'main_character')
+    # the related corp and alliance may not exist as models, so they can't be chosen from a list
+    readonly_fields = ('corporation', 'alliance')
 
     @staticmethod
     def user(obj):
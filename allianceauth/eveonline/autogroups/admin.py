@@ -1,4 +1,4 @@
-from django.contrib import admin
+from django.contrib import admin, messages
 from django.db import models
 from .models import AutogroupsConfig
 
@@ -14,6 +14,19 @@ def sync_user_groups(modeladmin, request, queryset):
         agc.update_all_states_group_membership()
 
 
+def plan_user_groups(modeladmin, request, queryset):
+    for agc in queryset:
+        plan = agc.plan_group_membership()
+        groups = ', '.join(plan['groups_to_create'][:10])
+        if len(plan['groups_to_create']) > 10:
+            groups += ', ...'
+        messages.info(request, '{0}: {1} groups to create{2}, {3} memberships to add, {4} to remove, '
+                               '{5} users affected, {6} service syncs expected'.format(
+                                   agc, len(plan['groups_to_create']), ' ({0})'.format(groups) if groups else '',
+                                   plan['memberships_to_add'], plan['memberships_to_remove'],
+                                   plan['users_affected'], plan['service_syncs']))
+
+
 class AutogroupsConfigAdmin(admin.ModelAdmin):
     formfield_overrides = {
         models.CharField: {'strip': False}
@@ -33,6 +46,9 @@ class AutogroupsConfigAdmin(admin.ModelAdmin):
         actions['sync_user_groups'] = (sync_user_groups,
                                        'sync_user_groups',
                                        'Sync all users groups for this Autogroup Config')
+        actions['plan_user_groups'] = (plan_user_groups,
+                                       'plan_user_groups',
+                                       'Plan syncing all users groups for this Autogroup Config without syncing')
         return actions
 
 
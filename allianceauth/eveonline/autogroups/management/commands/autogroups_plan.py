@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand
+from allianceauth.eveonline.autogroups.models import AutogroupsConfig
+
+
+class Command(BaseCommand):
+    help = 'Reports the group changes syncing autogroup configs would make, without making them'
+
+    def add_arguments(self, parser):
+        parser.add_argument('config_ids', nargs='*', type=int, help='Configs to plan for, defaults to all')
+        parser.add_argument('--corp-groups', choices=['on', 'off'],
+                            help='Plan as if corp groups were switched on or off')
+        parser.add_argument('--alliance-groups', choices=['on', 'off'],
+                            help='Plan as if alliance groups were switched on or off')
+
+    def handle(self, *args, **options):
+        configs = AutogroupsConfig.objects.all()
+        if options['config_ids']:
+            configs = configs.filter(pk__in=options['config_ids'])
+        toggles = {key: None if options[key] is None else options[key] == 'on'
+                   for key in ('corp_groups', 'alliance_groups')}
+        for config in configs:
+            plan = config.plan_group_membership(**toggles)
+            self.stdout.write(self.style.MIGRATE_HEADING('Config {0} ({1})'.format(config.pk, config)))
+            for line in format_plan(plan):
+                self.stdout.write(line)
+
+
+def format_plan(plan):
+    lines = ['{0} groups to create'.format(len(plan['groups_to_create']))]
+    lines += ['  {0}'.format(name) for name in plan['groups_to_create']]
+    lines += [
+        '{0} memberships to add'.format(plan['memberships_to_add']),
+        '{0} memberships to remove'.format(plan['memberships_to_remove']),
+        '{0} users affected'.format(plan['users_affected']),
+        '{0} service syncs expected'.format(plan['service_syncs']),
+    ]
+    return lines
@@ -1,5 +1,10 @@
 import logging
-from django.db import models, transaction
+import uuid
+from collections import defaultdict
+from django.conf import settings
+from django.core.cache import cache
+from django.db import models, transaction, IntegrityError
+from django.db.models.signals import m2m_changed
 from django.contrib.auth.models import Group, User
 from django.core.exceptions import ObjectDoesNotExist
 
@@ -8,12 +13,117 @@ from allianceauth.eveonline.models import EveCorporationInfo, EveAllianceInfo
 
 logger = logging.getLogger(__name__)
 
+BULK_CHUNK_SIZE = 500
+GROUP_MAP_CACHE_TIMEOUT = getattr(settings, 'AUTOGROUPS_GROUP_MAP_CACHE_TIMEOUT', 60 * 60 * 24)
+GROUP_MAP_VERSION_KEY = 'autogroups_group_map_version'
+
 
 def get_users_for_state(state: State):
-    return User.objects.select_related('profile').prefetch_related('profile__main_character')\
+    return User.objects.select_related('profile__main_character__alliance', 'profile__main_character__corporation')\
             .filter(profile__state_id=state.pk)
 
 
+def get_group_map_cache_key(config_pk):
+    version = cache.get(GROUP_MAP_VERSION_KEY)
+    if version is None:
+        cache.add(GROUP_MAP_VERSION_KEY, uuid.uuid4().hex, None)
+        version = cache.get(GROUP_MAP_VERSION_KEY)
+    return 'autogroups_group_map_{0}_{1}'.format(version, config_pk)
+
+
+def invalidate_group_maps():
+    """
+    Discard the cached group maps of every config, now and again once the current transaction commits
+    """
+    cache.set(GROUP_MAP_VERSION_KEY, uuid.uuid4().hex, None)
+    transaction.on_commit(lambda: cache.set(GROUP_MAP_VERSION_KEY, uuid.uuid4().hex, None))
+
+
+def chunked(items, size=BULK_CHUNK_SIZE):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def diff_group_memberships(users, desired, managed_groups):
+    """
+    Compares the managed group memberships of users with the desired memberships
+    :param users: User queryset to compare
+    :param desired: set of (user pk, group pk) memberships the users should have
+    :param managed_groups: set of group pks the users should only be members of if desired
+    :return: set of (user pk, group pk) memberships to add, dict of membership pk by (user pk, group pk) to remove
+    """
+    membership = User.groups.through
+    current = {}
+    # groups yet to be created are given by name, so can't have members
+    for chunk in chunked(managed_groups | {group_pk for _, group_pk in desired if not isinstance(group_pk, str)}):
+        current.update(((user_pk, group_pk), pk) for pk, user_pk, group_pk in membership.objects.filter(
+            user__in=users.values('pk'), group_id__in=chunk).values_list('pk', 'user_id', 'group_id'))
+    added = desired - set(current)
+    removed = {pair: pk for pair, pk in current.items() if pair[1] in managed_groups and pair not in desired}
+    return added, removed
+
+
+def create_group_memberships(memberships):
+    """
+    Inserts group memberships in bulk, skipping any already added by a concurrent update
+    :param memberships: iterable of (user pk, group pk) memberships to insert
+    :return: list of the memberships inserted
+    """
+    membership = User.groups.through
+    created = []
+    for chunk in chunked(memberships):
+        try:
+            with transaction.atomic():
+                membership.objects.bulk_create([membership(user_id=user_pk, group_id=group_pk)
+                                                for user_pk, group_pk in chunk])
+            created.extend(chunk)
+        except IntegrityError:
+            # fall back to inserting one at a time to find the memberships that already exist
+            for user_pk, group_pk in chunk:
+                try:
+                    with transaction.atomic():
+                        membership.objects.create(user_id=user_pk, group_id=group_pk)
+                    created.append((user_pk, group_pk))
+                except IntegrityError:
+                    logger.debug('User {} was added to group {} concurrently'.format(user_pk, group_pk))
+    return created
+
+
+def apply_group_memberships(users, desired, managed_groups):
+    """
+    Brings the managed group memberships of users in line with the desired memberships in bulk
+    Each changed user is sent a single post_add m2m_changed for all of their additions
+    and a single post_remove for all of their removals, which services sync together once the transaction commits.
+    :param users: User queryset to update
+    :param desired: set of (user pk, group pk) memberships the users should have
+    :param managed_groups: set of group pks the users should only be members of if desired
+    :return: set of pks of the users whose groups changed
+    """
+    membership = User.groups.through
+    added, removed = diff_group_memberships(users, desired, managed_groups)
+
+    added = create_group_memberships(added)
+    for chunk in chunked(removed.values()):
+        membership.objects.filter(pk__in=chunk).delete()
+
+    changes = defaultdict(lambda: (set(), set()))
+    for user_pk, group_pk in added:
+        changes[user_pk][0].add(group_pk)
+    for user_pk, group_pk in removed:
+        changes[user_pk][1].add(group_pk)
+    for chunk in chunked(changes):
+        for user in User.objects.filter(pk__in=chunk):
+            user_added, user_removed = changes[user.pk]
+            logger.debug('Autogroups added {} and removed {} groups for user {}'.format(
+                len(user_added), len(user_removed), user))
+            for action, pk_set in (('post_add', user_added), ('post_remove', user_removed)):
+                if pk_set:
+                    m2m_changed.send(sender=membership, instance=user, action=action, reverse=False, model=Group,
+                                     pk_set=pk_set, using=users.db)
+    return set(changes)
+
+
 class AutogroupsConfigManager(models.Manager):
     def update_groups_for_state(self, state: State):
         """
@@ -24,10 +134,7 @@ class AutogroupsConfigManager(models.Manager):
         """
         users = get_users_for_state(state)
         for config in self.filter(states=state):
-            logger.debug("in state loop")
-            for user in users:
-                logger.debug("in user loop for {}".format(user))
-                config.update_group_membership_for_user(user)
+            config.reconcile_group_membership(users)
 
     def update_groups_for_user(self, user: User, state: State = None):
         """
@@ -41,10 +148,24 @@ class AutogroupsConfigManager(models.Manager):
         for config in self.filter(states=state):
             # grant user new groups for their state
             config.update_group_membership_for_user(user)
-        for config in self.exclude(states=state):
-            # ensure user does not have groups from previous state
-            config.remove_user_from_alliance_groups(user)
-            config.remove_user_from_corp_groups(user)
+        # ensure user does not have groups from previous state
+        self.remove_user_from_managed_groups(user, self.exclude(states=state))
+
+    def remove_user_from_managed_groups(self, user: User, configs=None):
+        """
+        Remove the user from all the corp and alliance Groups managed by the configs at once
+        :param user: User to remove
+        :param configs: AutogroupsConfig queryset, defaults to all configs
+        :return:
+        """
+        if configs is None:
+            configs = self.all()
+        groups = set(user.groups.filter(
+            models.Q(corp_managed_config__in=configs) | models.Q(alliance_managed_config__in=configs)
+        ).values_list('pk', flat=True))
+        if groups:
+            logger.debug('Removing user {} from {} managed groups'.format(user, len(groups)))
+            user.groups.remove(*groups)
 
 
 class AutogroupsConfig(models.Model):
@@ -94,10 +215,148 @@ class AutogroupsConfig(models.Model):
         return 'States: ' + (' '.join(list(self.states.all().values_list('name', flat=True))) if self.pk else str(None))
 
     def update_all_states_group_membership(self):
-        list(map(self.update_group_membership_for_state, self.states.all()))
+        self.reconcile_group_membership(User.objects.filter(profile__state__in=self.states.all()))
 
     def update_group_membership_for_state(self, state: State):
-        list(map(self.update_group_membership_for_user, get_users_for_state(state)))
+        self.reconcile_group_membership(get_users_for_state(state))
+
+    @transaction.atomic
+    def reconcile_group_membership(self, users):
+        """
+        Update the corp and alliance Group memberships of many users at once
+        :param users: User queryset to update for
+        :return: set of pks of the users whose groups changed
+        """
+        desired, managed_groups = self._get_desired_memberships(users, self.corp_groups, self.alliance_groups)
+        return apply_group_memberships(users, desired, managed_groups)
+
+    def plan_group_membership(self, users=None, corp_groups=None, alliance_groups=None) -> dict:
+        """
+        Work out what reconcile_group_membership would change, without changing anything
+        :param users: User queryset to plan for, defaults to the users in this config's states
+        :param corp_groups: plan as if corp groups were enabled or disabled, defaults to the current setting
+        :param alliance_groups: plan as if alliance groups were enabled or disabled, defaults to the current setting
+        :return: dict of the plan's groups to create, membership changes, affected users and service syncs
+        """
+        from allianceauth.services.hooks import ServicesHook
+        if users is None:
+            users = User.objects.filter(profile__state__in=self.states.all())
+        desired, managed_groups = self._get_desired_memberships(
+            users,
+            self.corp_groups if corp_groups is None else corp_groups,
+            self.alliance_groups if alliance_groups is None else alliance_groups,
+            create=False)
+        added, removed = diff_group_memberships(users, desired, managed_groups)
+        affected = {user_pk for user_pk, _ in added} | {user_pk for user_pk, _ in removed}
+        return {
+            'groups_to_create': sorted({group for _, group in desired if isinstance(group, str)}),
+            'memberships_to_add': len(added),
+            'memberships_to_remove': len(removed),
+            'users_affected': len(affected),
+            # however many of their groups change, each affected user is synced once to every service
+            'service_syncs': len(affected) * len(list(ServicesHook.get_services())),
+        }
+
+    def _get_desired_memberships(self, users, corp_groups, alliance_groups, create=True):
+        """
+        :param create: create any missing corp and alliance models and groups, else give groups to create by name
+        :return: set of (user pk, group pk) memberships the users should have, set of managed group pks
+        """
+        entitled = users.filter(profile__state__in=self.states.all(), profile__main_character__isnull=False)
+        desired = set()
+        if corp_groups:
+            rows = list(entitled.values_list('pk', 'profile__main_character__corporation_id'))
+            groups = self._get_corp_groups({corp_id for _, corp_id in rows}, create=create)
+            desired.update((user_pk, groups[corp_id]) for user_pk, corp_id in rows if corp_id in groups)
+        if alliance_groups:
+            rows = list(entitled.filter(profile__main_character__alliance_id__isnull=False).values_list(
+                'pk', 'profile__main_character__alliance_id'))
+            groups = self._get_alliance_groups({alliance_id for _, alliance_id in rows}, create=create)
+            desired.update((user_pk, groups[alliance_id]) for user_pk, alliance_id in rows if alliance_id in groups)
+        managed_groups = set(self.corp_managed_groups.values_list('pk', flat=True))
+        managed_groups.update(self.alliance_managed_groups.values_list('pk', flat=True))
+        return desired, managed_groups
+
+    def get_group_map(self) -> dict:
+        """
+        Map of the managed groups named for the current corp and alliance names, shared through the cache
+        until this config, its managed groups or their corp or alliance names change
+        :return: dict of 'corp' and 'alliance' dicts of Group by EVE ID
+        """
+        key = get_group_map_cache_key(self.pk)
+        group_map = cache.get(key)
+        if group_map is None:
+            group_map = {'corp': {}, 'alliance': {}}
+            for managed in ManagedCorpGroup.objects.filter(config=self).select_related('group', 'corp'):
+                if managed.group.name == self.get_corp_group_name(managed.corp):
+                    group_map['corp'][managed.corp.corporation_id] = managed.group
+            for managed in ManagedAllianceGroup.objects.filter(config=self).select_related('group', 'alliance'):
+                if managed.group.name == self.get_alliance_group_name(managed.alliance):
+                    group_map['alliance'][managed.alliance.alliance_id] = managed.group
+            cache.set(key, group_map, GROUP_MAP_CACHE_TIMEOUT)
+        return group_map
+
+    def _get_corp_groups(self, corp_ids, create=True) -> dict:
+        """
+        :param create: create any missing corp models and groups, else give the names of groups to create
+        :return: dict of group pk or name by corp ID
+        """
+        result = {corp_id: group.pk for corp_id, group in self.get_group_map()['corp'].items() if corp_id in corp_ids}
+        corp_ids = set(corp_ids) - set(result)
+        if not corp_ids:
+            return result
+        corps = {}
+        for chunk in chunked(corp_ids):
+            corps.update((corp.corporation_id, corp) for corp in EveCorporationInfo.objects.filter(
+                corporation_id__in=chunk))
+        missing = set(corp_ids) - set(corps)
+        if missing and not create:
+            result.update((corp_id, '{}<corporation {}>'.format(self.corp_group_prefix, corp_id)) for corp_id in missing)
+        elif missing:
+            logger.debug('Creating {} corporations missing from the database.'.format(len(missing)))
+            corps.update((corp.corporation_id, corp) for corp in EveCorporationInfo.objects.create_corporations(missing))
+        result.update(self._get_groups({corp_id: self.get_corp_group_name(corp) for corp_id, corp in corps.items()},
+                                       (lambda corp_id: self.create_corp_group(corps[corp_id])) if create else None))
+        return result
+
+    def _get_alliance_groups(self, alliance_ids, create=True) -> dict:
+        """
+        :param create: create any missing alliance models and groups, else give the names of groups to create
+        :return: dict of group pk or name by alliance ID
+        """
+        result = {alliance_id: group.pk for alliance_id, group in self.get_group_map()['alliance'].items()
+                  if alliance_id in alliance_ids}
+        alliance_ids = set(alliance_ids) - set(result)
+        if not alliance_ids:
+            return result
+        alliances = {}
+        for chunk in chunked(alliance_ids):
+            alliances.update((alliance.alliance_id, alliance) for alliance in EveAllianceInfo.objects.filter(
+                alliance_id__in=chunk))
+        missing = set(alliance_ids) - set(alliances)
+        if missing and not create:
+            result.update((alliance_id, '{}<alliance {}>'.format(self.alliance_group_prefix, alliance_id))
+                          for alliance_id in missing)
+        elif missing:
+            logger.debug('Creating {} alliances missing from the database.'.format(len(missing)))
+            alliances.update((alliance.alliance_id, alliance) for alliance in
+                             EveAllianceInfo.objects.create_alliances(missing))
+        result.update(self._get_groups(
+            {alliance_id: self.get_alliance_group_name(alliance) for alliance_id, alliance in alliances.items()},
+            (lambda alliance_id: self.create_alliance_group(alliances[alliance_id])) if create else None))
+        return result
+
+    @staticmethod
+    def _get_groups(names: dict, create=None) -> dict:
+        groups = {}
+        for chunk in chunked(set(names.values())):
+            groups.update(Group.objects.filter(name__in=chunk).values_list('name', 'pk'))
+        result = {}
+        for obj_id, name in names.items():
+            if name not in groups:
+                groups[name] = create(obj_id).pk if create is not None else name
+            result[obj_id] = groups[name]
+        return result
 
     @transaction.atomic
     def update_group_membership_for_user(self, user: User):
@@ -118,10 +377,14 @@ class AutogroupsConfig(models.Model):
                 logger.debug('User {} does not have required state for alliance group membership'.format(user))
                 return
             else:
-                alliance = user.profile.main_character.alliance
-                if alliance is None:
+                main_character = user.profile.main_character
+                if not main_character.alliance_id:
                     logger.debug('User {} alliance is None, cannot update group membership'.format(user))
                     return
+                alliance = main_character.alliance
+                if alliance is None:
+                    # a joined alliance missing from the database is cached as None
+                    raise EveAllianceInfo.DoesNotExist
                 group = self.get_alliance_group(alliance)
         except EveAllianceInfo.DoesNotExist:
             logger.debug('User {} main characters alliance does not exist in the database. Creating.'.format(user))
@@ -143,6 +406,8 @@ class AutogroupsConfig(models.Model):
                 logger.debug('User {} does not have required state for corp group membership'.format(user))
             else:
                 corp = user.profile.main_character.corporation
+                if corp is None:
+                    raise EveCorporationInfo.DoesNotExist
                 group = self.get_corp_group(corp)
         except EveCorporationInfo.DoesNotExist:
             logger.debug('User {} main characters corporation does not exist in the database. Creating.'.format(user))
@@ -161,20 +426,26 @@ class AutogroupsConfig(models.Model):
         remove_groups = user.groups.filter(pk__in=self.alliance_managed_groups.all().values_list('pk', flat=True))
         if except_group is not None:
             remove_groups = remove_groups.exclude(pk=except_group.pk)
-        list(map(user.groups.remove, remove_groups))
+        remove_groups = list(remove_groups)
+        if remove_groups:
+            user.groups.remove(*remove_groups)
 
     @transaction.atomic
     def remove_user_from_corp_groups(self, user: User, except_group: Group = None):
         remove_groups = user.groups.filter(pk__in=self.corp_managed_groups.all().values_list('pk', flat=True))
         if except_group is not None:
             remove_groups = remove_groups.exclude(pk=except_group.pk)
-        list(map(user.groups.remove, remove_groups))
+        remove_groups = list(remove_groups)
+        if remove_groups:
+            user.groups.remove(*remove_groups)
 
     def get_alliance_group(self, alliance: EveAllianceInfo) -> Group:
-        return self.create_alliance_group(alliance)
+        group = self.get_group_map()['alliance'].get(int(alliance.alliance_id))
+        return group if group is not None else self.create_alliance_group(alliance)
 
     def get_corp_group(self, corp: EveCorporationInfo) -> Group:
-        return self.create_corp_group(corp)
+        group = self.get_group_map()['corp'].get(int(corp.corporation_id))
+        return group if group is not None else self.create_corp_group(corp)
 
     @transaction.atomic
     def create_alliance_group(self, alliance: EveAllianceInfo) -> Group:
@@ -1,13 +1,21 @@
 import logging
+from django.contrib.auth.models import Group
 from django.dispatch import receiver
-from django.db.models.signals import pre_save, post_save, pre_delete, m2m_changed
+from django.db.models.signals import pre_save, post_save, pre_delete, post_delete, m2m_changed
 from allianceauth.authentication.models import UserProfile, State
-from allianceauth.eveonline.models import EveCharacter
+from allianceauth.authentication.signals import state_changed
+from allianceauth.eveonline.models import EveCharacter, EveCorporationInfo, EveAllianceInfo
 
-from .models import AutogroupsConfig
+from .models import AutogroupsConfig, ManagedCorpGroup, ManagedAllianceGroup, invalidate_group_maps
+from .tasks import queue_groups_update
 
 logger = logging.getLogger(__name__)
 
+# saves only changing other fields can't change which groups a user is entitled to
+# state only saves are left to state_changed, which follows every state assignment
+PROFILE_FIELDS = {'main_character', 'main_character_id'}
+CHARACTER_FIELDS = {'corporation', 'corporation_id', 'alliance', 'alliance_id'}
+
 
 @receiver(pre_save, sender=AutogroupsConfig)
 def pre_save_config(sender, instance, *args, **kwargs):
@@ -42,11 +50,20 @@ def pre_delete_config(sender, instance, *args, **kwargs):
 
 
 @receiver(post_save, sender=UserProfile)
-def check_groups_on_profile_update(sender, instance, created, *args, **kwargs):
+def check_groups_on_profile_update(sender, instance, created, update_fields=None, *args, **kwargs):
     """
     Trigger check when main character or state changes.
     """
-    AutogroupsConfig.objects.update_groups_for_user(instance.user)
+    if update_fields is None or PROFILE_FIELDS.intersection(update_fields):
+        queue_groups_update(instance.user_id)
+
+
+@receiver(state_changed)
+def check_groups_on_state_change(sender, user, state, *args, **kwargs):
+    """
+    Trigger check when states are assigned in bulk, which saves profiles without post_save.
+    """
+    queue_groups_update(user.pk)
 
 
 @receiver(m2m_changed, sender=AutogroupsConfig.states.through)
@@ -66,10 +83,31 @@ def autogroups_states_changed(sender, instance, action, reverse, model, pk_set,
 
 
 @receiver(post_save, sender=EveCharacter)
-def check_groups_on_character_update(sender, instance, created, *args, **kwargs):
-    if not created:
-        try:
-            profile = UserProfile.objects.prefetch_related('user').get(main_character_id=instance.pk)
-            AutogroupsConfig.objects.update_groups_for_user(profile.user)
-        except UserProfile.DoesNotExist:
-            pass
+def check_groups_on_character_update(sender, instance, created, update_fields=None, *args, **kwargs):
+    if not created and (update_fields is None or CHARACTER_FIELDS.intersection(update_fields)):
+        for user_pk in UserProfile.objects.filter(main_character_id=instance.pk).values_list('user_id', flat=True):
+            queue_groups_update(user_pk)
+
+
+@receiver(post_save, sender=AutogroupsConfig)
+@receiver(post_save, sender=Group)
+@receiver(post_save, sender=ManagedCorpGroup)
+@receiver(post_save, sender=ManagedAllianceGroup)
+@receiver(post_delete, sender=ManagedCorpGroup)
+@receiver(post_delete, sender=ManagedAllianceGroup)
+def managed_groups_changed(sender, instance, *args, **kwargs):
+    """
+    Rebuild group maps when a managed group changes, including renaming it, as maps only hold correctly named groups.
+    """
+    invalidate_group_maps()
+
+
+@receiver(post_save, sender=EveCorporationInfo)
+@receiver(post_save, sender=EveAllianceInfo)
+def group_names_changed(sender, instance, created, update_fields=None, *args, **kwargs):
+    """
+    Rebuild group maps when a corp or alliance name or ticker changes, as the names of their groups change with them.
+    """
+    name_fields = {'corporation_name', 'corporation_ticker', 'alliance_name', 'alliance_ticker'}
+    if not created and (update_fields is None or name_fields.intersection(update_fields)):
+        invalidate_group_maps()
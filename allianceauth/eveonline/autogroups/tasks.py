@@ -0,0 +1,58 @@
+import logging
+import threading
+from functools import partial
+
+from celery import shared_task
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import transaction
+
+from .models import AutogroupsConfig
+
+logger = logging.getLogger(__name__)
+
+AUTOGROUPS_ASYNC = getattr(settings, 'AUTOGROUPS_ASYNC', False)  # update groups in a celery task instead of inline
+
+_pending_groups_updates = threading.local()
+
+
+def get_pending_groups_updates():
+    """
+    pks of the users in this thread waiting on an autogroups update when their transaction commits
+    """
+    if not hasattr(_pending_groups_updates, 'user_pks'):
+        _pending_groups_updates.user_pks = set()
+    return _pending_groups_updates.user_pks
+
+
+def queue_groups_update(user_pk):
+    """
+    Update the autogroups of a user once the current transaction commits,
+    however many times they are queued before then.
+    Each call registers its own commit callback, so a rollback discards only the callbacks it should,
+    and the first of a user's callbacks to run updates them.
+    """
+    get_pending_groups_updates().add(user_pk)
+    transaction.on_commit(partial(flush_groups_update, user_pk))
+
+
+def flush_groups_update(user_pk):
+    """
+    Update the autogroups of a queued user, in a celery task if AUTOGROUPS_ASYNC is set
+    :param user_pk: pk of the user to update
+    """
+    pending = get_pending_groups_updates()
+    if user_pk not in pending:
+        # already updated for an earlier change in the same transaction
+        return
+    pending.discard(user_pk)
+    if AUTOGROUPS_ASYNC:
+        update_groups_for_users.delay([user_pk])
+    else:
+        update_groups_for_users([user_pk])
+
+
+@shared_task
+def update_groups_for_users(user_pks):
+    for user in User.objects.filter(pk__in=user_pks).select_related('profile__state'):
+        AutogroupsConfig.objects.update_groups_for_user(user)
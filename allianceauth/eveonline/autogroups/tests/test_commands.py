@@ -0,0 +1,34 @@
+from io import StringIO
+
+from django.core.management import call_command
+from django.test import TestCase
+
+from allianceauth.tests.auth_utils import AuthUtils
+
+from ..models import AutogroupsConfig
+from . import patch
+
+
+class AutogroupsPlanCommandTestCase(TestCase):
+    def setUp(self):
+        self.stdout = StringIO()
+
+    @patch('.models.AutogroupsConfig.plan_group_membership')
+    def test_autogroups_plan(self, plan_group_membership):
+        obj = AutogroupsConfig.objects.create()
+        obj.states.add(AuthUtils.get_member_state())
+        plan_group_membership.return_value = {
+            'groups_to_create': ['Corp corp name'],
+            'memberships_to_add': 3,
+            'memberships_to_remove': 1,
+            'users_affected': 4,
+            'service_syncs': 8,
+        }
+
+        call_command('autogroups_plan', str(obj.pk), '--corp-groups', 'on', stdout=self.stdout)
+
+        plan_group_membership.assert_called_once_with(corp_groups=True, alliance_groups=None)
+        output = self.stdout.getvalue()
+        self.assertIn('Corp corp name', output)
+        self.assertIn('3 memberships to add', output)
+        self.assertIn('8 service syncs expected', output)
@@ -1,5 +1,10 @@
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.db.models.signals import m2m_changed
 from django.test import TestCase
 from allianceauth.tests.auth_utils import AuthUtils
+from allianceauth.eveonline.models import EveCorporationInfo, EveAllianceInfo
 
 from ..models import AutogroupsConfig
 from . import patch
@@ -12,13 +17,13 @@ class AutogroupsConfigManagerTestCase(TestCase):
         obj = AutogroupsConfig.objects.create()
         obj.states.add(member.profile.state)
 
-        with patch('.models.AutogroupsConfig.update_group_membership_for_user') as update_group_membership_for_user:
+        with patch('.models.AutogroupsConfig.reconcile_group_membership') as reconcile_group_membership:
             AutogroupsConfig.objects.update_groups_for_state(member.profile.state)
 
-            self.assertTrue(update_group_membership_for_user.called)
-            self.assertEqual(update_group_membership_for_user.call_count, 1)
-            args, kwargs = update_group_membership_for_user.call_args
-            self.assertEqual(args[0], member)
+            self.assertTrue(reconcile_group_membership.called)
+            self.assertEqual(reconcile_group_membership.call_count, 1)
+            args, kwargs = reconcile_group_membership.call_args
+            self.assertIn(member, args[0])
 
     def test_update_groups_for_user(self):
         member = AuthUtils.create_member('test member')
@@ -34,9 +39,8 @@ class AutogroupsConfigManagerTestCase(TestCase):
             self.assertEqual(args[0], member)
 
     @patch('.models.AutogroupsConfig.update_group_membership_for_user')
-    @patch('.models.AutogroupsConfig.remove_user_from_alliance_groups')
-    @patch('.models.AutogroupsConfig.remove_user_from_corp_groups')
-    def test_update_groups_no_config(self, remove_corp, remove_alliance, update_groups):
+    @patch('.models.AutogroupsConfigManager.remove_user_from_managed_groups')
+    def test_update_groups_no_config(self, remove_groups, update_groups):
         member = AuthUtils.create_member('test member')
         obj = AutogroupsConfig.objects.create()
 
@@ -44,11 +48,35 @@ class AutogroupsConfigManagerTestCase(TestCase):
         AutogroupsConfig.objects.update_groups_for_user(member)
 
         self.assertFalse(update_groups.called)
-        self.assertTrue(remove_alliance.called)
-        self.assertTrue(remove_corp.called)
+        self.assertTrue(remove_groups.called)
+        args, kwargs = remove_groups.call_args
+        self.assertIn(obj, args[1])
 
         # The normal group assignment should occur if there state has a config
         obj.states.add(member.profile.state)
         AutogroupsConfig.objects.update_groups_for_user(member)
 
         self.assertTrue(update_groups.called)
+
+    def test_remove_user_from_managed_groups(self):
+        member = AuthUtils.create_member('test member')
+        obj = AutogroupsConfig.objects.create()
+        corp = EveCorporationInfo.objects.create(corporation_id=2345, corporation_name='corp name',
+                                                 corporation_ticker='TIKK', member_count=10)
+        alliance = EveAllianceInfo.objects.create(alliance_id=3456, alliance_name='alliance name',
+                                                  alliance_ticker='TIKR', executor_corp_id='2345')
+        groups = [obj.create_corp_group(corp), obj.create_alliance_group(alliance)]
+        member.groups.add(*groups)
+
+        receiver = mock.Mock()
+        m2m_changed.connect(receiver, sender=User.groups.through)
+        self.addCleanup(m2m_changed.disconnect, receiver, sender=User.groups.through)
+
+        AutogroupsConfig.objects.remove_user_from_managed_groups(member)
+
+        # a single notification for both groups
+        removals = [kwargs for args, kwargs in receiver.call_args_list if kwargs['action'] == 'post_remove']
+        self.assertEqual(len(removals), 1)
+        self.assertSetEqual(removals[0]['pk_set'], {group.pk for group in groups})
+        for group in groups:
+            self.assertNotIn(group, member.groups.all())
@@ -1,11 +1,14 @@
+from unittest import mock
+
+from django.db.models.signals import m2m_changed
 from django.test import TestCase
-from django.contrib.auth.models import Group
+from django.contrib.auth.models import Group, User
 
 from allianceauth.tests.auth_utils import AuthUtils
 
 from allianceauth.eveonline.models import EveCharacter, EveCorporationInfo, EveAllianceInfo
 
-from ..models import AutogroupsConfig, get_users_for_state
+from ..models import AutogroupsConfig, get_users_for_state, apply_group_memberships, create_group_memberships
 
 
 from . import patch, connect_signals, disconnect_signals
@@ -208,6 +211,105 @@ class AutogroupsConfigTestCase(TestCase):
 
         self.assertNotIn(group, self.member.groups.all())
 
+    def test_reconcile_group_membership(self):
+        obj = AutogroupsConfig.objects.create(corp_groups=True, alliance_groups=True)
+        obj.states.add(AuthUtils.get_member_state())
+        char = EveCharacter.objects.create(
+            character_id='1234',
+            character_name='test character',
+            corporation_id='2345',
+            corporation_name='test corp',
+            corporation_ticker='tickr',
+            alliance_id='3456',
+            alliance_name='alliance name',
+        )
+        self.member.profile.main_character = char
+        self.member.profile.save()
+        other_corp = EveCorporationInfo.objects.create(corporation_id='2346', corporation_name='other corp',
+                                                       corporation_ticker='OTHR', member_count=10)
+        pre_groups = set(self.member.groups.all())
+        stale_group = obj.create_corp_group(other_corp)
+        self.member.groups.add(stale_group)
+
+        svc = mock.Mock()
+        commit_callbacks = []
+
+        # Act
+        with mock.patch('allianceauth.services.signals.ServicesHook') as services_hook, \
+                mock.patch('allianceauth.services.signals.transaction.on_commit', side_effect=commit_callbacks.append):
+            services_hook.get_services.return_value = [svc]
+            changed = obj.reconcile_group_membership(get_users_for_state(self.member.profile.state))
+            for callback in commit_callbacks:
+                callback()
+
+        corp_group = obj.get_corp_group(self.corp)
+        alliance_group = obj.get_alliance_group(self.alliance)
+        self.assertSetEqual(set(self.member.groups.all()), pre_groups | {corp_group, alliance_group})
+        self.assertSetEqual(changed, {self.member.pk})
+        # the user's additions and removals are synced to services together
+        svc.update_groups.assert_called_once_with(self.member)
+
+        # nothing left to change
+        self.assertSetEqual(obj.reconcile_group_membership(get_users_for_state(self.member.profile.state)), set())
+
+    def test_plan_group_membership(self):
+        obj = AutogroupsConfig.objects.create()
+        obj.states.add(AuthUtils.get_member_state())
+        char = EveCharacter.objects.create(
+            character_id='1234',
+            character_name='test character',
+            corporation_id='2345',
+            corporation_name='test corp',
+            corporation_ticker='tickr',
+            alliance_id='3459',
+            alliance_name='alliance name',
+        )
+        self.member.profile.main_character = char
+        self.member.profile.save()
+
+        # Act
+        plan = obj.plan_group_membership(corp_groups=True, alliance_groups=True)
+
+        self.assertListEqual(plan['groups_to_create'], ['Alliance <alliance 3459>', 'Corp corp name'])
+        self.assertEqual(plan['memberships_to_add'], 2)
+        self.assertEqual(plan['memberships_to_remove'], 0)
+        self.assertEqual(plan['users_affected'], 1)
+        # nothing changed
+        self.assertFalse(Group.objects.filter(name='Corp corp name').exists())
+        self.assertFalse(EveAllianceInfo.objects.filter(alliance_id=3459).exists())
+
+    def test_plan_group_membership_service_syncs(self):
+        obj = AutogroupsConfig.objects.create(corp_groups=True)
+        obj.states.add(AuthUtils.get_member_state())
+        char = EveCharacter.objects.create(
+            character_id='1234',
+            character_name='test character',
+            corporation_id='2345',
+            corporation_name='test corp',
+            corporation_ticker='tickr',
+        )
+        self.member.profile.main_character = char
+        self.member.profile.save()
+        other_corp = EveCorporationInfo.objects.create(corporation_id='2346', corporation_name='other corp',
+                                                       corporation_ticker='OTHR', member_count=10)
+        # the user both gains their corp group and loses their old one
+        self.member.groups.add(obj.create_corp_group(other_corp))
+        obj.create_corp_group(self.corp)
+        svcs = [mock.Mock(), mock.Mock()]
+        commit_callbacks = []
+
+        with mock.patch('allianceauth.services.hooks.ServicesHook.get_services', return_value=svcs), \
+                mock.patch('allianceauth.services.signals.transaction.on_commit', side_effect=commit_callbacks.append):
+            plan = obj.plan_group_membership()
+            obj.reconcile_group_membership(get_users_for_state(self.member.profile.state))
+            for callback in commit_callbacks:
+                callback()
+
+        self.assertEqual(plan['memberships_to_add'], 1)
+        self.assertEqual(plan['memberships_to_remove'], 1)
+        self.assertEqual(plan['service_syncs'], 2)
+        self.assertEqual(sum(svc.update_groups.call_count for svc in svcs), plan['service_syncs'])
+
     def test_remove_user_from_alliance_groups(self):
         obj = AutogroupsConfig.objects.create()
         result = obj.get_alliance_group(self.alliance)
@@ -254,6 +356,31 @@ class AutogroupsConfigTestCase(TestCase):
         self.assertEqual(obj.get_corp_group_name(self.corp), group.name)
         self.assertTrue(obj.corp_managed_groups.filter(pk=group.pk).exists())
 
+    def test_get_corp_group_cached(self):
+        obj = AutogroupsConfig.objects.create()
+        group = obj.get_corp_group(self.corp)
+        obj.get_group_map()
+
+        # the cache version and group map
+        with self.assertNumQueries(2):
+            self.assertEqual(obj.get_corp_group(self.corp), group)
+
+        self.corp.corporation_name = 'new corp name'
+        self.corp.save(update_fields=['corporation_name'])
+
+        self.assertEqual(obj.get_corp_group(self.corp).name, 'Corp new corp name')
+
+    def test_get_corp_group_renamed(self):
+        obj = AutogroupsConfig.objects.create()
+        group = obj.get_corp_group(self.corp)
+        obj.get_group_map()
+
+        group.name = 'renamed group'
+        group.save()
+
+        # no longer named for the corp, so replaced by a new group
+        self.assertNotEqual(obj.get_corp_group(self.corp), group)
+
     def test_create_alliance_group(self):
         obj = AutogroupsConfig.objects.create()
         result = obj.create_alliance_group(self.alliance)
@@ -341,3 +468,47 @@ class AutogroupsConfigTestCase(TestCase):
         result = obj._replace_spaces(name)
 
         self.assertEqual(result, 'test*name')
+
+
+class GroupMembershipsTestCase(TestCase):
+    def setUp(self):
+        self.user = AuthUtils.create_user('test user', disconnect_signals=True)
+        self.groups = [Group.objects.create(name='group %s' % i) for i in range(3)]
+
+    def test_apply_group_memberships(self):
+        self.user.groups.add(self.groups[0], self.groups[2])
+        other = AuthUtils.create_user('other user', disconnect_signals=True)
+        receiver = mock.Mock()
+        m2m_changed.connect(receiver, sender=User.groups.through)
+        self.addCleanup(m2m_changed.disconnect, receiver, sender=User.groups.through)
+        svc = mock.Mock()
+        commit_callbacks = []
+
+        with mock.patch('allianceauth.services.signals.ServicesHook') as services_hook, \
+                mock.patch('allianceauth.services.signals.transaction.on_commit', side_effect=commit_callbacks.append):
+            services_hook.get_services.return_value = [svc]
+            changed = apply_group_memberships(
+                User.objects.filter(pk__in=[self.user.pk, other.pk]),
+                {(self.user.pk, self.groups[1].pk), (other.pk, self.groups[1].pk)},
+                {group.pk for group in self.groups[:2]})
+            for callback in commit_callbacks:
+                callback()
+
+        self.assertSetEqual(changed, {self.user.pk, other.pk})
+        self.assertSetEqual(set(self.user.groups.all()), {self.groups[1], self.groups[2]})
+        # one notification for the additions and one for the removals
+        notifications = {kwargs['action']: kwargs['pk_set'] for args, kwargs in receiver.call_args_list
+                         if kwargs['instance'] == self.user}
+        self.assertDictEqual(notifications, {'post_add': {self.groups[1].pk}, 'post_remove': {self.groups[0].pk}})
+        # but each user is synced to services once
+        self.assertListEqual(sorted(args[0].pk for args, kwargs in svc.update_groups.call_args_list),
+                             sorted([self.user.pk, other.pk]))
+
+    def test_create_group_memberships_concurrently_added(self):
+        # added by another update after the memberships were compared
+        self.user.groups.add(self.groups[1])
+
+        created = create_group_memberships([(self.user.pk, group.pk) for group in self.groups])
+
+        self.assertListEqual(created, [(self.user.pk, self.groups[0].pk), (self.user.pk, self.groups[2].pk)])
+        self.assertSetEqual(set(self.user.groups.all()), set(self.groups))
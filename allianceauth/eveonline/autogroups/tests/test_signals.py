@@ -1,6 +1,7 @@
 from django.test import TestCase
 from django.contrib.auth.models import User
 
+from allianceauth.authentication.models import State, UserProfile
 from allianceauth.tests.auth_utils import AuthUtils
 
 from allianceauth.eveonline.models import EveCharacter, EveCorporationInfo, EveAllianceInfo
@@ -49,6 +50,11 @@ class SignalsTestCase(TestCase):
 
         connect_signals()
 
+        # run queued group updates straight away, as test transactions are never committed
+        on_commit = patch('.tasks.transaction.on_commit', side_effect=lambda func: func())
+        on_commit.start()
+        self.addCleanup(on_commit.stop)
+
     @patch('.models.AutogroupsConfigManager.update_groups_for_user')
     def test_check_groups_on_profile_update_state(self, update_groups_for_user):
         # Trigger signal
@@ -99,6 +105,70 @@ class SignalsTestCase(TestCase):
         member = User.objects.get(pk=self.member.pk)
         self.assertEqual(member.profile.state, AuthUtils.get_member_state())
 
+    @patch('.models.AutogroupsConfigManager.update_groups_for_user')
+    def test_check_groups_irrelevant_update(self, update_groups_for_user):
+        self.member.profile.main_character.character_name = 'renamed character'
+        self.member.profile.main_character.save(update_fields=['character_name'])
+
+        self.assertFalse(update_groups_for_user.called)
+
+    @patch('.models.AutogroupsConfigManager.update_groups_for_user')
+    def test_check_groups_coalesced(self, update_groups_for_user):
+        commit_callbacks = []
+        with patch('.tasks.transaction.on_commit', side_effect=commit_callbacks.append):
+            self.member.profile.main_character.corporation_id = '2300'
+            self.member.profile.main_character.save()
+            self.member.profile.save()
+
+        for callback in commit_callbacks:
+            callback()
+
+        self.assertEqual(update_groups_for_user.call_count, 1)
+
+    @patch('.models.AutogroupsConfigManager.update_groups_for_user')
+    def test_check_groups_rolled_back(self, update_groups_for_user):
+        other = AuthUtils.create_member('other user')
+        update_groups_for_user.reset_mock()
+        commit_callbacks = []
+        with patch('.tasks.transaction.on_commit', side_effect=commit_callbacks.append):
+            self.member.profile.save()
+            # rolling back discards the commit callbacks registered in the transaction
+            commit_callbacks.clear()
+
+            # the rolled back user isn't updated along with users queued later
+            other.profile.save()
+            for callback in commit_callbacks:
+                callback()
+            self.assertEqual(update_groups_for_user.call_count, 1)
+            self.assertEqual(update_groups_for_user.call_args[0][0], other)
+
+            # but is when queued again
+            commit_callbacks.clear()
+            self.member.profile.save()
+            for callback in commit_callbacks:
+                callback()
+
+        self.assertEqual(update_groups_for_user.call_count, 2)
+        self.assertEqual(update_groups_for_user.call_args[0][0], self.member)
+
+    @patch('.tasks.AUTOGROUPS_ASYNC', True)
+    @patch('.tasks.update_groups_for_users.delay')
+    def test_check_groups_async(self, delay):
+        self.member.profile.save()
+
+        delay.assert_called_once_with([self.member.pk])
+
+    def test_check_groups_on_bulk_state_assignment(self):
+        obj = AutogroupsConfig.objects.create(corp_groups=True)
+        obj.states.add(AuthUtils.get_member_state())
+        UserProfile.objects.filter(pk=self.member.profile.pk).update(state=AuthUtils.get_guest_state())
+
+        State.objects.assign_to_profiles(UserProfile.objects.filter(pk=self.member.profile.pk))
+
+        member = User.objects.get(pk=self.member.pk)
+        self.assertEqual(member.profile.state, AuthUtils.get_member_state())
+        self.assertIn(obj.get_corp_group(self.corp), member.groups.all())
+
     @patch('.models.AutogroupsConfig.delete_corp_managed_groups')
     @patch('.models.AutogroupsConfig.delete_alliance_managed_groups')
     def test_pre_save_config_deletes_alliance_groups(self, delete_alliance_managed_groups, delete_corp_managed_groups):
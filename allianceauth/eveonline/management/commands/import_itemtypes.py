@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+from allianceauth.eveonline.models import EveItemType
+
+
+class Command(BaseCommand):
+    help = 'Imports the names of all item types from ESI so they can be looked up locally'
+
+    def handle(self, *args, **options):
+        self.stdout.write('Importing item types. This may take a few minutes.')
+        created = EveItemType.objects.import_itemtypes()
+        self.stdout.write(self.style.SUCCESS('Imported {0} item types.'.format(len(created))))
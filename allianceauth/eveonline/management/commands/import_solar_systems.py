@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+from allianceauth.eveonline.models import EveLocation
+
+
+class Command(BaseCommand):
+    help = 'Imports the names of all solar systems from ESI so they can be looked up locally'
+
+    def handle(self, *args, **options):
+        self.stdout.write('Importing solar systems. This may take a minute.')
+        created = EveLocation.objects.import_solar_systems()
+        self.stdout.write(self.style.SUCCESS('Imported {0} solar systems.'.format(len(created))))
@@ -1,37 +1,109 @@
 import logging
+from datetime import timedelta
 
+from django.conf import settings
 from django.db import models
+from django.db.models import F, Q
+from django.utils import timezone
 from . import providers
 
 logger = logging.getLogger(__name__)
 
+STRUCTURE_NAME_TTL = getattr(settings, 'EVEONLINE_STRUCTURE_NAME_TTL', 60 * 60 * 24)  # seconds before refetching
+
+
+class RefreshPriorityMixin:
+    """
+    Picks the records most in need of a refresh from the provider: those relevant to access decisions first,
+    then the least recently updated.
+    """
+    PRIORITY_NORMAL = 0
+    PRIORITY_HIGH = 1
+
+    def relevant_filter(self) -> Q:
+        """
+        :return: filter matching the records which are given high priority
+        """
+        raise NotImplementedError()
+
+    def update_priorities(self):
+        relevant = self.relevant_filter()
+        self.filter(relevant).exclude(priority=self.PRIORITY_HIGH).update(priority=self.PRIORITY_HIGH)
+        self.exclude(relevant).exclude(priority=self.PRIORITY_NORMAL).update(priority=self.PRIORITY_NORMAL)
+
+    def stale(self, limit, min_age):
+        """
+        :param limit: maximum number of records to return
+        :param min_age: seconds since their last update before records are considered stale
+        :return: queryset of the highest priority, least recently updated stale records
+        """
+        cutoff = timezone.now() - timedelta(seconds=min_age)
+        return self.filter(Q(last_updated__isnull=True) | Q(last_updated__lt=cutoff)).order_by(
+            '-priority', F('last_updated').asc(nulls_first=True))[:limit]
+
 
 class EveCharacterProviderManager:
-    def get_character(self, character_id) -> providers.Character:
-        return providers.provider.get_character(character_id)
+    def get_character(self, character_id, conditional=False) -> providers.Character:
+        return providers.provider.get_character(character_id, conditional=conditional)
 
+    def store_etag(self, character: providers.Character):
+        providers.provider.store_etag('character', character)
 
-class EveCharacterManager(models.Manager):
+    def get_characters(self, character_ids) -> dict:
+        return providers.provider.get_characters(character_ids)
+
+
+class EveCharacterManager(RefreshPriorityMixin, models.Manager):
     provider = EveCharacterProviderManager()
 
+    def relevant_filter(self):
+        # main characters, and characters given a state directly
+        return Q(userprofile__isnull=False) | Q(state__isnull=False)
+
     def create_character(self, character_id):
         return self.create_character_obj(self.provider.get_character(character_id))
 
     def create_character_obj(self, character: providers.Character):
-        return self.create(
-            character_id=character.id,
-            character_name=character.name,
-            corporation_id=character.corp.id,
-            corporation_name=character.corp.name,
-            corporation_ticker=character.corp.ticker,
-            alliance_id=character.alliance.id,
-            alliance_name=character.alliance.name,
-            alliance_ticker=getattr(character.alliance, 'ticker', None),
-        )
+        return self.create(**self._character_fields(character))
+
+    def create_characters(self, character_ids):
+        """
+        Create models for all of the given characters which don't already exist,
+        resolving them from the provider in bulk
+        :param character_ids: iterable of character IDs
+        :return: list of created EveCharacter models
+        """
+        character_ids = list(character_ids)
+        existing = set(self.filter(character_id__in=character_ids).values_list('character_id', flat=True))
+        characters = self.provider.get_characters([c_id for c_id in character_ids if int(c_id) not in existing])
+        return self.bulk_create([self.model(**self._character_fields(c)) for c in characters.values()])
+
+    @staticmethod
+    def _character_fields(character: providers.Character):
+        return {
+            'character_id': character.id,
+            'character_name': character.name,
+            'corporation_id': character.corp.id,
+            'corporation_name': character.corp.name,
+            'corporation_ticker': character.corp.ticker,
+            'alliance_id': character.alliance.id,
+            'alliance_name': character.alliance.name,
+            'alliance_ticker': getattr(character.alliance, 'ticker', None),
+        }
 
     def update_character(self, character_id):
         return self.get(character_id=character_id).update_character()
 
+    def update_characters(self, character_ids):
+        """
+        Update models for the given characters, resolving them from the provider in bulk
+        :param character_ids: iterable of character IDs
+        :return: list of updated EveCharacter models
+        """
+        characters = self.provider.get_characters(character_ids)
+        return [model.update_character(characters[model.character_id]) for model in
+                self.filter(character_id__in=list(characters))]
+
     def get_character_by_id(self, char_id):
         if self.filter(character_id=char_id).exists():
             return self.get(character_id=char_id)
@@ -39,18 +111,48 @@ class EveCharacterManager(models.Manager):
 
 
 class EveAllianceProviderManager:
-    def get_alliance(self, alliance_id) -> providers.Alliance:
-        return providers.provider.get_alliance(alliance_id)
+    def get_alliance(self, alliance_id, conditional=False) -> providers.Alliance:
+        return providers.provider.get_alliance(alliance_id, conditional=conditional)
+
+    def store_etag(self, alliance: providers.Alliance):
+        providers.provider.store_etag('alliance', alliance)
 
+    def get_alliances(self, alliance_ids, conditional=False) -> dict:
+        return providers.provider.get_alliances(alliance_ids, conditional=conditional)
 
-class EveAllianceManager(models.Manager):
+
+class EveAllianceManager(RefreshPriorityMixin, models.Manager):
     provider = EveAllianceProviderManager()
 
+    def relevant_filter(self):
+        # alliances given a state, and alliances of main characters
+        from .models import EveCharacter
+        mains = EveCharacter.objects.filter(userprofile__isnull=False, alliance_id__isnull=False)
+        return Q(state__isnull=False) | Q(alliance_id__in=mains.values('alliance_id'))
+
     def create_alliance(self, alliance_id):
-        obj = self.create_alliance_obj(self.provider.get_alliance(alliance_id))
-        obj.populate_alliance()
+        alliance = self.provider.get_alliance(alliance_id)
+        obj = self.create_alliance_obj(alliance)
+        obj.populate_alliance(alliance)
         return obj
 
+    def create_alliances(self, alliance_ids):
+        """
+        Create and populate models for all of the given alliances which don't already exist,
+        resolving them from the provider in bulk
+        :param alliance_ids: iterable of alliance IDs
+        :return: list of created EveAllianceInfo models
+        """
+        alliance_ids = list(alliance_ids)
+        existing = set(self.filter(alliance_id__in=alliance_ids).values_list('alliance_id', flat=True))
+        alliances = self.provider.get_alliances([a_id for a_id in alliance_ids if int(a_id) not in existing])
+        created = []
+        for alliance in alliances.values():
+            obj = self.create_alliance_obj(alliance)
+            obj.populate_alliance(alliance)
+            created.append(obj)
+        return created
+
     def create_alliance_obj(self, alliance: providers.Alliance):
         return self.create(
             alliance_id=alliance.id,
@@ -62,15 +164,37 @@ class EveAllianceManager(models.Manager):
     def update_alliance(self, alliance_id):
         return self.get(alliance_id=alliance_id).update_alliance()
 
+    def update_alliances(self, alliance_ids):
+        """
+        Update models for the given alliances, resolving them from the provider in bulk
+        :param alliance_ids: iterable of alliance IDs
+        :return: list of updated EveAllianceInfo models
+        """
+        alliances = self.provider.get_alliances(alliance_ids)
+        return [model.update_alliance(alliances[model.alliance_id]) for model in
+                self.filter(alliance_id__in=list(alliances))]
+
 
 class EveCorporationProviderManager:
-    def get_corporation(self, corp_id) -> providers.Corporation:
-        return providers.provider.get_corp(corp_id)
+    def get_corporation(self, corp_id, conditional=False) -> providers.Corporation:
+        return providers.provider.get_corp(corp_id, conditional=conditional)
+
+    def store_etag(self, corp: providers.Corporation):
+        providers.provider.store_etag('corporation', corp)
+
+    def get_corporations(self, corp_ids, conditional=False) -> dict:
+        return providers.provider.get_corps(corp_ids, conditional=conditional)
 
 
-class EveCorporationManager(models.Manager):
+class EveCorporationManager(RefreshPriorityMixin, models.Manager):
     provider = EveCorporationProviderManager()
 
+    def relevant_filter(self):
+        # corporations given a state, and corporations of main characters
+        from .models import EveCharacter
+        mains = EveCharacter.objects.filter(userprofile__isnull=False)
+        return Q(state__isnull=False) | Q(corporation_id__in=mains.values('corporation_id'))
+
     def create_corporation(self, corp_id):
         return self.create_corporation_obj(self.provider.get_corporation(corp_id))
 
@@ -88,5 +212,158 @@ class EveCorporationManager(models.Manager):
             alliance=alliance,
         )
 
+    def create_corporations(self, corp_ids):
+        """
+        Create models for all of the given corporations which don't already exist,
+        resolving them from the provider in bulk
+        :param corp_ids: iterable of corporation IDs
+        :return: list of created EveCorporationInfo models
+        """
+        from .models import EveAllianceInfo
+        corp_ids = list(corp_ids)
+        existing = set(self.filter(corporation_id__in=corp_ids).values_list('corporation_id', flat=True))
+        corps = self.provider.get_corporations([c_id for c_id in corp_ids if int(c_id) not in existing])
+        alliances = {a.alliance_id: a for a in EveAllianceInfo.objects.filter(
+            alliance_id__in=[c.alliance_id for c in corps.values() if c.alliance_id])}
+        return self.bulk_create([self.model(
+            corporation_id=corp.id,
+            corporation_name=corp.name,
+            corporation_ticker=corp.ticker,
+            member_count=corp.members,
+            alliance=alliances.get(corp.alliance_id),
+        ) for corp in corps.values()])
+
     def update_corporation(self, corp_id):
-        return self.get(corporation_id=corp_id).update_corporation(self.provider.get_corporation(corp_id))
+        return self.get(corporation_id=corp_id).update_corporation()
+
+    def update_corporations(self, corp_ids, conditional=False):
+        """
+        Update models for the given corporations, resolving them from the provider in bulk
+        :param corp_ids: iterable of corporation IDs
+        :param conditional: only update corporations changed since their ETag was stored, marking the rest as updated
+        :return: list of updated EveCorporationInfo models
+        """
+        corp_ids = list(corp_ids)
+        corps = self.provider.get_corporations(corp_ids, conditional=conditional)
+        updated = [model.update_corporation(corps[model.corporation_id]) for model in
+                   self.filter(corporation_id__in=list(corps))]
+        if conditional:
+            self.filter(corporation_id__in=corp_ids).exclude(corporation_id__in=list(corps)).update(
+                last_updated=timezone.now())
+        return updated
+
+
+class EveItemTypeProviderManager:
+    def get_itemtype(self, type_id) -> providers.ItemType:
+        return providers.provider.get_itemtype(type_id)
+
+    def get_itemtypes(self, type_ids) -> dict:
+        return providers.provider.get_itemtypes(type_ids)
+
+    def get_itemtype_ids(self) -> list:
+        return providers.provider.get_itemtype_ids()
+
+
+class EveItemTypeManager(models.Manager):
+    provider = EveItemTypeProviderManager()
+
+    # item type names by ID, shared by every lookup in this process
+    _names = providers.EntityCache(use_django_cache=False)
+
+    def get_type_name(self, type_id) -> str:
+        """
+        Looks up an item type name from the in-process cache, then the database,
+        and only fetches it from the provider if it has never been seen before
+        :raises: providers.ObjectNotFound
+        """
+        type_id = int(type_id)
+        name = self._names.get('itemtype', type_id)
+        if name is not None:
+            return name
+        try:
+            name = self.filter(type_id=type_id).values_list('type_name', flat=True).get()
+        except self.model.DoesNotExist:
+            itemtype = self.provider.get_itemtype(type_id)
+            name = self.get_or_create(type_id=type_id, defaults={'type_name': itemtype.name})[0].type_name
+        self._names.set('itemtype', type_id, name)
+        return name
+
+    def import_itemtypes(self, type_ids=None):
+        """
+        Stores the names of the given item types which aren't already stored, resolving them from the provider in bulk
+        :param type_ids: iterable of item type IDs, or None to import every item type
+        :return: list of created EveItemType models
+        """
+        if type_ids is None:
+            type_ids = self.provider.get_itemtype_ids()
+        existing = set(self.values_list('type_id', flat=True))
+        itemtypes = self.provider.get_itemtypes([t_id for t_id in type_ids if int(t_id) not in existing])
+        return self.bulk_create([self.model(type_id=t.id, type_name=t.name) for t in itemtypes.values()],
+                                batch_size=500)
+
+
+class EveLocationProviderManager:
+    def get_names(self, location_ids) -> dict:
+        return providers.provider.get_names(location_ids)
+
+    def get_solar_system_ids(self) -> list:
+        return providers.provider.get_solar_system_ids()
+
+
+class EveLocationManager(models.Manager):
+    provider = EveLocationProviderManager()
+
+    # location names by ID, shared by every lookup in this process
+    _names = providers.EntityCache(use_django_cache=False)
+
+    def get_location_name(self, location_id, location_type, fetch=None) -> str:
+        """
+        Looks up a location name from the in-process cache, then the database,
+        and only fetches it if it has never been seen before.
+        Structures can be renamed, so their names are fetched again once stored for EVEONLINE_STRUCTURE_NAME_TTL seconds.
+        :param location_type: one of the model's location types
+        :param fetch: callable returning the name, required for structures as their names are not public
+        :raises: providers.ObjectNotFound
+        """
+        location_id = int(location_id)
+        name = self._names.get('location', location_id)
+        if name is not None:
+            return name
+        location = self.filter(location_id=location_id).first()
+        if location is None:
+            if fetch is None:
+                try:
+                    name = self.provider.get_names([location_id])[location_id].name
+                except KeyError:
+                    raise providers.ObjectNotFound(location_id, location_type)
+            else:
+                name = fetch()
+            location = self.get_or_create(location_id=location_id, defaults={
+                'location_name': name, 'location_type': location_type})[0]
+        name = location.location_name
+        ttl = None
+        if location.location_type == self.model.STRUCTURE:
+            ttl = STRUCTURE_NAME_TTL - (timezone.now() - location.last_updated).total_seconds()
+            if ttl <= 0 and fetch is not None:
+                try:
+                    name = fetch()
+                except Exception:
+                    # keep the stored name, and try again on the next lookup
+                    logger.warning('Unable to refresh name of structure {0}'.format(location_id), exc_info=True)
+                else:
+                    self.filter(pk=location.pk).update(location_name=name, last_updated=timezone.now())
+                    ttl = STRUCTURE_NAME_TTL
+        self._names.set('location', location_id, name, ttl)
+        return name
+
+    def import_solar_systems(self):
+        """
+        Stores the names of all solar systems which aren't already stored, resolving them from the provider in bulk
+        :return: list of created EveLocation models
+        """
+        existing = set(self.filter(location_type=self.model.SOLAR_SYSTEM).values_list('location_id', flat=True))
+        names = self.provider.get_names(
+            [s_id for s_id in self.provider.get_solar_system_ids() if s_id not in existing])
+        return self.bulk_create([self.model(location_id=n.id, location_name=n.name,
+                                            location_type=self.model.SOLAR_SYSTEM) for n in names.values()],
+                                batch_size=500)
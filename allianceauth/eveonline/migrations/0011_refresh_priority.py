@@ -0,0 +1,60 @@
+# Generated by Django 2.0.13 on 2026-10-18 09:12
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('eveonline', '0010_alliance_ticker'),
+    ]
+
+    # existing records are added without a last_updated time so they are the first to be refreshed
+    operations = [
+        migrations.AddField(
+            model_name='eveallianceinfo',
+            name='last_updated',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='eveallianceinfo',
+            name='last_updated',
+            field=models.DateTimeField(blank=True, db_index=True, default=django.utils.timezone.now, null=True),
+        ),
+        migrations.AddField(
+            model_name='eveallianceinfo',
+            name='priority',
+            field=models.PositiveSmallIntegerField(default=0, help_text='Higher priority alliances are refreshed first.'),
+        ),
+        migrations.AddField(
+            model_name='evecorporationinfo',
+            name='last_updated',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='evecorporationinfo',
+            name='last_updated',
+            field=models.DateTimeField(blank=True, db_index=True, default=django.utils.timezone.now, null=True),
+        ),
+        migrations.AddField(
+            model_name='evecorporationinfo',
+            name='priority',
+            field=models.PositiveSmallIntegerField(default=0, help_text='Higher priority corporations are refreshed first.'),
+        ),
+        migrations.AddField(
+            model_name='evecharacter',
+            name='last_updated',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='evecharacter',
+            name='last_updated',
+            field=models.DateTimeField(blank=True, db_index=True, default=django.utils.timezone.now, null=True),
+        ),
+        migrations.AddField(
+            model_name='evecharacter',
+            name='priority',
+            field=models.PositiveSmallIntegerField(default=0, help_text='Higher priority characters are refreshed first.'),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 2.0.13 on 2026-10-18 08:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('eveonline', '0011_refresh_priority'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EveItemType',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('type_id', models.PositiveIntegerField(unique=True)),
+                ('type_name', models.CharField(max_length=254)),
+            ],
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 2.0.13 on 2026-10-18 08:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('eveonline', '0012_itemtype'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EveLocation',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('location_id', models.BigIntegerField(unique=True)),
+                ('location_name', models.CharField(max_length=254)),
+                ('location_type', models.CharField(choices=[('solar_system', 'Solar System'), ('station', 'Station'), ('structure', 'Structure')], max_length=20)),
+            ],
+        ),
+    ]
@@ -0,0 +1,47 @@
+# Generated by Django 2.0.13 on 2026-10-18 08:19
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def blank_alliance_to_null(apps, schema_editor):
+    EveCharacter = apps.get_model('eveonline', 'EveCharacter')
+    EveCharacter.objects.filter(alliance_id='').update(alliance_id=None)
+
+
+def null_alliance_to_blank(apps, schema_editor):
+    pass
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('eveonline', '0013_location'),
+    ]
+
+    # the relations reuse the existing corporation_id and alliance_id columns, so only the model state changes
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.RemoveField(
+                    model_name='evecharacter',
+                    name='alliance_id',
+                ),
+                migrations.RemoveField(
+                    model_name='evecharacter',
+                    name='corporation_id',
+                ),
+                migrations.AddField(
+                    model_name='evecharacter',
+                    name='alliance',
+                    field=models.ForeignKey(blank=True, db_constraint=False, db_index=False, default=None, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='characters', to='eveonline.EveAllianceInfo', to_field='alliance_id'),
+                ),
+                migrations.AddField(
+                    model_name='evecharacter',
+                    name='corporation',
+                    field=models.ForeignKey(db_constraint=False, db_index=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='characters', to='eveonline.EveCorporationInfo', to_field='corporation_id'),
+                ),
+            ],
+        ),
+        migrations.RunPython(blank_alliance_to_null, null_alliance_to_blank),
+    ]
@@ -0,0 +1,86 @@
+# Generated by Django 2.0.13 on 2026-10-18 08:41
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('eveonline', '0014_character_relations'),
+    ]
+
+    # The character's corporation and alliance columns don't follow their targets' type change, so they are
+    # briefly plain fields while all the ID columns are converted, then become relations again.
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.RemoveField(
+                    model_name='evecharacter',
+                    name='alliance',
+                ),
+                migrations.RemoveField(
+                    model_name='evecharacter',
+                    name='corporation',
+                ),
+                migrations.AddField(
+                    model_name='evecharacter',
+                    name='alliance_id',
+                    field=models.CharField(blank=True, default=None, max_length=254, null=True),
+                ),
+                migrations.AddField(
+                    model_name='evecharacter',
+                    name='corporation_id',
+                    field=models.CharField(max_length=254),
+                    preserve_default=False,
+                ),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='evecharacter',
+            name='alliance_id',
+            field=models.BigIntegerField(blank=True, db_index=True, default=None, null=True),
+        ),
+        migrations.AlterField(
+            model_name='evecharacter',
+            name='corporation_id',
+            field=models.BigIntegerField(db_index=True),
+        ),
+        migrations.AlterField(
+            model_name='evecharacter',
+            name='character_id',
+            field=models.BigIntegerField(unique=True),
+        ),
+        migrations.AlterField(
+            model_name='evecorporationinfo',
+            name='corporation_id',
+            field=models.BigIntegerField(unique=True),
+        ),
+        migrations.AlterField(
+            model_name='eveallianceinfo',
+            name='alliance_id',
+            field=models.BigIntegerField(unique=True),
+        ),
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.RemoveField(
+                    model_name='evecharacter',
+                    name='alliance_id',
+                ),
+                migrations.RemoveField(
+                    model_name='evecharacter',
+                    name='corporation_id',
+                ),
+                migrations.AddField(
+                    model_name='evecharacter',
+                    name='alliance',
+                    field=models.ForeignKey(blank=True, db_constraint=False, default=None, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='characters', to='eveonline.EveAllianceInfo', to_field='alliance_id'),
+                ),
+                migrations.AddField(
+                    model_name='evecharacter',
+                    name='corporation',
+                    field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='characters', to='eveonline.EveCorporationInfo', to_field='corporation_id'),
+                ),
+            ],
+        ),
+    ]
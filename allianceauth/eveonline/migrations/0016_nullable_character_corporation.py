@@ -0,0 +1,19 @@
+# Generated by Django 2.0.13 on 2026-10-18 09:03
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('eveonline', '0015_integer_ids'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='evecharacter',
+            name='corporation',
+            field=models.ForeignKey(db_constraint=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='characters', to='eveonline.EveCorporationInfo', to_field='corporation_id'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 2.0.13 on 2026-10-18 09:16
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('eveonline', '0016_nullable_character_corporation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='evelocation',
+            name='last_updated',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
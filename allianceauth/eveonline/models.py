@@ -1,35 +1,92 @@
+import logging
+
 from django.db import models
-from typing import Union
+from django.utils import timezone
 
 from .managers import EveCharacterManager, EveCharacterProviderManager
 from .managers import EveCorporationManager, EveCorporationProviderManager
 from .managers import EveAllianceManager, EveAllianceProviderManager
+from .managers import EveItemTypeManager, EveItemTypeProviderManager
+from .managers import EveLocationManager, EveLocationProviderManager
 from . import providers
 
+logger = logging.getLogger(__name__)
+
+
+def save_changed_fields(instance: models.Model, **values):
+    """
+    Sets the given field values on a model instance and saves only those which differ from the current values.
+    Nothing is saved if no values differ, only last_updated is bumped without sending signals.
+    :return: list of changed field names, also kept as instance.changed_fields
+    """
+    changed = []
+    for name, value in values.items():
+        field = instance._meta.get_field(name)
+        if field.is_relation and name != field.attname:
+            current = getattr(instance, field.attname)
+            new = value.pk if value is not None else None
+        elif field.is_relation:
+            # raw value of a foreign key
+            current = field.target_field.to_python(getattr(instance, name))
+            value = new = field.target_field.to_python(value)
+        else:
+            current = field.to_python(getattr(instance, name))
+            value = new = field.to_python(value)
+        if current != new:
+            setattr(instance, name, value)
+            if field.is_relation and field.is_cached(instance):
+                field.delete_cached_value(instance)
+            changed.append(name)
+    if changed:
+        logger.debug('Updating fields {0} of {1}'.format(', '.join(changed), instance))
+        instance.last_updated = timezone.now()
+        instance.save(update_fields=changed + ['last_updated'])
+    else:
+        mark_updated(instance)
+    instance.changed_fields = changed
+    return changed
+
+
+def mark_updated(instance: models.Model):
+    """
+    Records that a model instance has been checked against the provider without saving it
+    """
+    instance.last_updated = timezone.now()
+    type(instance).objects.filter(pk=instance.pk).update(last_updated=instance.last_updated)
+
 
 class EveAllianceInfo(models.Model):
-    alliance_id = models.CharField(max_length=254, unique=True)
+    alliance_id = models.BigIntegerField(unique=True)
     alliance_name = models.CharField(max_length=254, unique=True)
     alliance_ticker = models.CharField(max_length=254)
     executor_corp_id = models.CharField(max_length=254)
+    last_updated = models.DateTimeField(null=True, blank=True, default=timezone.now, db_index=True)
+    priority = models.PositiveSmallIntegerField(default=0, help_text="Higher priority alliances are refreshed first.")
 
     objects = EveAllianceManager()
     provider = EveAllianceProviderManager()
 
-    def populate_alliance(self):
-        alliance = self.provider.get_alliance(self.alliance_id)
-        for corp_id in alliance.corp_ids:
-            if not EveCorporationInfo.objects.filter(corporation_id=corp_id).exists():
-                EveCorporationInfo.objects.create_corporation(corp_id)
-        EveCorporationInfo.objects.filter(corporation_id__in=alliance.corp_ids).update(alliance=self)
+    def populate_alliance(self, alliance: providers.Alliance = None):
+        if alliance is None:
+            alliance = self.provider.get_alliance(self.alliance_id)
+        EveCorporationInfo.objects.create_corporations(alliance.corp_ids)
+        EveCorporationInfo.objects.filter(corporation_id__in=alliance.corp_ids).exclude(alliance=self).update(
+            alliance=self)
         EveCorporationInfo.objects.filter(alliance=self).exclude(corporation_id__in=alliance.corp_ids).update(
             alliance=None)
+        # the alliance ETag covers its corporation list, so it is only current once that has been saved
+        self.provider.store_etag(alliance)
 
     def update_alliance(self, alliance: providers.Alliance = None):
         if alliance is None:
-            alliance = self.provider.get_alliance(self.alliance_id)
-        self.executor_corp_id = alliance.executor_corp_id
-        self.save()
+            try:
+                alliance = self.provider.get_alliance(self.alliance_id, conditional=True)
+            except providers.ObjectNotModified as e:
+                logger.debug(e)
+                mark_updated(self)
+                self.changed_fields = []
+                return self
+        save_changed_fields(self, executor_corp_id=alliance.executor_corp_id)
         return self
 
     def __str__(self):
@@ -46,24 +103,32 @@ class EveAllianceInfo(models.Model):
 
 
 class EveCorporationInfo(models.Model):
-    corporation_id = models.CharField(max_length=254, unique=True)
+    corporation_id = models.BigIntegerField(unique=True)
     corporation_name = models.CharField(max_length=254, unique=True)
     corporation_ticker = models.CharField(max_length=254)
     member_count = models.IntegerField()
     alliance = models.ForeignKey(EveAllianceInfo, blank=True, null=True, on_delete=models.SET_NULL)
+    last_updated = models.DateTimeField(null=True, blank=True, default=timezone.now, db_index=True)
+    priority = models.PositiveSmallIntegerField(default=0, help_text="Higher priority corporations are refreshed first.")
 
     objects = EveCorporationManager()
     provider = EveCorporationProviderManager()
 
     def update_corporation(self, corp: providers.Corporation = None):
         if corp is None:
-            corp = self.provider.get_corporation(self.corporation_id)
-        self.member_count = corp.members
+            try:
+                corp = self.provider.get_corporation(self.corporation_id, conditional=True)
+            except providers.ObjectNotModified as e:
+                logger.debug(e)
+                mark_updated(self)
+                self.changed_fields = []
+                return self
         try:
-            self.alliance = EveAllianceInfo.objects.get(alliance_id=corp.alliance_id)
+            alliance = EveAllianceInfo.objects.get(alliance_id=corp.alliance_id)
         except EveAllianceInfo.DoesNotExist:
-            self.alliance = None
-        self.save()
+            alliance = None
+        save_changed_fields(self, member_count=corp.members, alliance=alliance)
+        self.provider.store_etag(corp)
         return self
 
     def __str__(self):
@@ -80,49 +145,47 @@ class EveCorporationInfo(models.Model):
 
 
 class EveCharacter(models.Model):
-    character_id = models.CharField(max_length=254, unique=True)
+    character_id = models.BigIntegerField(unique=True)
     character_name = models.CharField(max_length=254, unique=True)
-    corporation_id = models.CharField(max_length=254)
+    # related by EVE ID without a database constraint, as the corp and alliance models need not exist
+    # nullable so select_related uses an outer join, keeping characters whose corp model is missing
+    corporation = models.ForeignKey(EveCorporationInfo, to_field='corporation_id', db_constraint=False, null=True,
+                                    on_delete=models.DO_NOTHING, related_name='characters')
     corporation_name = models.CharField(max_length=254)
     corporation_ticker = models.CharField(max_length=5)
-    alliance_id = models.CharField(max_length=254, blank=True, null=True, default='')
+    alliance = models.ForeignKey(EveAllianceInfo, to_field='alliance_id', db_constraint=False, blank=True,
+                                 null=True, default=None, on_delete=models.DO_NOTHING, related_name='characters')
     alliance_name = models.CharField(max_length=254, blank=True, null=True, default='')
     alliance_ticker = models.CharField(max_length=5, blank=True, null=True, default='')
+    last_updated = models.DateTimeField(null=True, blank=True, default=timezone.now, db_index=True)
+    priority = models.PositiveSmallIntegerField(default=0, help_text="Higher priority characters are refreshed first.")
 
     objects = EveCharacterManager()
     provider = EveCharacterProviderManager()
 
-    @property
-    def alliance(self) -> Union[EveAllianceInfo, None]:
-        """
-        Pseudo foreign key from alliance_id to EveAllianceInfo
-        :raises: EveAllianceInfo.DoesNotExist
-        :return: EveAllianceInfo or None
-        """
-        if self.alliance_id is None:
-            return None
-        return EveAllianceInfo.objects.get(alliance_id=self.alliance_id)
-
-    @property
-    def corporation(self) -> EveCorporationInfo:
-        """
-        Pseudo foreign key from corporation_id to EveCorporationInfo
-        :raises: EveCorporationInfo.DoesNotExist
-        :return: EveCorporationInfo
-        """
-        return EveCorporationInfo.objects.get(corporation_id=self.corporation_id)
-
     def update_character(self, character: providers.Character = None):
         if character is None:
-            character = self.provider.get_character(self.character_id)
-        self.character_name = character.name
-        self.corporation_id = character.corp.id
-        self.corporation_name = character.corp.name
-        self.corporation_ticker = character.corp.ticker
-        self.alliance_id = character.alliance.id
-        self.alliance_name = character.alliance.name
-        self.alliance_ticker = getattr(character.alliance, 'ticker', None)
-        self.save()
+            try:
+                character = self.provider.get_character(self.character_id, conditional=True)
+            except providers.ObjectNotModified as e:
+                logger.debug(e)
+                if not self.corporation_id:
+                    character = self.provider.get_character(self.character_id)
+                else:
+                    # the character is unchanged, but its corp and alliance can have been renamed since
+                    character = providers.Character(id=self.character_id, name=self.character_name,
+                                                    corp_id=self.corporation_id, alliance_id=self.alliance_id)
+        save_changed_fields(
+            self,
+            character_name=character.name,
+            corporation_id=character.corp.id,
+            corporation_name=character.corp.name,
+            corporation_ticker=character.corp.ticker,
+            alliance_id=character.alliance.id,
+            alliance_name=character.alliance.name,
+            alliance_ticker=getattr(character.alliance, 'ticker', None),
+        )
+        self.provider.store_etag(character)
         return self
 
     def __str__(self):
@@ -136,3 +199,36 @@ class EveCharacter(models.Model):
             size = item.strip('portrait_url_')
             return self.portrait_url(size)
         return self.__getattribute__(item)
+
+
+class EveItemType(models.Model):
+    type_id = models.PositiveIntegerField(unique=True)
+    type_name = models.CharField(max_length=254)
+
+    objects = EveItemTypeManager()
+    provider = EveItemTypeProviderManager()
+
+    def __str__(self):
+        return self.type_name
+
+
+class EveLocation(models.Model):
+    SOLAR_SYSTEM = 'solar_system'
+    STATION = 'station'
+    STRUCTURE = 'structure'
+    LOCATION_TYPE_CHOICES = (
+        (SOLAR_SYSTEM, 'Solar System'),
+        (STATION, 'Station'),
+        (STRUCTURE, 'Structure'),
+    )
+
+    location_id = models.BigIntegerField(unique=True)
+    location_name = models.CharField(max_length=254)
+    location_type = models.CharField(max_length=20, choices=LOCATION_TYPE_CHOICES)
+    last_updated = models.DateTimeField(default=timezone.now)
+
+    objects = EveLocationManager()
+    provider = EveLocationProviderManager()
+
+    def __str__(self):
+        return self.location_name
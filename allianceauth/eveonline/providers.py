@@ -1,7 +1,20 @@
-from esi.clients import esi_client_factory
-from bravado.exception import HTTPNotFound, HTTPUnprocessableEntity
+from esi.clients import TokenAuthenticator
+from bravado import requests_client
+from bravado.client import SwaggerClient
+from bravado.exception import HTTPError, HTTPNotFound, HTTPUnprocessableEntity
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, Future
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from functools import lru_cache, partial
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from django.core.cache import cache
+import json
 import logging
 import os
+import threading
+import time
 
 SWAGGER_SPEC_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'swagger.json')
 """
@@ -12,8 +25,22 @@ get_alliances_alliance_id_corporations
 get_corporations_corporation_id
 get_characters_character_id
 get_universe_types_type_id
+get_universe_types
+get_universe_systems
+post_characters_affiliation
+post_universe_names
 """
-
+# the bundled spec is validated by the test suite instead of every time a client is built,
+# which would also fetch its remote references from ESI
+SPEC_CONFIG = {'use_models': False, 'validate_swagger_spec': False}
+
+PROVIDER_MAX_WORKERS = getattr(settings, 'EVEONLINE_PROVIDER_MAX_WORKERS', 10)  # concurrent ESI requests
+PROVIDER_CACHE_MAX_SIZE = getattr(settings, 'EVEONLINE_PROVIDER_CACHE_MAX_SIZE', 10000)
+PROVIDER_CACHE_TTL = getattr(settings, 'EVEONLINE_PROVIDER_CACHE_TTL', 60 * 60)  # used when ESI sends no Expires
+PROVIDER_CACHE_USE_DJANGO = getattr(settings, 'EVEONLINE_PROVIDER_CACHE_USE_DJANGO', False)
+ETAG_CACHE_TIMEOUT = getattr(settings, 'EVEONLINE_ETAG_CACHE_TIMEOUT', 60 * 60 * 24 * 7)
+# back off until the error limit window resets once fewer errors than this remain
+ERROR_LIMIT_THRESHOLD = getattr(settings, 'EVEONLINE_ERROR_LIMIT_THRESHOLD', 20)
 
 logger = logging.getLogger(__name__)
 
@@ -27,10 +54,20 @@ class ObjectNotFound(Exception):
         return '%s with ID %s not found.' % (self.type, self.id)
 
 
+class ObjectNotModified(Exception):
+    def __init__(self, obj_id, type_name):
+        self.id = obj_id
+        self.type = type_name
+
+    def __str__(self):
+        return '%s with ID %s not modified.' % (self.type, self.id)
+
+
 class Entity(object):
     def __init__(self, id=None, name=None):
         self.id = id
         self.name = name
+        self.etag = None
 
     def __str__(self):
         return self.name
@@ -122,44 +159,367 @@ class ItemType(Entity):
         super(ItemType, self).__init__(**kwargs)
 
 
+@lru_cache(maxsize=None)
+def load_swagger_spec(path=SWAGGER_SPEC_PATH):
+    """
+    :return: the parsed swagger spec dict, read from disk once per process
+    """
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def build_client(token=None):
+    """
+    Builds a bravado client for the bundled swagger spec
+    :param token: :class:`esi.models.Token` used to access authenticated endpoints
+    """
+    http_client = requests_client.RequestsClient()
+    if token:
+        http_client.authenticator = TokenAuthenticator(token=token)
+    return SwaggerClient.from_spec(load_swagger_spec(), http_client=http_client, config=SPEC_CONFIG)
+
+
+def seconds_until_expiry(expires):
+    """
+    Determines the seconds remaining until an HTTP "Expires" header timestamp
+    :param expires: HTTP response "Expires" header
+    :return: seconds until expiry, or None if the header is missing or malformed
+    """
+    try:
+        return max((parsedate_to_datetime(expires) - datetime.now(timezone.utc)).total_seconds(), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+class EntityCache(object):
+    """
+    Size bounded LRU cache of provider entities, each of which expires after its own TTL.
+    Concurrent requests for the same missing entity wait on a single fetch.
+    Optionally backed by the Django cache so entities are shared between processes.
+    """
+    def __init__(self, max_size=PROVIDER_CACHE_MAX_SIZE, ttl=PROVIDER_CACHE_TTL, use_django_cache=PROVIDER_CACHE_USE_DJANGO):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.use_django_cache = use_django_cache
+        self._entries = OrderedDict()
+        self._pending = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _key(type_name, obj_id):
+        return 'eveonline_provider_{}_{}'.format(type_name, int(obj_id))
+
+    def _get_local(self, key):
+        try:
+            expires, entity = self._entries[key]
+        except KeyError:
+            return None
+        if expires <= time.time():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entity
+
+    def _set_local(self, key, entity, expires):
+        self._entries[key] = (expires, entity)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def get(self, type_name, obj_id):
+        """
+        :return: the cached entity, or None if it is missing or expired
+        """
+        key = self._key(type_name, obj_id)
+        with self._lock:
+            entity = self._get_local(key)
+        if entity is None and self.use_django_cache:
+            cached = cache.get(key)
+            if cached is not None:
+                expires, entity = cached
+                with self._lock:
+                    self._set_local(key, entity, expires)
+        with self._lock:
+            if entity is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return entity
+
+    def set(self, type_name, obj_id, entity, ttl=None):
+        """
+        Cache an entity for ttl seconds, or the default TTL if not given
+        """
+        ttl = self.ttl if ttl is None else ttl
+        if ttl <= 0:
+            return
+        key = self._key(type_name, obj_id)
+        expires = time.time() + ttl
+        with self._lock:
+            self._set_local(key, entity, expires)
+        if self.use_django_cache:
+            cache.set(key, (expires, entity), ttl)
+
+    def get_or_fetch(self, type_name, obj_id, fetch):
+        """
+        Return the cached entity, calling fetch to retrieve it if missing.
+        Only one fetch per entity is in flight at a time; other callers wait for its result.
+        :param fetch: callable taking obj_id and returning a tuple of the entity and its TTL in seconds or None
+        """
+        entity = self.get(type_name, obj_id)
+        if entity is not None:
+            return entity
+        key = self._key(type_name, obj_id)
+        with self._lock:
+            pending = self._pending.get(key)
+            if pending is None:
+                self._pending[key] = future = Future()
+        if pending is not None:
+            return pending.result()
+        try:
+            entity, ttl = fetch(obj_id)
+            self.set(type_name, obj_id, entity, ttl)
+            future.set_result(entity)
+            return entity
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._pending[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """
+        :return: dict of cache size and hit, miss and eviction counts
+        """
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
 class EveProvider(object):
-    def get_alliance(self, alliance_id):
+    def get_alliance(self, alliance_id, conditional=False):
         """
+        :param conditional: raise ObjectNotModified if unchanged since its ETag was last stored
         :return: an Alliance object for the given ID
         """
         raise NotImplementedError()
 
-    def get_corp(self, corp_id):
+    def get_corp(self, corp_id, conditional=False):
         """
+        :param conditional: raise ObjectNotModified if unchanged since its ETag was last stored
         :return: a Corporation object for the given ID
         """
         raise NotImplementedError()
 
-    def get_character(self, character_id):
+    def get_character(self, character_id, conditional=False):
         """
+        :param conditional: raise ObjectNotModified if unchanged since its ETag was last stored
         :return: a Character object for the given ID
         """
         raise NotImplementedError()
 
+    def store_etag(self, type_name, entity):
+        """
+        Records the ETag of an entity whose data has been saved, for use by later conditional lookups
+        """
+        pass
+
     def get_itemtype(self, type_id):
         """
         :return: an ItemType object for the given ID
         """
         raise NotImplemented()
 
+    def get_alliances(self, alliance_ids, conditional=False):
+        """
+        :param conditional: also omit alliances unchanged since their ETag was last stored
+        :return: a dict of Alliance objects keyed by ID, omitting IDs which could not be found
+        """
+        raise NotImplementedError()
+
+    def get_corps(self, corp_ids, conditional=False):
+        """
+        :param conditional: also omit corporations unchanged since their ETag was last stored
+        :return: a dict of Corporation objects keyed by ID, omitting IDs which could not be found
+        """
+        raise NotImplementedError()
+
+    def get_characters(self, character_ids):
+        """
+        :return: a dict of Character objects keyed by ID, omitting IDs which could not be found
+        """
+        raise NotImplementedError()
+
+    def get_itemtypes(self, type_ids):
+        """
+        :return: a dict of ItemType objects keyed by ID, omitting IDs which could not be found
+        """
+        raise NotImplementedError()
+
+    def get_itemtype_ids(self):
+        """
+        :return: a list of the IDs of every item type
+        """
+        raise NotImplementedError()
+
+    def get_solar_system_ids(self):
+        """
+        :return: a list of the IDs of every solar system
+        """
+        raise NotImplementedError()
+
+    def get_names(self, ids):
+        """
+        :return: a dict of Entity objects of any category keyed by ID, omitting IDs which could not be resolved
+        """
+        raise NotImplementedError()
+
+    def gather(self, *calls, return_exceptions=False):
+        """
+        Runs the given callables, concurrently where the provider supports it
+        :param calls: callables taking no arguments, eg the result method of a bravado future
+        :param return_exceptions: return exceptions raised by calls in place of their results instead of raising
+        :return: list of results in the order of calls
+        """
+        results = []
+        for call in calls:
+            try:
+                results.append(call())
+            except Exception as e:
+                if not return_exceptions:
+                    raise
+                results.append(e)
+        return results
+
 
 class EveSwaggerProvider(EveProvider):
-    def __init__(self, token=None, adapter=None):
-        self.client = esi_client_factory(token=token, spec_file=SWAGGER_SPEC_PATH)
+    # ESI rejects bulk lookups of more IDs than this in a single request
+    bulk_chunk_size = 1000
+
+    def __init__(self, token=None, adapter=None, max_workers=PROVIDER_MAX_WORKERS, entity_cache=None):
+        self.token = token
+        self._client = None
+        self._client_lock = threading.Lock()
         self.adapter = adapter or self
+        self.max_workers = max_workers
+        # marks this provider's worker threads, so nested gathers don't start more workers
+        self._worker = threading.local()
+        self.cache = entity_cache or EntityCache()
+        self.error_limit_remain = None
+        self.error_limit_reset = None
+
+    def _record_error_limit(self, headers):
+        """
+        Keeps track of the ESI error limit from response headers
+        """
+        try:
+            remain = int(headers.get('X-Esi-Error-Limit-Remain'))
+            reset = int(headers.get('X-Esi-Error-Limit-Reset'))
+        except (AttributeError, TypeError, ValueError):
+            return
+        self.error_limit_remain = remain
+        self.error_limit_reset = time.time() + reset
+
+    def error_limit_delay(self, threshold=ERROR_LIMIT_THRESHOLD):
+        """
+        :return: seconds to wait before making further requests, 0 unless the ESI error limit is nearly exhausted
+        """
+        if self.error_limit_remain is None or self.error_limit_remain >= threshold:
+            return 0
+        return max(self.error_limit_reset - time.time(), 0)
 
     def __str__(self):
         return 'esi'
 
-    def get_alliance(self, alliance_id):
+    @property
+    def client(self):
+        """
+        The bravado client, built on first use so importing the provider doesn't pay for parsing the spec
+        """
+        if self._client is None:
+            with self._client_lock:
+                if self._client is None:
+                    client = build_client(token=self.token)
+                    # keep enough connections alive for every concurrent request
+                    client.swagger_spec.http_client.session.mount('https://', HTTPAdapter(pool_maxsize=self.max_workers))
+                    self._client = client
+        return self._client
+
+    def _result(self, operation, etag=None, **kwargs):
+        """
+        Performs an operation, conditionally on the resource having changed if an ETag is given
+        :return: tuple of the operation result, seconds until the response expires or None if unknown,
+        and the response ETag. None if the resource matches the given ETag.
+        """
+        if etag:
+            kwargs['If-None-Match'] = etag
+        future = operation(**kwargs)
+        future.also_return_response = True
+        try:
+            result, response = future.result()
+        except HTTPError as e:
+            self._record_error_limit(getattr(e.response, 'headers', {}))
+            if e.status_code == 304:
+                return None
+            raise
+        self._record_error_limit(response.headers)
+        if etag and response.headers.get('ETag') == etag:
+            # served from the response cache, which ignores request headers
+            return None
+        return result, seconds_until_expiry(response.headers.get('Expires')), response.headers.get('ETag')
+
+    @staticmethod
+    def _etag_key(type_name, obj_id):
+        return 'eveonline_etag_{}_{}'.format(type_name, int(obj_id))
+
+    def _get_if_modified(self, type_name, obj_id, fetch):
+        etag = cache.get(self._etag_key(type_name, obj_id))
+        if etag is not None:
+            cached = self.cache.get(type_name, obj_id)
+            if cached is not None and cached.etag == etag:
+                raise ObjectNotModified(obj_id, type_name)
+        entity, ttl = fetch(obj_id, etag=etag)
+        self.cache.set(type_name, obj_id, entity, ttl)
+        return entity
+
+    def store_etag(self, type_name, entity):
+        if entity.etag:
+            cache.set(self._etag_key(type_name, entity.id), entity.etag, ETAG_CACHE_TIMEOUT)
+
+    def get_alliance(self, alliance_id, conditional=False):
+        if conditional:
+            return self._get_if_modified('alliance', alliance_id, self._fetch_alliance)
+        return self.cache.get_or_fetch('alliance', alliance_id, self._fetch_alliance)
+
+    def _fetch_alliance(self, alliance_id, etag=None):
+        # the ETag of an alliance is the pair of ETags of its details and its corporation list
+        data_etag, corps_etag = etag or (None, None)
         try:
-            data = self.client.Alliance.get_alliances_alliance_id(alliance_id=alliance_id).result()
-            corps = self.client.Alliance.get_alliances_alliance_id_corporations(alliance_id=alliance_id).result()
+            data, corps = self.gather(
+                partial(self._result, self.client.Alliance.get_alliances_alliance_id, data_etag,
+                        alliance_id=alliance_id),
+                partial(self._result, self.client.Alliance.get_alliances_alliance_id_corporations, corps_etag,
+                        alliance_id=alliance_id),
+            )
+            if data is None and corps is None:
+                raise ObjectNotModified(alliance_id, 'alliance')
+            data = data or self._result(self.client.Alliance.get_alliances_alliance_id, alliance_id=alliance_id)
+            corps = corps or self._result(
+                self.client.Alliance.get_alliances_alliance_id_corporations, alliance_id=alliance_id)
+            (data, data_ttl, data_etag), (corps, corps_ttl, corps_etag) = data, corps
             model = Alliance(
                 id=alliance_id,
                 name=data['name'],
@@ -167,13 +527,23 @@ class EveSwaggerProvider(EveProvider):
                 corp_ids=corps,
                 executor_corp_id=data['executor_corporation_id'] if 'executor_corporation_id' in data else None,
             )
-            return model
+            if data_etag and corps_etag:
+                model.etag = (data_etag, corps_etag)
+            return model, min((t for t in (data_ttl, corps_ttl) if t is not None), default=None)
         except HTTPNotFound:
             raise ObjectNotFound(alliance_id, 'alliance')
 
-    def get_corp(self, corp_id):
+    def get_corp(self, corp_id, conditional=False):
+        if conditional:
+            return self._get_if_modified('corporation', corp_id, self._fetch_corp)
+        return self.cache.get_or_fetch('corporation', corp_id, self._fetch_corp)
+
+    def _fetch_corp(self, corp_id, etag=None):
         try:
-            data = self.client.Corporation.get_corporations_corporation_id(corporation_id=corp_id).result()
+            result = self._result(self.client.Corporation.get_corporations_corporation_id, etag, corporation_id=corp_id)
+            if result is None:
+                raise ObjectNotModified(corp_id, 'corporation')
+            data, ttl, etag = result
             model = Corporation(
                 id=corp_id,
                 name=data['name'],
@@ -182,20 +552,31 @@ class EveSwaggerProvider(EveProvider):
                 members=data['member_count'],
                 alliance_id=data['alliance_id'] if 'alliance_id' in data else None,
             )
-            return model
+            model.etag = etag
+            return model, ttl
         except HTTPNotFound:
             raise ObjectNotFound(corp_id, 'corporation')
 
-    def get_character(self, character_id):
+    def get_character(self, character_id, conditional=False):
+        if conditional:
+            return self._get_if_modified('character', character_id, self._fetch_character)
+        return self.cache.get_or_fetch('character', character_id, self._fetch_character)
+
+    def _fetch_character(self, character_id, etag=None):
         try:
-            data = self.client.Character.get_characters_character_id(character_id=character_id).result()
+            result = self._result(
+                self.client.Character.get_characters_character_id, etag, character_id=character_id)
+            if result is None:
+                raise ObjectNotModified(character_id, 'character')
+            data, ttl, etag = result
             model = Character(
                 id=character_id,
                 name=data['name'],
                 corp_id=data['corporation_id'],
                 alliance_id=data['alliance_id'] if 'alliance_id' in data else None,
             )
-            return model
+            model.etag = etag
+            return model, ttl
         except (HTTPNotFound, HTTPUnprocessableEntity):
             raise ObjectNotFound(character_id, 'character')
 
@@ -206,5 +587,164 @@ class EveSwaggerProvider(EveProvider):
         except (HTTPNotFound, HTTPUnprocessableEntity):
             raise ObjectNotFound(type_id, 'type')
 
+    @staticmethod
+    def _unique_ids(ids):
+        """
+        Normalises IDs to integers, dropping duplicates while preserving order
+        """
+        return list(OrderedDict.fromkeys(int(obj_id) for obj_id in ids if obj_id))
+
+    def gather(self, *calls, return_exceptions=False):
+        """
+        Runs the given callables concurrently, at most max_workers at a time.
+        Requests share the provider's pooled keep-alive connections.
+        Calls made from within a gathered callable run in its worker, so nesting never exceeds max_workers in total.
+        """
+        if len(calls) < 2 or getattr(self._worker, 'active', False):
+            return super(EveSwaggerProvider, self).gather(*calls, return_exceptions=return_exceptions)
+
+        def run(call):
+            self._worker.active = True
+            try:
+                return call()
+            finally:
+                self._worker.active = False
+
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(calls))) as executor:
+            futures = [executor.submit(run, call) for call in calls]
+        results = []
+        for future in futures:
+            exception = future.exception()
+            if exception is None:
+                results.append(future.result())
+            elif return_exceptions:
+                results.append(exception)
+            else:
+                raise exception
+        return results
+
+    def _map(self, func, items):
+        """
+        Calls func on every item concurrently
+        :return: list of results in the same order as items
+        """
+        return self.gather(*[partial(func, item) for item in items])
+
+    def _bulk_get(self, func, ids, conditional=False):
+        """
+        Resolves each unique ID with func concurrently, skipping any which are not found
+        :param conditional: look IDs up conditionally, also skipping any which are unchanged
+        :return: dict of results keyed by ID
+        """
+        def get(obj_id):
+            try:
+                return func(obj_id, conditional=True) if conditional else func(obj_id)
+            except (ObjectNotFound, ObjectNotModified) as e:
+                logger.debug(e)
+                return None
+
+        ids = self._unique_ids(ids)
+        return {obj_id: obj for obj_id, obj in zip(ids, self._map(get, ids)) if obj is not None}
+
+    def get_alliances(self, alliance_ids, conditional=False):
+        return self._bulk_get(self.get_alliance, alliance_ids, conditional=conditional)
+
+    def get_corps(self, corp_ids, conditional=False):
+        return self._bulk_get(self.get_corp, corp_ids, conditional=conditional)
+
+    def _get_character_chunk(self, character_ids):
+        try:
+            affiliations = self._result(self.client.Character.post_characters_affiliation, characters=character_ids)[0]
+            names = self._result(self.client.Universe.post_universe_names, ids=character_ids)[0]
+        except (HTTPNotFound, HTTPUnprocessableEntity):
+            # a single invalid ID fails the whole bulk request, so resolve this chunk one at a time
+            logger.debug('Bulk character lookup failed. Falling back to individual lookups.')
+            return self._bulk_get(self.get_character, character_ids)
+        names = {n['id']: n['name'] for n in names}
+        return {
+            a['character_id']: Character(
+                id=a['character_id'],
+                name=names[a['character_id']],
+                corp_id=a['corporation_id'],
+                alliance_id=a['alliance_id'] if 'alliance_id' in a else None,
+            ) for a in affiliations if a['character_id'] in names
+        }
+
+    def _get_itemtype_chunk(self, type_ids):
+        try:
+            names = self._result(self.client.Universe.post_universe_names, ids=type_ids)[0]
+        except (HTTPNotFound, HTTPUnprocessableEntity):
+            # a single invalid ID fails the whole bulk request, so resolve this chunk one at a time
+            logger.debug('Bulk item type lookup failed. Falling back to individual lookups.')
+            return self._bulk_get(self.get_itemtype, type_ids)
+        return {n['id']: ItemType(id=n['id'], name=n['name']) for n in names if n['category'] == 'inventory_type'}
+
+    def get_itemtypes(self, type_ids):
+        type_ids = self._unique_ids(type_ids)
+        chunks = [type_ids[i:i + self.bulk_chunk_size] for i in range(0, len(type_ids), self.bulk_chunk_size)]
+        itemtypes = {}
+        for chunk in self._map(self._get_itemtype_chunk, chunks):
+            itemtypes.update(chunk)
+        return itemtypes
+
+    def get_itemtype_ids(self):
+        future = self.client.Universe.get_universe_types(page=1)
+        future.also_return_response = True
+        type_ids, response = future.result()
+        self._record_error_limit(response.headers)
+        pages = int(response.headers.get('X-Pages', 1))
+        for page in self.gather(*[self.client.Universe.get_universe_types(page=p).result for p in range(2, pages + 1)]):
+            type_ids.extend(page)
+        return type_ids
+
+    def get_solar_system_ids(self):
+        return self._result(self.client.Universe.get_universe_systems)[0]
+
+    def _get_names_chunk(self, ids):
+        try:
+            names = self._result(self.client.Universe.post_universe_names, ids=ids)[0]
+        except (HTTPNotFound, HTTPUnprocessableEntity):
+            # a single invalid ID fails the whole request, so narrow it down by halves
+            if len(ids) == 1:
+                logger.debug('Unable to resolve name of ID {0}'.format(ids[0]))
+                return {}
+            names = self._get_names_chunk(ids[:len(ids) // 2])
+            names.update(self._get_names_chunk(ids[len(ids) // 2:]))
+            return names
+        return {n['id']: Entity(id=n['id'], name=n['name']) for n in names}
+
+    def get_names(self, ids):
+        ids = self._unique_ids(ids)
+        chunks = [ids[i:i + self.bulk_chunk_size] for i in range(0, len(ids), self.bulk_chunk_size)]
+        names = {}
+        for chunk in self._map(self._get_names_chunk, chunks):
+            names.update(chunk)
+        return names
+
+    def get_characters(self, character_ids):
+        characters = {}
+        missing = []
+        for character_id in self._unique_ids(character_ids):
+            character = self.cache.get('character', character_id)
+            if character is None:
+                missing.append(character_id)
+            else:
+                characters[character_id] = character
+        chunks = [missing[i:i + self.bulk_chunk_size] for i in range(0, len(missing), self.bulk_chunk_size)]
+        for chunk in self._map(self._get_character_chunk, chunks):
+            for character_id, character in chunk.items():
+                self.cache.set('character', character_id, character)
+            characters.update(chunk)
+
+        # resolve every corp and alliance once and share them between their members
+        corps = self.get_corps(c.corp_id for c in characters.values())
+        alliances = self.get_alliances(c.alliance_id for c in corps.values())
+        for corp in corps.values():
+            if corp.alliance_id in alliances:
+                corp._alliance = alliances[corp.alliance_id]
+        for character in characters.values():
+            character._corp = corps.get(character.corp_id)
+        return characters
+
 
 provider = EveSwaggerProvider()
@@ -1,12 +1,31 @@
 import logging
+import math
+import time
+import uuid
 
 from celery import shared_task
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
 from .models import EveAllianceInfo
 from .models import EveCharacter
 from .models import EveCorporationInfo
+from .models import mark_updated
+from . import providers
+from .providers import ObjectNotModified
 
 logger = logging.getLogger(__name__)
 
+MODEL_UPDATE_CHUNK_SIZE = getattr(settings, 'EVEONLINE_MODEL_UPDATE_CHUNK_SIZE', 500)
+MODEL_UPDATE_WINDOW = getattr(settings, 'EVEONLINE_MODEL_UPDATE_WINDOW', 60 * 60)  # seconds to spread chunks over
+MODEL_UPDATE_CHECKPOINT_KEY = 'eveonline_model_update_checkpoint'
+# a run whose next chunk is overdue by this many seconds is assumed to have been interrupted
+MODEL_UPDATE_STALL_TIMEOUT = 10 * 60
+MODEL_UPDATE_MAX_ATTEMPTS = 3
+REFRESH_BATCH_SIZE = getattr(settings, 'EVEONLINE_REFRESH_BATCH_SIZE', 100)  # minimum models of each type per tick
+REFRESH_MIN_AGE = getattr(settings, 'EVEONLINE_REFRESH_MIN_AGE', 60 * 60 * 6)  # seconds before a model is stale
+REFRESH_INTERVAL = getattr(settings, 'EVEONLINE_REFRESH_INTERVAL', 5 * 60)  # seconds between ticks in the beat schedule
+
 
 @shared_task
 def update_corp(corp_id):
@@ -15,7 +34,13 @@ def update_corp(corp_id):
 
 @shared_task
 def update_alliance(alliance_id):
-    EveAllianceInfo.objects.update_alliance(alliance_id).populate_alliance()
+    try:
+        alliance = EveAllianceInfo.provider.get_alliance(alliance_id, conditional=True)
+    except ObjectNotModified as e:
+        logger.debug(e)
+        mark_updated(EveAllianceInfo.objects.get(alliance_id=alliance_id))
+        return
+    EveAllianceInfo.objects.get(alliance_id=alliance_id).update_alliance(alliance).populate_alliance(alliance)
 
 
 @shared_task
@@ -23,15 +48,122 @@ def update_character(character_id):
     EveCharacter.objects.update_character(character_id)
 
 
+@shared_task
+def update_corps(corp_ids):
+    EveCorporationInfo.objects.update_corporations(corp_ids, conditional=True)
+
+
+@shared_task
+def update_alliances(alliance_ids):
+    alliance_ids = list(alliance_ids)
+    alliances = EveAllianceInfo.provider.get_alliances(alliance_ids, conditional=True)
+    for model in EveAllianceInfo.objects.filter(alliance_id__in=alliance_ids):
+        if model.alliance_id in alliances:
+            alliance = alliances[model.alliance_id]
+            model.update_alliance(alliance).populate_alliance(alliance)
+        else:
+            mark_updated(model)
+
+
+@shared_task
+def update_characters(character_ids):
+    EveCharacter.objects.update_characters(character_ids)
+
+
+# models are updated in this order, each as chunks of IDs passed to their bulk update task
+MODEL_UPDATE_STEPS = (
+    (EveCorporationInfo, 'corporation_id', update_corps),
+    (EveAllianceInfo, 'alliance_id', update_alliances),
+    (EveCharacter, 'character_id', update_characters),
+)
+
+
+def _schedule_model_update_chunk(checkpoint, countdown):
+    checkpoint['next_run'] = time.time() + countdown
+    cache.set(MODEL_UPDATE_CHECKPOINT_KEY, checkpoint, None)
+    run_model_update_chunk.apply_async(args=[checkpoint['run_id']], countdown=countdown)
+
+
 @shared_task
 def run_model_update():
-    # update existing corp models
-    for corp in EveCorporationInfo.objects.all().values('corporation_id'):
-        update_corp.delay(corp['corporation_id'])
+    """
+    Updates all corp, alliance and character models in chunks spread over EVEONLINE_MODEL_UPDATE_WINDOW seconds.
+    Progress is checkpointed so an interrupted run resumes where it stopped instead of starting over.
+    """
+    checkpoint = cache.get(MODEL_UPDATE_CHECKPOINT_KEY)
+    if checkpoint is not None:
+        if checkpoint['next_run'] + MODEL_UPDATE_STALL_TIMEOUT > time.time():
+            logger.info('Model update already in progress.')
+            return
+        logger.info('Resuming interrupted model update of {0} after pk {1}'.format(
+            MODEL_UPDATE_STEPS[checkpoint['step']][0].__name__, checkpoint['last_pk']))
+    else:
+        chunks = sum(math.ceil(model.objects.count() / MODEL_UPDATE_CHUNK_SIZE) for model, _, _ in MODEL_UPDATE_STEPS)
+        checkpoint = {
+            'step': 0,
+            'last_pk': 0,
+            'attempts': 0,
+            'interval': MODEL_UPDATE_WINDOW / max(chunks, 1),
+        }
+    # chunks still queued for an earlier run stop once they see it has been replaced
+    checkpoint['run_id'] = uuid.uuid4().hex
+    _schedule_model_update_chunk(checkpoint, 0)
+
 
-    # update existing alliance models
-    for alliance in EveAllianceInfo.objects.all().values('alliance_id'):
-        update_alliance.delay(alliance['alliance_id'])
+@shared_task
+def run_model_update_chunk(run_id=None):
+    """
+    Updates the next chunk of models from the run_model_update checkpoint, then schedules the following chunk.
+    Waits longer between chunks while the ESI error limit is nearly exhausted.
+    :param run_id: run the chunk belongs to, it does nothing if that run is no longer the checkpointed one
+    """
+    checkpoint = cache.get(MODEL_UPDATE_CHECKPOINT_KEY)
+    if checkpoint is None:
+        return
+    if checkpoint.get('run_id') != run_id:
+        logger.info('Model update run {0} has been replaced. Stopping.'.format(run_id))
+        return
+    model, id_field, update = MODEL_UPDATE_STEPS[checkpoint['step']]
+    chunk = list(model.objects.filter(pk__gt=checkpoint['last_pk']).order_by('pk').values_list(
+        'pk', id_field)[:MODEL_UPDATE_CHUNK_SIZE])
+
+    if not chunk:
+        if checkpoint['step'] + 1 == len(MODEL_UPDATE_STEPS):
+            cache.delete(MODEL_UPDATE_CHECKPOINT_KEY)
+            logger.info('Model update complete.')
+            return
+        checkpoint.update(step=checkpoint['step'] + 1, last_pk=0)
+        _schedule_model_update_chunk(checkpoint, 0)
+        return
+
+    try:
+        update([obj_id for pk, obj_id in chunk])
+    except Exception:
+        checkpoint['attempts'] += 1
+        if checkpoint['attempts'] < MODEL_UPDATE_MAX_ATTEMPTS:
+            logger.exception('Failed to update chunk of {0} models. Retrying.'.format(model.__name__))
+            _schedule_model_update_chunk(
+                checkpoint, max(checkpoint['interval'], providers.provider.error_limit_delay()))
+            return
+        logger.exception('Failed to update chunk of {0} models {1} times. Skipping it.'.format(
+            model.__name__, checkpoint['attempts']))
+    checkpoint.update(last_pk=chunk[-1][0], attempts=0)
+    _schedule_model_update_chunk(checkpoint, max(checkpoint['interval'], providers.provider.error_limit_delay()))
 
-    for character in EveCharacter.objects.all().values('character_id'):
-        update_character.delay(character['character_id'])
+
+@shared_task
+def refresh_stale_models(batch_size=REFRESH_BATCH_SIZE):
+    """
+    Refreshes the stalest corp, alliance and character models, those relevant to states and main characters first.
+    Meant to run every EVEONLINE_REFRESH_INTERVAL seconds so models are refreshed in a steady trickle.
+    Batches grow beyond batch_size as needed to get through every model once per EVEONLINE_REFRESH_MIN_AGE.
+    """
+    ticks = max(REFRESH_MIN_AGE // REFRESH_INTERVAL, 1)
+    for model, id_field, update in MODEL_UPDATE_STEPS:
+        model.objects.update_priorities()
+        limit = max(batch_size, math.ceil(model.objects.count() / ticks))
+        stale = list(model.objects.stale(limit, REFRESH_MIN_AGE).values_list('pk', id_field))
+        if stale:
+            # claim the batch so later ticks don't select it again while the update is queued
+            model.objects.filter(pk__in=[pk for pk, obj_id in stale]).update(last_updated=timezone.now())
+            update.delay([obj_id for pk, obj_id in stale])
@@ -1,9 +1,13 @@
+from datetime import timedelta
 from unittest import mock
 
 from django.test import TestCase
+from django.utils import timezone
 
-from ..models import EveCharacter, EveCorporationInfo, EveAllianceInfo
-from ..providers import Character, Corporation, Alliance
+from allianceauth.tests.auth_utils import AuthUtils
+
+from ..models import EveCharacter, EveCorporationInfo, EveAllianceInfo, EveItemType, EveLocation
+from ..providers import Character, Corporation, Alliance, Entity, ItemType, ObjectNotFound, ObjectNotModified
 
 
 class EveCharacterProviderManagerTestCase(TestCase):
@@ -22,16 +26,16 @@ class EveCharacterManagerTestCase(TestCase):
     class TestCharacter(Character):
         @property
         def alliance(self):
-            return Alliance(id='3456', name='Test Alliance')
+            return Alliance(id=3456, name='Test Alliance')
 
         @property
         def corp(self):
-            return Corporation(id='2345', name='Test Corp', alliance_id='3456', ticker='0BUGS')
+            return Corporation(id=2345, name='Test Corp', alliance_id=3456, ticker='0BUGS')
 
     @mock.patch('allianceauth.eveonline.managers.providers.provider')
     def test_create_character(self, provider):
         # Also covers create_character_obj
-        expected = self.TestCharacter(id='1234', name='Test Character', corp_id='2345', alliance_id='3456')
+        expected = self.TestCharacter(id=1234, name='Test Character', corp_id=2345, alliance_id=3456)
 
         provider.get_character.return_value = expected
 
@@ -49,16 +53,16 @@ class EveCharacterManagerTestCase(TestCase):
     def test_update_character(self, provider):
         # Also covers Model.update_character
         existing = EveCharacter.objects.create(
-            character_id='1234',
+            character_id=1234,
             character_name='character.name',
-            corporation_id='character.corp.id',
+            corporation_id=1000,
             corporation_name='character.corp.name',
             corporation_ticker='character.corp.ticker',
-            alliance_id='character.alliance.id',
+            alliance_id=3000,
             alliance_name='character.alliance.name',
         )
 
-        expected = self.TestCharacter(id='1234', name='Test Character', corp_id='2345', alliance_id='3456')
+        expected = self.TestCharacter(id=1234, name='Test Character', corp_id=2345, alliance_id=3456)
 
         provider.get_character.return_value = expected
 
@@ -71,21 +75,64 @@ class EveCharacterManagerTestCase(TestCase):
         self.assertEqual(result.corporation_ticker, expected.corp.ticker)
         self.assertEqual(result.alliance_id, expected.alliance.id)
         self.assertEqual(result.alliance_name, expected.alliance.name)
+        provider.store_etag.assert_called_once_with('character', expected)
+
+    @mock.patch('allianceauth.eveonline.managers.providers.provider')
+    def test_update_character_not_modified(self, provider):
+        EveCharacter.objects.create(
+            character_id=1234,
+            character_name='character.name',
+            corporation_id=1000,
+            corporation_name='character.corp.name',
+            corporation_ticker='character.corp.ticker',
+            alliance_name=None,
+            alliance_ticker=None,
+        )
+        provider.get_character.side_effect = ObjectNotModified('1234', 'character')
+        provider.get_corp.return_value = Corporation(id=1000, name='character.corp.name',
+                                                     ticker='character.corp.ticker')
+
+        with mock.patch.object(EveCharacter, 'save') as save:
+            result = EveCharacter.objects.update_character('1234')
+
+        self.assertFalse(save.called)
+        self.assertEqual(result.character_name, 'character.name')
+        provider.get_character.assert_called_once_with(1234, conditional=True)
+        # the stored ETag is kept
+        args, kwargs = provider.store_etag.call_args
+        self.assertIsNone(args[1].etag)
+
+    @mock.patch('allianceauth.eveonline.managers.providers.provider')
+    def test_update_character_not_modified_corp_renamed(self, provider):
+        EveCharacter.objects.create(
+            character_id=1234,
+            character_name='character.name',
+            corporation_id=1000,
+            corporation_name='character.corp.name',
+            corporation_ticker='character.corp.ticker',
+        )
+        provider.get_character.side_effect = ObjectNotModified('1234', 'character')
+        provider.get_corp.return_value = Corporation(id=1000, name='renamed corp', ticker='RENAM')
+
+        result = EveCharacter.objects.update_character('1234')
+
+        self.assertEqual(result.corporation_name, 'renamed corp')
+        self.assertEqual(EveCharacter.objects.get(character_id=1234).corporation_ticker, 'RENAM')
 
     def test_get_character_by_id(self):
         EveCharacter.objects.create(
-            character_id='1234',
+            character_id=1234,
             character_name='character.name',
-            corporation_id='character.corp.id',
+            corporation_id=1000,
             corporation_name='character.corp.name',
             corporation_ticker='character.corp.ticker',
-            alliance_id='character.alliance.id',
+            alliance_id=3000,
             alliance_name='character.alliance.name',
         )
 
         result = EveCharacter.objects.get_character_by_id('1234')
 
-        self.assertEqual(result.character_id, '1234')
+        self.assertEqual(result.character_id, 1234)
         self.assertEqual(result.character_name, 'character.name')
 
 
@@ -110,8 +157,8 @@ class EveAllianceManagerTestCase(TestCase):
     @mock.patch('allianceauth.eveonline.managers.providers.provider')
     def test_create_alliance(self, provider, populate_alliance):
         # Also covers create_alliance_obj
-        expected = self.TestAlliance(id='3456', name='Test Alliance', ticker='TEST',
-                                     corp_ids=['2345'], executor_corp_id='2345')
+        expected = self.TestAlliance(id=3456, name='Test Alliance', ticker='TEST',
+                                     corp_ids=[2345], executor_corp_id='2345')
 
         provider.get_alliance.return_value = expected
 
@@ -127,13 +174,13 @@ class EveAllianceManagerTestCase(TestCase):
     def test_update_alliance(self, provider):
         # Also covers Model.update_alliance
         EveAllianceInfo.objects.create(
-            alliance_id='3456',
+            alliance_id=3456,
             alliance_name='alliance.name',
             alliance_ticker='alliance.ticker',
             executor_corp_id='alliance.executor_corp_id',
         )
-        expected = self.TestAlliance(id='3456', name='Test Alliance', ticker='TEST',
-                                     corp_ids=['2345'], executor_corp_id='2345')
+        expected = self.TestAlliance(id=3456, name='Test Alliance', ticker='TEST',
+                                     corp_ids=[2345], executor_corp_id='2345')
 
         provider.get_alliance.return_value = expected
 
@@ -159,26 +206,26 @@ class EveCorporationManagerTestCase(TestCase):
     class TestCorporation(Corporation):
         @property
         def alliance(self):
-            return EveAllianceManagerTestCase.TestAlliance(id='3456', name='Test Alliance', ticker='TEST',
-                                                           corp_ids=['2345'], executor_corp_id='2345')
+            return EveAllianceManagerTestCase.TestAlliance(id=3456, name='Test Alliance', ticker='TEST',
+                                                           corp_ids=[2345], executor_corp_id='2345')
 
         @property
         def ceo(self):
-            return EveCharacterManagerTestCase.TestCharacter(id='1234', name='Test Character',
-                                                             corp_id='2345', alliance_id='3456')
+            return EveCharacterManagerTestCase.TestCharacter(id=1234, name='Test Character',
+                                                             corp_id=2345, alliance_id=3456)
 
     @mock.patch('allianceauth.eveonline.managers.providers.provider')
     def test_create_corporation(self, provider):
         # Also covers create_corp_obj
         exp_alliance = EveAllianceInfo.objects.create(
-            alliance_id='3456',
+            alliance_id=3456,
             alliance_name='alliance.name',
             alliance_ticker='alliance.ticker',
             executor_corp_id='alliance.executor_corp_id',
         )
 
-        expected = self.TestCorporation(id='2345', name='Test Corp', ticker='0BUGS',
-                                        ceo_id='1234', members=1, alliance_id='3456')
+        expected = self.TestCorporation(id=2345, name='Test Corp', ticker='0BUGS',
+                                        ceo_id=1234, members=1, alliance_id=3456)
 
         provider.get_corp.return_value = expected
 
@@ -194,22 +241,22 @@ class EveCorporationManagerTestCase(TestCase):
     def test_create_corporation(self, provider):
         # Also covers Model.update_corporation
         exp_alliance = EveAllianceInfo.objects.create(
-            alliance_id='3456',
+            alliance_id=3456,
             alliance_name='alliance.name',
             alliance_ticker='alliance.ticker',
             executor_corp_id='alliance.executor_corp_id',
         )
 
         EveCorporationInfo.objects.create(
-            corporation_id='2345',
+            corporation_id=2345,
             corporation_name='corp.name',
             corporation_ticker='corp.ticker',
             member_count=10,
             alliance=None,
         )
 
-        expected = self.TestCorporation(id='2345', name='Test Corp', ticker='0BUGS',
-                                        ceo_id='1234', members=1, alliance_id='3456')
+        expected = self.TestCorporation(id=2345, name='Test Corp', ticker='0BUGS',
+                                        ceo_id=1234, members=1, alliance_id=3456)
 
         provider.get_corp.return_value = expected
 
@@ -219,3 +266,226 @@ class EveCorporationManagerTestCase(TestCase):
         # These are the only updated props
         self.assertEqual(result.member_count, expected.members)
         self.assertEqual(result.alliance, exp_alliance)
+
+
+class EveBulkManagerTestCase(TestCase):
+    @mock.patch('allianceauth.eveonline.managers.providers.provider')
+    def test_create_characters(self, provider):
+        EveCharacter.objects.create(
+            character_id=1234,
+            character_name='character.name',
+            corporation_id=2345,
+            corporation_name='character.corp.name',
+            corporation_ticker='TICKR',
+        )
+        expected = EveCharacterManagerTestCase.TestCharacter(id=1235, name='Test Character 2', corp_id=2345,
+                                                             alliance_id=3456)
+        provider.get_characters.return_value = {1235: expected}
+
+        result = EveCharacter.objects.create_characters(['1234', '1235'])
+
+        args, kwargs = provider.get_characters.call_args
+        self.assertEqual(args[0], ['1235'])
+        self.assertEqual(len(result), 1)
+        created = EveCharacter.objects.get(character_id=1235)
+        self.assertEqual(created.character_name, expected.name)
+        self.assertEqual(created.corporation_id, 2345)
+        self.assertEqual(created.alliance_id, 3456)
+
+    @mock.patch('allianceauth.eveonline.managers.providers.provider')
+    def test_update_characters(self, provider):
+        EveCharacter.objects.create(
+            character_id=1234,
+            character_name='character.name',
+            corporation_id=1000,
+            corporation_name='character.corp.name',
+            corporation_ticker='TICKR',
+        )
+        expected = EveCharacterManagerTestCase.TestCharacter(id=1234, name='Test Character', corp_id=2345,
+                                                             alliance_id=3456)
+        provider.get_characters.return_value = {1234: expected}
+
+        result = EveCharacter.objects.update_characters(['1234', '9999'])
+
+        self.assertEqual(len(result), 1)
+        updated = EveCharacter.objects.get(character_id=1234)
+        self.assertEqual(updated.character_name, expected.name)
+        self.assertEqual(updated.corporation_id, 2345)
+        self.assertEqual(updated.corporation_name, 'Test Corp')
+
+    @mock.patch('allianceauth.eveonline.managers.providers.provider')
+    def test_create_corporations(self, provider):
+        alliance = EveAllianceInfo.objects.create(
+            alliance_id=3456,
+            alliance_name='alliance.name',
+            alliance_ticker='alliance.ticker',
+            executor_corp_id='2345',
+        )
+        provider.get_corps.return_value = {
+            2345: Corporation(id=2345, name='Test Corp', ticker='0BUGS', ceo_id=1234, members=1, alliance_id=3456),
+            2346: Corporation(id=2346, name='Other Corp', ticker='OTHER', ceo_id=1235, members=2, alliance_id=None),
+        }
+
+        EveCorporationInfo.objects.create_corporations([2345, 2346])
+
+        self.assertEqual(EveCorporationInfo.objects.get(corporation_id=2345).alliance, alliance)
+        self.assertIsNone(EveCorporationInfo.objects.get(corporation_id=2346).alliance)
+
+    @mock.patch('allianceauth.eveonline.managers.providers.provider')
+    def test_update_alliances(self, provider):
+        EveAllianceInfo.objects.create(
+            alliance_id=3456,
+            alliance_name='alliance.name',
+            alliance_ticker='alliance.ticker',
+            executor_corp_id='alliance.executor_corp_id',
+        )
+        provider.get_alliances.return_value = {
+            3456: Alliance(id=3456, name='Test Alliance', ticker='TEST', corp_ids=[2345], executor_corp_id='2345'),
+        }
+
+        result = EveAllianceInfo.objects.update_alliances(['3456'])
+
+        self.assertEqual(len(result), 1)
+        self.assertEqual(EveAllianceInfo.objects.get(alliance_id=3456).executor_corp_id, '2345')
+
+
+class RefreshPriorityTestCase(TestCase):
+    def setUp(self):
+        self.user = AuthUtils.create_user('test_user', disconnect_signals=True)
+        AuthUtils.add_main_character(self.user, 'main', '1', corp_id=10, corp_name='main corp',
+                                     corp_ticker='MAIN', alliance_id=100, alliance_name='main alliance')
+        self.main = EveCharacter.objects.get(character_id=1)
+        self.alt = EveCharacter.objects.create(character_id=2, character_name='alt', corporation_id=20,
+                                               corporation_name='alt corp', corporation_ticker='ALT')
+        self.main_corp = EveCorporationInfo.objects.create(corporation_id=10, corporation_name='main corp',
+                                                           corporation_ticker='MAIN', member_count=1)
+        self.state_corp = EveCorporationInfo.objects.create(corporation_id=30, corporation_name='state corp',
+                                                            corporation_ticker='STATE', member_count=1)
+        self.other_corp = EveCorporationInfo.objects.create(corporation_id=20, corporation_name='alt corp',
+                                                            corporation_ticker='ALT', member_count=1)
+        AuthUtils.create_state('test state', 150, member_corporations=self.state_corp, disconnect_signals=True)
+
+    def test_update_priorities(self):
+        EveCharacter.objects.update_priorities()
+        EveCorporationInfo.objects.update_priorities()
+
+        high = EveCharacter.objects.PRIORITY_HIGH
+        self.assertEqual(set(EveCharacter.objects.filter(priority=high)), {self.main})
+        self.assertEqual(set(EveCorporationInfo.objects.filter(priority=high)), {self.main_corp, self.state_corp})
+
+        self.user.profile.main_character = None
+        self.user.profile.save()
+        EveCharacter.objects.update_priorities()
+        self.assertFalse(EveCharacter.objects.filter(priority=high).exists())
+
+    def test_stale(self):
+        old = timezone.now() - timedelta(days=2)
+        EveCorporationInfo.objects.filter(pk=self.other_corp.pk).update(last_updated=None)
+        EveCorporationInfo.objects.filter(pk=self.state_corp.pk).update(last_updated=old)
+        EveCorporationInfo.objects.update_priorities()
+
+        result = list(EveCorporationInfo.objects.stale(10, 60 * 60))
+
+        # the recently updated main corp is not stale, the relevant state corp outranks the never updated corp
+        self.assertEqual(result, [self.state_corp, self.other_corp])
+        self.assertEqual(list(EveCorporationInfo.objects.stale(1, 60 * 60)), [self.state_corp])
+
+
+class EveItemTypeManagerTestCase(TestCase):
+    def setUp(self):
+        EveItemType.objects._names.clear()
+
+    @mock.patch('allianceauth.eveonline.managers.providers.provider')
+    def test_get_type_name(self, provider):
+        provider.get_itemtype.return_value = ItemType(id=587, name='Rifter')
+
+        self.assertEqual(EveItemType.objects.get_type_name('587'), 'Rifter')
+        self.assertTrue(EveItemType.objects.filter(type_id=587, type_name='Rifter').exists())
+
+        # later lookups are served from memory without touching the database or provider
+        with self.assertNumQueries(0):
+            self.assertEqual(EveItemType.objects.get_type_name(587), 'Rifter')
+        provider.get_itemtype.assert_called_once_with(587)
+
+    @mock.patch('allianceauth.eveonline.managers.providers.provider')
+    def test_get_type_name_stored(self, provider):
+        EveItemType.objects.create(type_id=587, type_name='Rifter')
+
+        self.assertEqual(EveItemType.objects.get_type_name(587), 'Rifter')
+        self.assertFalse(provider.get_itemtype.called)
+
+    @mock.patch('allianceauth.eveonline.managers.providers.provider')
+    def test_import_itemtypes(self, provider):
+        EveItemType.objects.create(type_id=587, type_name='Rifter')
+        provider.get_itemtype_ids.return_value = [587, 588]
+        provider.get_itemtypes.return_value = {588: ItemType(id=588, name='Reaper')}
+
+        EveItemType.objects.import_itemtypes()
+
+        provider.get_itemtypes.assert_called_once_with([588])
+        self.assertEqual(EveItemType.objects.get(type_id=588).type_name, 'Reaper')
+
+
+class EveLocationManagerTestCase(TestCase):
+    def setUp(self):
+        EveLocation.objects._names.clear()
+
+    @mock.patch('allianceauth.eveonline.managers.providers.provider')
+    def test_get_location_name(self, provider):
+        provider.get_names.return_value = {30000142: Entity(id=30000142, name='Jita')}
+
+        self.assertEqual(EveLocation.objects.get_location_name('30000142', EveLocation.SOLAR_SYSTEM), 'Jita')
+        self.assertTrue(EveLocation.objects.filter(location_id=30000142, location_type=EveLocation.SOLAR_SYSTEM,
+                                                   location_name='Jita').exists())
+        with self.assertNumQueries(0):
+            self.assertEqual(EveLocation.objects.get_location_name(30000142, EveLocation.SOLAR_SYSTEM), 'Jita')
+        provider.get_names.assert_called_once_with([30000142])
+
+    @mock.patch('allianceauth.eveonline.managers.providers.provider')
+    def test_get_location_name_not_found(self, provider):
+        provider.get_names.return_value = {}
+
+        with self.assertRaises(ObjectNotFound):
+            EveLocation.objects.get_location_name(1, EveLocation.STATION)
+
+    def test_get_location_name_fetch(self):
+        fetch = mock.Mock(return_value='Keepstar')
+
+        self.assertEqual(EveLocation.objects.get_location_name(1022734985679, EveLocation.STRUCTURE, fetch), 'Keepstar')
+        EveLocation.objects._names.clear()
+        self.assertEqual(EveLocation.objects.get_location_name(1022734985679, EveLocation.STRUCTURE, fetch), 'Keepstar')
+        self.assertEqual(fetch.call_count, 1)
+
+    def test_get_location_name_structure_renamed(self):
+        EveLocation.objects.create(location_id=1022734985679, location_name='Keepstar',
+                                   location_type=EveLocation.STRUCTURE,
+                                   last_updated=timezone.now() - timedelta(days=2))
+        fetch = mock.Mock(return_value='Renamed Keepstar')
+
+        self.assertEqual(EveLocation.objects.get_location_name(1022734985679, EveLocation.STRUCTURE, fetch),
+                         'Renamed Keepstar')
+        self.assertEqual(EveLocation.objects.get(location_id=1022734985679).location_name, 'Renamed Keepstar')
+
+    def test_get_location_name_structure_refresh_failed(self):
+        EveLocation.objects.create(location_id=1022734985679, location_name='Keepstar',
+                                   location_type=EveLocation.STRUCTURE,
+                                   last_updated=timezone.now() - timedelta(days=2))
+        fetch = mock.Mock(side_effect=Exception('docking access revoked'))
+
+        # the stored name is used, and not kept in memory so the next lookup tries again
+        self.assertEqual(EveLocation.objects.get_location_name(1022734985679, EveLocation.STRUCTURE, fetch),
+                         'Keepstar')
+        self.assertEqual(EveLocation.objects.get_location_name(1022734985679, EveLocation.STRUCTURE, fetch),
+                         'Keepstar')
+        self.assertEqual(fetch.call_count, 2)
+
+    @mock.patch('allianceauth.eveonline.managers.providers.provider')
+    def test_import_solar_systems(self, provider):
+        EveLocation.objects.create(location_id=30000142, location_name='Jita', location_type=EveLocation.SOLAR_SYSTEM)
+        provider.get_solar_system_ids.return_value = [30000142, 30000144]
+        provider.get_names.return_value = {30000144: Entity(id=30000144, name='Perimeter')}
+
+        EveLocation.objects.import_solar_systems()
+
+        provider.get_names.assert_called_once_with([30000144])
+        self.assertEqual(EveLocation.objects.get(location_id=30000144).location_name, 'Perimeter')
@@ -1,6 +1,9 @@
+from unittest import mock
+
 from django.test import TestCase
 
 from ..models import EveCharacter, EveCorporationInfo, EveAllianceInfo
+from ..providers import Alliance, Character, Corporation
 
 
 class EveCharacterTestCase(TestCase):
@@ -9,17 +12,17 @@ class EveCharacterTestCase(TestCase):
         Test that the correct corporation is returned by the corporation property
         """
         character = EveCharacter.objects.create(
-            character_id='1234',
+            character_id=1234,
             character_name='character.name',
-            corporation_id='2345',
+            corporation_id=2345,
             corporation_name='character.corp.name',
             corporation_ticker='character.corp.ticker',
-            alliance_id='character.alliance.id',
+            alliance_id=3000,
             alliance_name='character.alliance.name',
         )
 
         expected = EveCorporationInfo.objects.create(
-            corporation_id='2345',
+            corporation_id=2345,
             corporation_name='corp.name',
             corporation_ticker='corp.ticker',
             member_count=10,
@@ -27,7 +30,7 @@ class EveCharacterTestCase(TestCase):
         )
 
         incorrect = EveCorporationInfo.objects.create(
-            corporation_id='9999',
+            corporation_id=9999,
             corporation_name='corp.name1',
             corporation_ticker='corp.ticker1',
             member_count=10,
@@ -43,12 +46,12 @@ class EveCharacterTestCase(TestCase):
         object is not in the database
         """
         character = EveCharacter.objects.create(
-            character_id='1234',
+            character_id=1234,
             character_name='character.name',
-            corporation_id='2345',
+            corporation_id=2345,
             corporation_name='character.corp.name',
             corporation_ticker='character.corp.ticker',
-            alliance_id='character.alliance.id',
+            alliance_id=3000,
             alliance_name='character.alliance.name',
         )
 
@@ -60,24 +63,24 @@ class EveCharacterTestCase(TestCase):
         Test that the correct alliance is returned by the alliance property
         """
         character = EveCharacter.objects.create(
-            character_id='1234',
+            character_id=1234,
             character_name='character.name',
-            corporation_id='2345',
+            corporation_id=2345,
             corporation_name='character.corp.name',
             corporation_ticker='character.corp.ticker',
-            alliance_id='3456',
+            alliance_id=3456,
             alliance_name='character.alliance.name',
         )
 
         expected = EveAllianceInfo.objects.create(
-            alliance_id='3456',
+            alliance_id=3456,
             alliance_name='alliance.name',
             alliance_ticker='alliance.ticker',
             executor_corp_id='alliance.executor_corp_id',
         )
 
         incorrect = EveAllianceInfo.objects.create(
-            alliance_id='9001',
+            alliance_id=9001,
             alliance_name='alliance.name1',
             alliance_ticker='alliance.ticker1',
             executor_corp_id='alliance.executor_corp_id1',
@@ -92,12 +95,12 @@ class EveCharacterTestCase(TestCase):
         object is not in the database
         """
         character = EveCharacter.objects.create(
-            character_id='1234',
+            character_id=1234,
             character_name='character.name',
-            corporation_id='2345',
+            corporation_id=2345,
             corporation_name='character.corp.name',
             corporation_ticker='character.corp.ticker',
-            alliance_id='3456',
+            alliance_id=3456,
             alliance_name='character.alliance.name',
         )
 
@@ -109,9 +112,9 @@ class EveCharacterTestCase(TestCase):
         Check that None is returned when the character has no alliance
         """
         character = EveCharacter.objects.create(
-            character_id='1234',
+            character_id=1234,
             character_name='character.name',
-            corporation_id='2345',
+            corporation_id=2345,
             corporation_name='character.corp.name',
             corporation_ticker='character.corp.ticker',
             alliance_id=None,
@@ -119,3 +122,117 @@ class EveCharacterTestCase(TestCase):
         )
 
         self.assertIsNone(character.alliance)
+
+    def test_select_related(self):
+        """
+        Check that listing characters with their corp and alliance takes a single query
+        """
+        alliance = EveAllianceInfo.objects.create(alliance_id=3456, alliance_name='alliance.name',
+                                                  alliance_ticker='ALLY', executor_corp_id='2345')
+        corp = EveCorporationInfo.objects.create(corporation_id=2345, corporation_name='corp.name',
+                                                 corporation_ticker='CORP', member_count=10, alliance=alliance)
+        for i in range(3):
+            EveCharacter.objects.create(character_id=str(i), character_name='character%s' % i,
+                                        corporation_id=2345, corporation_name='corp.name',
+                                        corporation_ticker='CORP', alliance_id=3456)
+
+        with self.assertNumQueries(1):
+            characters = list(EveCharacter.objects.select_related('corporation', 'alliance'))
+            self.assertEqual([c.corporation for c in characters], [corp] * 3)
+            self.assertEqual([c.alliance for c in characters], [alliance] * 3)
+
+    def test_select_related_missing_corp(self):
+        EveCharacter.objects.create(character_id=1, character_name='character', corporation_id=2345,
+                                    corporation_name='corp.name', corporation_ticker='CORP')
+
+        characters = list(EveCharacter.objects.select_related('corporation', 'alliance'))
+
+        self.assertEqual(len(characters), 1)
+        self.assertIsNone(characters[0].corporation)
+
+
+class EveCharacterUpdateTestCase(TestCase):
+    def setUp(self):
+        self.character = EveCharacter.objects.create(
+            character_id=1234,
+            character_name='character.name',
+            corporation_id=2345,
+            corporation_name='character.corp.name',
+            corporation_ticker='CORP',
+            alliance_id=None,
+            alliance_name=None,
+            alliance_ticker=None,
+        )
+        self.corp = Corporation(id=2345, name='character.corp.name', ticker='CORP')
+
+    def test_update_character_unchanged(self):
+        """
+        Check that nothing is saved when the provider data matches the model
+        """
+        data = Character(id=1234, name='character.name', corp_id=2345)
+        data._corp = self.corp
+
+        with mock.patch.object(EveCharacter, 'save') as save:
+            self.character.update_character(data)
+
+        self.assertFalse(save.called)
+        self.assertEqual(self.character.changed_fields, [])
+
+    def test_update_character_changed(self):
+        """
+        Check that only the changed fields are saved
+        """
+        data = Character(id=1234, name='character.name', corp_id=2345, alliance_id=3456)
+        self.corp.alliance_id = 3456
+        self.corp._alliance = Alliance(id=3456, name='alliance.name', ticker='ALLY')
+        data._corp = self.corp
+
+        with mock.patch.object(EveCharacter, 'save') as save:
+            self.character.update_character(data)
+
+        fields = ['alliance_id', 'alliance_name', 'alliance_ticker']
+        save.assert_called_once_with(update_fields=fields + ['last_updated'])
+        self.assertEqual(sorted(self.character.changed_fields), fields)
+        self.assertEqual(self.character.alliance_id, 3456)
+
+    def test_update_character_clears_relation(self):
+        """
+        Check that a changed alliance isn't hidden by the previously cached relation
+        """
+        self.assertIsNone(self.character.alliance)
+        alliance = EveAllianceInfo.objects.create(alliance_id=3456, alliance_name='alliance.name',
+                                                  alliance_ticker='ALLY', executor_corp_id='2345')
+        data = Character(id=1234, name='character.name', corp_id=2345, alliance_id=3456)
+        self.corp.alliance_id = 3456
+        self.corp._alliance = Alliance(id=3456, name='alliance.name', ticker='ALLY')
+        data._corp = self.corp
+
+        self.character.update_character(data)
+
+        self.assertEqual(self.character.alliance, alliance)
+
+
+class EveAllianceInfoTestCase(TestCase):
+    @mock.patch('allianceauth.eveonline.managers.providers.provider')
+    def test_populate_alliance(self, provider):
+        """
+        Check that missing corps are created in bulk and member corps are linked to the alliance
+        """
+        alliance = EveAllianceInfo.objects.create(alliance_id=3456, alliance_name='alliance.name',
+                                                  alliance_ticker='ALLY', executor_corp_id='2345')
+        EveCorporationInfo.objects.create(corporation_id=2345, corporation_name='existing',
+                                          corporation_ticker='EXIST', member_count=1)
+        former = EveCorporationInfo.objects.create(corporation_id=9999, corporation_name='former',
+                                                   corporation_ticker='GONE', member_count=1, alliance=alliance)
+        provider.get_corps.return_value = {
+            2346: Corporation(id=2346, name='new', ticker='NEW', members=1, alliance_id=3456),
+            2347: Corporation(id=2347, name='new2', ticker='NEW2', members=1, alliance_id=3456),
+        }
+
+        alliance.populate_alliance(Alliance(id=3456, corp_ids=[2345, 2346, 2347]))
+
+        provider.get_corps.assert_called_once_with([2346, 2347], conditional=False)
+        self.assertEqual(set(EveCorporationInfo.objects.filter(alliance=alliance).values_list(
+            'corporation_id', flat=True)), {2345, 2346, 2347})
+        former.refresh_from_db()
+        self.assertIsNone(former.alliance)
@@ -0,0 +1,353 @@
+import threading
+from unittest import mock
+
+from bravado.exception import HTTPError, HTTPNotFound
+from django.core.cache import cache
+from django.test import TestCase
+
+from ..providers import EveSwaggerProvider, Character, Corporation, Alliance, ObjectNotFound, ObjectNotModified
+from ..providers import EntityCache, build_client
+
+MODULE_PATH = 'allianceauth.eveonline.providers'
+
+
+@mock.patch(MODULE_PATH + '.build_client')
+class EveSwaggerProviderBulkTestCase(TestCase):
+    def test_get_characters(self, client_factory):
+        client = client_factory.return_value
+        response = mock.Mock(headers={'X-Esi-Error-Limit-Remain': '100', 'X-Esi-Error-Limit-Reset': '30'})
+        client.Character.post_characters_affiliation.return_value.result.return_value = ([
+            {'character_id': 1, 'corporation_id': 10, 'alliance_id': 100},
+            {'character_id': 2, 'corporation_id': 10, 'alliance_id': 100},
+        ], response)
+        client.Universe.post_universe_names.return_value.result.return_value = ([
+            {'id': 1, 'name': 'Char One', 'category': 'character'},
+            {'id': 2, 'name': 'Char Two', 'category': 'character'},
+        ], response)
+        provider = EveSwaggerProvider()
+        corp = Corporation(id=10, name='Corp', ticker='CORP', alliance_id=100)
+        alliance = Alliance(id=100, name='Alliance', ticker='ALLY')
+
+        with mock.patch.object(provider, 'get_corp', return_value=corp) as get_corp, \
+                mock.patch.object(provider, 'get_alliance', return_value=alliance) as get_alliance:
+            result = provider.get_characters(['1', 2, '2'])
+
+        self.assertEqual(set(result), {1, 2})
+        self.assertEqual(result[1].name, 'Char One')
+        self.assertEqual(result[2].corp, corp)
+        self.assertEqual(result[2].alliance, alliance)
+        # the shared corp and alliance are only resolved once
+        self.assertEqual(get_corp.call_count, 1)
+        self.assertEqual(get_alliance.call_count, 1)
+        args, kwargs = client.Character.post_characters_affiliation.call_args
+        self.assertEqual(kwargs['characters'], [1, 2])
+        self.assertEqual(provider.error_limit_remain, 100)
+
+    def test_get_characters_chunked(self, client_factory):
+        client = client_factory.return_value
+        client.Character.post_characters_affiliation.return_value.result.return_value = ([], mock.Mock(headers={}))
+        client.Universe.post_universe_names.return_value.result.return_value = ([], mock.Mock(headers={}))
+        provider = EveSwaggerProvider()
+        provider.bulk_chunk_size = 2
+
+        provider.get_characters([1, 2, 3, 4, 5])
+
+        self.assertEqual(client.Character.post_characters_affiliation.call_count, 3)
+
+    def test_get_characters_invalid_id(self, client_factory):
+        client = client_factory.return_value
+        client.Character.post_characters_affiliation.return_value.result.side_effect = HTTPNotFound(mock.Mock())
+        provider = EveSwaggerProvider()
+
+        def get_character(character_id):
+            if character_id == 2:
+                raise ObjectNotFound(character_id, 'character')
+            return Character(id=character_id, name='Char', corp_id=10)
+
+        with mock.patch.object(provider, 'get_character', side_effect=get_character), \
+                mock.patch.object(provider, 'get_corps', return_value={}), \
+                mock.patch.object(provider, 'get_alliances', return_value={}):
+            result = provider.get_characters([1, 2])
+
+        self.assertEqual(list(result), [1])
+
+    def test_get_itemtypes(self, client_factory):
+        client = client_factory.return_value
+        client.Universe.post_universe_names.return_value.result.return_value = ([
+            {'id': 587, 'name': 'Rifter', 'category': 'inventory_type'},
+            {'id': 1, 'name': 'Not a type', 'category': 'region'},
+        ], mock.Mock(headers={}))
+        provider = EveSwaggerProvider()
+
+        result = provider.get_itemtypes(['587', 1])
+
+        self.assertEqual(list(result), [587])
+        self.assertEqual(result[587].name, 'Rifter')
+
+    def test_get_itemtype_ids(self, client_factory):
+        operation = client_factory.return_value.Universe.get_universe_types
+        first, second = mock.Mock(), mock.Mock()
+        first.result.return_value = ([1, 2], mock.Mock(headers={'X-Pages': '2'}))
+        second.result.return_value = [3]
+        operation.side_effect = [first, second]
+        provider = EveSwaggerProvider()
+
+        self.assertEqual(provider.get_itemtype_ids(), [1, 2, 3])
+        operation.assert_called_with(page=2)
+
+    def test_get_names_invalid_id(self, client_factory):
+        def post_universe_names(ids):
+            future = mock.Mock()
+            if 2 in ids:
+                future.result.side_effect = HTTPNotFound(mock.Mock())
+            else:
+                future.result.return_value = (
+                    [{'id': i, 'name': str(i), 'category': 'solar_system'} for i in ids], mock.Mock(headers={}))
+            return future
+        client_factory.return_value.Universe.post_universe_names.side_effect = post_universe_names
+        provider = EveSwaggerProvider()
+
+        result = provider.get_names([1, 2, 3, 4])
+
+        self.assertEqual(sorted(result), [1, 3, 4])
+        self.assertEqual(result[3].name, '3')
+
+    def test_get_corps(self, client_factory):
+        provider = EveSwaggerProvider()
+
+        def get_corp(corp_id):
+            if corp_id == 11:
+                raise ObjectNotFound(corp_id, 'corporation')
+            return Corporation(id=corp_id)
+
+        with mock.patch.object(provider, 'get_corp', side_effect=get_corp) as get_corp_mock:
+            result = provider.get_corps([10, 11, '10', 12])
+
+        self.assertEqual(set(result), {10, 12})
+        self.assertEqual(get_corp_mock.call_count, 3)
+
+    def test_get_corps_conditional(self, client_factory):
+        provider = EveSwaggerProvider()
+
+        def get_corp(corp_id, conditional=False):
+            if corp_id == 11 and conditional:
+                raise ObjectNotModified(corp_id, 'corporation')
+            return Corporation(id=corp_id)
+
+        with mock.patch.object(provider, 'get_corp', side_effect=get_corp) as get_corp_mock:
+            result = provider.get_corps([10, 11], conditional=True)
+
+        self.assertEqual(set(result), {10})
+        get_corp_mock.assert_any_call(11, conditional=True)
+
+
+class EntityCacheTestCase(TestCase):
+    def setUp(self):
+        self.cache = EntityCache(max_size=2, ttl=60, use_django_cache=False)
+
+    def test_hit_and_miss(self):
+        self.assertIsNone(self.cache.get('corporation', 1))
+        corp = Corporation(id=1)
+        self.cache.set('corporation', '1', corp)
+
+        self.assertIs(self.cache.get('corporation', 1), corp)
+        self.assertIsNone(self.cache.get('alliance', 1))
+        self.assertEqual(self.cache.stats()['hits'], 1)
+        self.assertEqual(self.cache.stats()['misses'], 2)
+
+    @mock.patch(MODULE_PATH + '.time.time')
+    def test_expiry(self, now):
+        now.return_value = 1000
+        self.cache.set('corporation', 1, Corporation(id=1), ttl=10)
+        self.cache.set('corporation', 2, Corporation(id=2), ttl=0)
+
+        now.return_value = 1009
+        self.assertIsNotNone(self.cache.get('corporation', 1))
+        self.assertIsNone(self.cache.get('corporation', 2))
+        now.return_value = 1010
+        self.assertIsNone(self.cache.get('corporation', 1))
+
+    def test_eviction(self):
+        self.cache.set('corporation', 1, Corporation(id=1))
+        self.cache.set('corporation', 2, Corporation(id=2))
+        self.cache.get('corporation', 1)  # 2 becomes least recently used
+        self.cache.set('corporation', 3, Corporation(id=3))
+
+        self.assertIsNone(self.cache.get('corporation', 2))
+        self.assertIsNotNone(self.cache.get('corporation', 1))
+        self.assertEqual(self.cache.stats()['evictions'], 1)
+
+    def test_django_cache(self):
+        shared = EntityCache(use_django_cache=True)
+        shared.set('alliance', 1, Alliance(id=1, name='Test Alliance'))
+
+        other = EntityCache(use_django_cache=True)
+        self.assertEqual(other.get('alliance', 1).name, 'Test Alliance')
+
+    def test_get_or_fetch(self):
+        fetch = mock.Mock(return_value=(Corporation(id=1), 30))
+
+        self.cache.get_or_fetch('corporation', 1, fetch)
+        self.cache.get_or_fetch('corporation', 1, fetch)
+
+        self.assertEqual(fetch.call_count, 1)
+
+    def test_get_or_fetch_not_found(self):
+        fetch = mock.Mock(side_effect=ObjectNotFound(1, 'corporation'))
+
+        with self.assertRaises(ObjectNotFound):
+            self.cache.get_or_fetch('corporation', 1, fetch)
+        with self.assertRaises(ObjectNotFound):
+            self.cache.get_or_fetch('corporation', 1, fetch)
+        self.assertEqual(fetch.call_count, 2)
+
+
+@mock.patch(MODULE_PATH + '.build_client')
+class EveSwaggerProviderCacheTestCase(TestCase):
+    def test_get_corp_cached_until_expiry(self, client_factory):
+        response = mock.Mock(headers={'Expires': 'Sun, 01 Jan 2034 00:00:00 GMT'})
+        client = client_factory.return_value
+        client.Corporation.get_corporations_corporation_id.return_value.result.return_value = (
+            {'name': 'Corp', 'ticker': 'CORP', 'ceo_id': 1, 'member_count': 2}, response)
+        provider = EveSwaggerProvider(entity_cache=EntityCache(use_django_cache=False))
+
+        corp = provider.get_corp(10)
+        self.assertIs(provider.get_corp('10'), corp)
+        self.assertEqual(client.Corporation.get_corporations_corporation_id.call_count, 1)
+
+    def test_get_corp_expired(self, client_factory):
+        response = mock.Mock(headers={'Expires': 'Thu, 01 Jan 2015 00:00:00 GMT'})
+        client = client_factory.return_value
+        client.Corporation.get_corporations_corporation_id.return_value.result.return_value = (
+            {'name': 'Corp', 'ticker': 'CORP', 'ceo_id': 1, 'member_count': 2}, response)
+        provider = EveSwaggerProvider(entity_cache=EntityCache(use_django_cache=False))
+
+        provider.get_corp(10)
+        provider.get_corp(10)
+        self.assertEqual(client.Corporation.get_corporations_corporation_id.call_count, 2)
+
+
+@mock.patch(MODULE_PATH + '.build_client')
+class EveSwaggerProviderConditionalTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.data = {'name': 'Char', 'corporation_id': 2}
+
+    def test_etag_sent_and_not_modified(self, client_factory):
+        operation = client_factory.return_value.Character.get_characters_character_id
+        operation.return_value.result.return_value = (self.data, mock.Mock(headers={'ETag': '"abc"'}))
+        provider = EveSwaggerProvider(entity_cache=EntityCache(use_django_cache=False))
+
+        character = provider.get_character(1, conditional=True)
+        self.assertEqual(character.etag, '"abc"')
+        operation.assert_called_once_with(character_id=1)
+        provider.store_etag('character', character)
+
+        provider.cache.clear()
+        operation.return_value.result.side_effect = HTTPError(mock.Mock(status_code=304))
+        with self.assertRaises(ObjectNotModified):
+            provider.get_character(1, conditional=True)
+        operation.assert_called_with(character_id=1, **{'If-None-Match': '"abc"'})
+
+    def test_cached_entity_not_modified(self, client_factory):
+        operation = client_factory.return_value.Character.get_characters_character_id
+        operation.return_value.result.return_value = (self.data, mock.Mock(headers={'ETag': '"abc"'}))
+        provider = EveSwaggerProvider(entity_cache=EntityCache(use_django_cache=False))
+
+        provider.store_etag('character', provider.get_character(1))
+        with self.assertRaises(ObjectNotModified):
+            provider.get_character(1, conditional=True)
+        self.assertEqual(operation.call_count, 1)
+
+    def test_modified(self, client_factory):
+        operation = client_factory.return_value.Character.get_characters_character_id
+        operation.return_value.result.return_value = (self.data, mock.Mock(headers={'ETag': '"abc"'}))
+        provider = EveSwaggerProvider(entity_cache=EntityCache(use_django_cache=False))
+        provider.store_etag('character', provider.get_character(1))
+
+        provider.cache.clear()
+        operation.return_value.result.return_value = (self.data, mock.Mock(headers={'ETag': '"def"'}))
+        self.assertEqual(provider.get_character(1, conditional=True).etag, '"def"')
+
+
+@mock.patch(MODULE_PATH + '.build_client')
+class EveSwaggerProviderErrorLimitTestCase(TestCase):
+    def test_error_limit_delay(self, client_factory):
+        provider = EveSwaggerProvider()
+        self.assertEqual(provider.error_limit_delay(), 0)
+
+        provider._record_error_limit({'X-Esi-Error-Limit-Remain': '50', 'X-Esi-Error-Limit-Reset': '30'})
+        self.assertEqual(provider.error_limit_delay(), 0)
+
+        provider._record_error_limit({'X-Esi-Error-Limit-Remain': '5', 'X-Esi-Error-Limit-Reset': '30'})
+        self.assertAlmostEqual(provider.error_limit_delay(), 30, delta=1)
+
+    def test_error_limit_recorded_from_errors(self, client_factory):
+        operation = client_factory.return_value.Corporation.get_corporations_corporation_id
+        operation.return_value.result.side_effect = HTTPNotFound(
+            mock.Mock(status_code=404, headers={'X-Esi-Error-Limit-Remain': '1', 'X-Esi-Error-Limit-Reset': '10'}))
+        provider = EveSwaggerProvider(entity_cache=EntityCache(use_django_cache=False))
+
+        with self.assertRaises(ObjectNotFound):
+            provider.get_corp(1)
+        self.assertEqual(provider.error_limit_remain, 1)
+
+
+@mock.patch(MODULE_PATH + '.build_client')
+class EveSwaggerProviderGatherTestCase(TestCase):
+    def test_gather(self, client_factory):
+        provider = EveSwaggerProvider(max_workers=2)
+
+        self.assertEqual(provider.gather(*[lambda i=i: i * 2 for i in range(5)]), [0, 2, 4, 6, 8])
+        self.assertEqual(provider.gather(), [])
+
+    def test_gather_exceptions(self, client_factory):
+        provider = EveSwaggerProvider()
+        error = ObjectNotFound(1, 'corporation')
+
+        def fail():
+            raise error
+
+        with self.assertRaises(ObjectNotFound):
+            provider.gather(lambda: 1, fail)
+        self.assertEqual(provider.gather(lambda: 1, fail, return_exceptions=True), [1, error])
+
+    def test_gather_nested(self, client_factory):
+        provider = EveSwaggerProvider(max_workers=2)
+        threads = set()
+
+        def inner():
+            threads.add(threading.current_thread())
+
+        def outer():
+            return provider.gather(inner, inner, inner)
+
+        provider.gather(outer, outer, outer)
+
+        # nested calls run in the outer workers instead of starting more
+        self.assertLessEqual(len(threads), 2)
+        self.assertNotIn(threading.current_thread(), threads)
+
+    def test_connection_pool(self, client_factory):
+        EveSwaggerProvider(max_workers=20).client
+
+        session = client_factory.return_value.swagger_spec.http_client.session
+        args, kwargs = session.mount.call_args
+        self.assertEqual(args[1]._pool_maxsize, 20)
+
+
+class EveSwaggerProviderClientTestCase(TestCase):
+    @mock.patch(MODULE_PATH + '.build_client')
+    def test_client_built_lazily(self, client_factory):
+        provider = EveSwaggerProvider()
+        self.assertFalse(client_factory.called)
+
+        self.assertIs(provider.client, client_factory.return_value)
+        self.assertIs(provider.client, client_factory.return_value)
+        client_factory.assert_called_once_with(token=None)
+
+    def test_bundled_spec_valid(self):
+        # clients skip validation when they are built, so check the bundled spec here
+        with mock.patch(MODULE_PATH + '.SPEC_CONFIG', {'use_models': False, 'validate_swagger_spec': True}):
+            client = build_client()
+        self.assertTrue(hasattr(client.Character, 'post_characters_affiliation'))
@@ -0,0 +1,170 @@
+import time
+from datetime import timedelta
+from unittest import mock
+
+from django.core.cache import cache
+from django.test import TestCase
+from django.utils import timezone
+
+from ..models import EveCharacter, EveCorporationInfo, EveAllianceInfo
+from ..providers import Alliance, ObjectNotModified
+from ..tasks import update_alliance, update_alliances, update_corps
+from ..tasks import run_model_update, run_model_update_chunk, refresh_stale_models, MODEL_UPDATE_CHECKPOINT_KEY
+
+MODULE_PATH = 'allianceauth.eveonline.tasks'
+
+
+@mock.patch(MODULE_PATH + '.MODEL_UPDATE_CHUNK_SIZE', 2)
+@mock.patch('allianceauth.eveonline.managers.providers.provider')
+class RunModelUpdateTestCase(TestCase):
+    def setUp(self):
+        cache.delete(MODEL_UPDATE_CHECKPOINT_KEY)
+        for i in range(3):
+            EveCorporationInfo.objects.create(corporation_id=str(i + 1), corporation_name='corp%s' % i,
+                                              corporation_ticker='c%s' % i, member_count=1)
+        for i in range(2):
+            EveCharacter.objects.create(character_id=str(i + 10), character_name='char%s' % i,
+                                        corporation_id=1, corporation_name='corp0', corporation_ticker='c0')
+
+    def test_run_model_update(self, provider):
+        provider.error_limit_delay.return_value = 0
+        provider.get_corps.return_value = {}
+        provider.get_alliances.return_value = {}
+        provider.get_characters.return_value = {}
+
+        run_model_update()
+
+        self.assertEqual([args[0] for args, kwargs in provider.get_corps.call_args_list], [[1, 2], [3]])
+        self.assertFalse(provider.get_alliances.called)
+        provider.get_characters.assert_called_once_with([10, 11])
+        self.assertIsNone(cache.get(MODEL_UPDATE_CHECKPOINT_KEY))
+
+    def test_resume_interrupted(self, provider):
+        provider.error_limit_delay.return_value = 0
+        provider.get_characters.return_value = {}
+        first = EveCharacter.objects.get(character_id=10)
+        cache.set(MODEL_UPDATE_CHECKPOINT_KEY, {
+            'step': 2, 'last_pk': first.pk, 'attempts': 0, 'interval': 0, 'next_run': time.time() - 60 * 60}, None)
+
+        run_model_update()
+
+        self.assertFalse(provider.get_corps.called)
+        provider.get_characters.assert_called_once_with([11])
+
+    def test_in_progress(self, provider):
+        cache.set(MODEL_UPDATE_CHECKPOINT_KEY, {
+            'step': 0, 'last_pk': 0, 'attempts': 0, 'interval': 0, 'next_run': time.time()}, None)
+
+        run_model_update()
+
+        self.assertFalse(provider.get_corps.called)
+
+    def test_replaced_run_stops(self, provider):
+        cache.set(MODEL_UPDATE_CHECKPOINT_KEY, {
+            'step': 0, 'last_pk': 0, 'attempts': 0, 'interval': 10, 'next_run': time.time(), 'run_id': 'new'}, None)
+
+        with mock.patch.object(run_model_update_chunk, 'apply_async') as apply_async:
+            run_model_update_chunk('old')
+
+        self.assertFalse(provider.get_corps.called)
+        self.assertFalse(apply_async.called)
+
+    def test_error_limit_backoff(self, provider):
+        provider.error_limit_delay.return_value = 45
+        provider.get_corps.return_value = {}
+        cache.set(MODEL_UPDATE_CHECKPOINT_KEY, {
+            'step': 0, 'last_pk': 0, 'attempts': 0, 'interval': 10, 'next_run': time.time(), 'run_id': 'run'}, None)
+
+        with mock.patch.object(run_model_update_chunk, 'apply_async') as apply_async:
+            run_model_update_chunk('run')
+
+        apply_async.assert_called_once_with(args=['run'], countdown=45)
+        self.assertEqual(cache.get(MODEL_UPDATE_CHECKPOINT_KEY)['last_pk'],
+                         EveCorporationInfo.objects.get(corporation_id=2).pk)
+
+    def test_failed_chunk_retried(self, provider):
+        provider.error_limit_delay.return_value = 0
+        provider.get_corps.side_effect = Exception
+        cache.set(MODEL_UPDATE_CHECKPOINT_KEY, {
+            'step': 0, 'last_pk': 0, 'attempts': 0, 'interval': 10, 'next_run': time.time(), 'run_id': 'run'}, None)
+
+        with mock.patch.object(run_model_update_chunk, 'apply_async') as apply_async:
+            run_model_update_chunk('run')
+
+        apply_async.assert_called_once_with(args=['run'], countdown=10)
+        checkpoint = cache.get(MODEL_UPDATE_CHECKPOINT_KEY)
+        self.assertEqual(checkpoint['last_pk'], 0)
+        self.assertEqual(checkpoint['attempts'], 1)
+
+
+@mock.patch('allianceauth.eveonline.managers.providers.provider')
+class RefreshStaleModelsTestCase(TestCase):
+    def test_refresh_stale_models(self, provider):
+        provider.get_corps.return_value = {}
+        provider.get_characters.return_value = {}
+        for i in range(3):
+            EveCorporationInfo.objects.create(corporation_id=str(i + 1), corporation_name='corp%s' % i,
+                                              corporation_ticker='c%s' % i, member_count=1)
+        EveCorporationInfo.objects.filter(corporation_id__in=['1', '3']).update(last_updated=None)
+
+        refresh_stale_models(batch_size=1)
+        refresh_stale_models(batch_size=1)
+
+        # each tick takes the stalest corp, then marks it so it isn't picked again
+        self.assertEqual([args[0] for args, kwargs in provider.get_corps.call_args_list], [[1], [3]])
+        self.assertFalse(provider.get_characters.called)
+
+    @mock.patch(MODULE_PATH + '.REFRESH_INTERVAL', 60 * 60 * 3)
+    def test_refresh_stale_models_scales_batch(self, provider):
+        provider.get_corps.return_value = {}
+        for i in range(4):
+            EveCorporationInfo.objects.create(corporation_id=str(i + 1), corporation_name='corp%s' % i,
+                                              corporation_ticker='c%s' % i, member_count=1, last_updated=None)
+
+        refresh_stale_models(batch_size=1)
+
+        # two ticks per REFRESH_MIN_AGE, so each has to take half the corps to keep up
+        self.assertEqual(len(provider.get_corps.call_args[0][0]), 2)
+
+
+@mock.patch('allianceauth.eveonline.managers.providers.provider')
+class UpdateTasksTestCase(TestCase):
+    def setUp(self):
+        self.stale = timezone.now() - timedelta(days=1)
+        self.corp = EveCorporationInfo.objects.create(corporation_id=1, corporation_name='corp', corporation_ticker='c',
+                                                      member_count=1, last_updated=self.stale)
+        self.alliance = EveAllianceInfo.objects.create(alliance_id=2, alliance_name='alliance', alliance_ticker='a',
+                                                       executor_corp_id='1', last_updated=self.stale)
+
+    def test_update_corps_not_modified(self, provider):
+        provider.get_corps.return_value = {}
+
+        update_corps([1])
+
+        provider.get_corps.assert_called_once_with([1], conditional=True)
+        self.corp.refresh_from_db()
+        self.assertGreater(self.corp.last_updated, self.stale)
+
+    def test_update_alliances(self, provider):
+        other = EveAllianceInfo.objects.create(alliance_id=3, alliance_name='other', alliance_ticker='o',
+                                               executor_corp_id='1', last_updated=self.stale)
+        provider.get_alliances.return_value = {
+            3: Alliance(id=3, name='other', ticker='o', corp_ids=[4], executor_corp_id='4'),
+        }
+
+        update_alliances([2, 3])
+
+        provider.get_alliances.assert_called_once_with([2, 3], conditional=True)
+        self.alliance.refresh_from_db()
+        self.assertGreater(self.alliance.last_updated, self.stale)
+        self.assertEqual(self.alliance.executor_corp_id, '1')
+        other.refresh_from_db()
+        self.assertEqual(other.executor_corp_id, '4')
+
+    def test_update_alliance_not_modified(self, provider):
+        provider.get_alliance.side_effect = ObjectNotModified(2, 'alliance')
+
+        update_alliance(2)
+
+        self.alliance.refresh_from_db()
+        self.assertGreater(self.alliance.last_updated, self.stale)
@@ -20,6 +20,8 @@ from django.utils.crypto import get_random_string
 from allianceauth.eveonline.models import EveAllianceInfo
 from allianceauth.eveonline.models import EveCharacter
 from allianceauth.eveonline.models import EveCorporationInfo
+from allianceauth.eveonline.models import EveItemType
+from allianceauth.eveonline.models import EveLocation
 
 SWAGGER_SPEC_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'swagger.json')
 """
@@ -254,21 +256,23 @@ def click_fatlink_view(request, token, fat_hash=None):
         if character:
             # get data
             c = token.get_esi_client(spec_file=SWAGGER_SPEC_PATH)
-            location = c.Location.get_characters_character_id_location(character_id=token.character_id).result()
-            ship = c.Location.get_characters_character_id_ship(character_id=token.character_id).result()
-            location['solar_system_name'] = \
-                c.Universe.get_universe_systems_system_id(system_id=location['solar_system_id']).result()[
-                    'name']
+            location, ship = provider.gather(
+                c.Location.get_characters_character_id_location(character_id=token.character_id).result,
+                c.Location.get_characters_character_id_ship(character_id=token.character_id).result,
+            )
+            location['solar_system_name'] = EveLocation.objects.get_location_name(
+                location['solar_system_id'], EveLocation.SOLAR_SYSTEM)
             if location['station_id']:
-                location['station_name'] = \
-                    c.Universe.get_universe_stations_station_id(station_id=location['station_id']).result()['name']
+                location['station_name'] = EveLocation.objects.get_location_name(
+                    location['station_id'], EveLocation.STATION)
             elif location['structure_id']:
-                location['station_name'] = \
-                    c.Universe.get_universe_structures_structure_id(structure_id=location['structure_id']).result()[
-                        'name']
+                # structure names are only available to characters with docking access
+                structure = c.Universe.get_universe_structures_structure_id(structure_id=location['structure_id'])
+                location['station_name'] = EveLocation.objects.get_location_name(
+                    location['structure_id'], EveLocation.STRUCTURE, fetch=lambda: structure.result()['name'])
             else:
                 location['station_name'] = "No Station"
-            ship['ship_type_name'] = provider.get_itemtype(ship['ship_type_id']).name
+            ship['ship_type_name'] = EveItemType.objects.get_type_name(ship['ship_type_id'])
 
             fat = Fat()
             fat.system = location['solar_system_name']
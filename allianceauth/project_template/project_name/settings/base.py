@@ -47,9 +47,9 @@ CELERYBEAT_SCHEDULE = {
         'task': 'esi.tasks.cleanup_token',
         'schedule': crontab(minute=0, hour=0),
     },
-    'run_model_update': {
-        'task': 'allianceauth.eveonline.tasks.run_model_update',
-        'schedule': crontab(minute=0, hour="*/6"),
+    'refresh_stale_models': {
+        'task': 'allianceauth.eveonline.tasks.refresh_stale_models',
+        'schedule': crontab(minute='*/5'),
     },
     'check_all_character_ownership': {
         'task': 'allianceauth.authentication.tasks.check_all_character_ownership',
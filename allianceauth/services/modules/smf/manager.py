@@ -102,7 +102,7 @@ class SmfManager:
     @classmethod
     def add_avatar(cls, member_name, characterid):
         logger.debug("Adding EVE character id %s portrait as smf avatar for user %s" % (characterid, member_name))
-        avatar_url = "https://image.eveonline.com/Character/" + characterid + "_64.jpg"
+        avatar_url = "https://image.eveonline.com/Character/{}_64.jpg".format(characterid)
         cursor = connections['smf'].cursor()
         id_member = cls.get_user_id(member_name)
         cursor.execute(cls.SQL_ADD_USER_AVATAR, [avatar_url, id_member])
@@ -201,3 +201,11 @@ class SmfManagerTestCase(TestCase):
         pwhash = self.manager.gen_hash('username', 'test')
 
         self.assertEqual(pwhash, 'b6d21d37de84db76746b1c45696a00f9ce4f86fd')
+
+    @mock.patch(MODULE_PATH + '.manager.connections')
+    def test_add_avatar(self, connections):
+        with mock.patch.object(self.manager, 'get_user_id', return_value=5):
+            self.manager.add_avatar('username', 1234)
+
+        args, kwargs = connections['smf'].cursor.return_value.execute.call_args
+        self.assertEqual(args[1], ['https://image.eveonline.com/Character/1234_64.jpg', 5])
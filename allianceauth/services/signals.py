@@ -1,4 +1,5 @@
 import logging
+import threading
 
 from django.contrib.auth.models import User, Group, Permission
 from django.db import transaction
@@ -14,12 +15,28 @@ from allianceauth.authentication.signals import state_changed
 
 logger = logging.getLogger(__name__)
 
+_pending_group_updates = threading.local()
+
+
+def get_pending_group_updates():
+    """
+    pks of the users in this thread waiting on a service group update when their transaction commits
+    """
+    if not hasattr(_pending_group_updates, 'user_pks'):
+        _pending_group_updates.user_pks = set()
+    return _pending_group_updates.user_pks
+
 
 @receiver(m2m_changed, sender=User.groups.through)
 def m2m_changed_user_groups(sender, instance, action, *args, **kwargs):
     logger.debug("Received m2m_changed from %s groups with action %s" % (instance, action))
 
     def trigger_service_group_update():
+        pending = get_pending_group_updates()
+        if instance.pk not in pending:
+            # already updated for an earlier change in the same transaction
+            return
+        pending.discard(instance.pk)
         logger.debug("Triggering service group update for %s" % instance)
         # Iterate through Service hooks
         for svc in ServicesHook.get_services():
@@ -31,6 +48,7 @@ def m2m_changed_user_groups(sender, instance, action, *args, **kwargs):
 
     if instance.pk and (action == "post_add" or action == "post_remove" or action == "post_clear"):
         logger.debug("Waiting for commit to trigger service group update for %s" % instance)
+        get_pending_group_updates().add(instance.pk)
         transaction.on_commit(trigger_service_group_update)
 
 
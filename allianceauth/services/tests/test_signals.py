@@ -44,6 +44,34 @@ class ServicesSignalsTestCase(TestCase):
         args, kwargs = svc.validate_user.call_args
         self.assertEqual(self.member, args[0])
 
+    @mock.patch('allianceauth.services.signals.transaction')
+    @mock.patch('allianceauth.services.signals.ServicesHook')
+    def test_m2m_changed_user_groups_once_per_transaction(self, services_hook, transaction):
+        """
+        Test that many group changes in a transaction update the user's groups once
+        """
+        svc = mock.Mock()
+        services_hook.get_services.return_value = [svc]
+        commit_callbacks = []
+        transaction.on_commit = commit_callbacks.append
+        test_group = Group.objects.create(name="Test group")
+        other_group = Group.objects.create(name="Other group")
+
+        self.member.groups.add(test_group, other_group)
+        self.member.groups.remove(other_group)
+        for callback in commit_callbacks:
+            callback()
+
+        svc.update_groups.assert_called_once_with(self.member)
+
+        # later transactions update them again
+        commit_callbacks.clear()
+        self.member.groups.remove(test_group)
+        for callback in commit_callbacks:
+            callback()
+
+        self.assertEqual(svc.update_groups.call_count, 2)
+
     @mock.patch('allianceauth.services.signals.disable_user')
     def test_pre_delete_user(self, disable_user):
 
@@ -38,6 +38,8 @@ class AuthUtils:
             state.member_corporations.add(member_corporations)
         if member_alliances:
             state.member_alliances.add(member_alliances)
+        # the signals updating the state index may be disconnected
+        State.objects.invalidate_index()
         return state
 
     @classmethod
@@ -109,7 +111,7 @@ class AuthUtils:
         post_save.connect(state_saved, sender=State)
 
     @classmethod
-    def add_main_character(cls, user, name, character_id, corp_id='', corp_name='', corp_ticker='', alliance_id='',
+    def add_main_character(cls, user, name, character_id, corp_id=0, corp_name='', corp_ticker='', alliance_id=None,
                            alliance_name=''):
         char = EveCharacter.objects.create(
             character_id=character_id,